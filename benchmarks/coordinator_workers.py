@@ -0,0 +1,187 @@
+"""Benchmark thông lượng cấp lease của coordinator theo số worker
+
+Với mỗi số worker, chạy coordinator (COORDINATOR_WORKERS=n, bảng lease dùng
+chung qua SQLite khi n > 1) cùng hai database server giả trả lời ngay, rồi
+cho nhiều client đồng thời lặp: request_access -> heartbeat -> server_status
+-> release_access. In số lease cấp được và số request xử lý mỗi giây, cùng
+số bản ghi lease_log (bảng lease dùng chung) mỗi lease khi n > 1.
+
+    python benchmarks/coordinator_workers.py --workers 1,2,4 --clients 32 --duration 10
+
+Coordinator nghe cổng 5000 nên cổng này phải đang trống.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+COORDINATOR_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "coordinator", "coordinator-server.py"
+)
+COORDINATOR_URL = "http://127.0.0.1:5000"
+FAKE_SERVER_PORTS = (5601, 5602)
+
+
+def fake_database_server(port):
+    """Database server giả: mọi endpoint (/status, /notify_access, /release) trả về 200"""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    def app(environ, start_response):
+        body = json.dumps({"status": "success", "clients": {}, "capacity": 1024}).encode()
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def start_coordinator(workers, state_dir, servers=None, **env):
+    """Chạy coordinator với env thêm vào và đăng ký các server giả
+
+    servers là danh sách {"url", "capacity", ...} gửi tới /register_server với
+    id 1, 2, ... (thay các server mặc định); mặc định là FAKE_SERVER_PORTS.
+    """
+    if servers is None:
+        servers = [{"url": f"http://127.0.0.1:{port}", "capacity": 1024} for port in FAKE_SERVER_PORTS]
+    env = dict(os.environ, COORDINATOR_WORKERS=str(workers),
+               COORDINATOR_STATE=os.path.join(state_dir, "coordinator_state"),
+               LEASE_JOURNAL=os.path.join(state_dir, "lease_state"), **env)
+    process = subprocess.Popen([sys.executable, COORDINATOR_PATH], env=env, cwd=state_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{COORDINATOR_URL}/server_status", timeout=1).status_code == 200:
+                break
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    else:
+        stop_coordinator(process)
+        raise RuntimeError("Coordinator không khởi động được")
+
+    for server_id, server in enumerate(servers, start=1):
+        requests.post(f"{COORDINATOR_URL}/register_server", json=dict(server, id=server_id),
+                      timeout=5).raise_for_status()
+    # Các worker khác nhận server đăng ký qua bảng lease dùng chung
+    time.sleep(1)
+    return process
+
+
+def stop_coordinator(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def client_process(index, threads, duration, heartbeats, results):
+    """Một tiến trình sinh tải gồm threads client, trả (grants, requests, errors) qua results"""
+    counts = {"grants": 0, "requests": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(client_id):
+        session = requests.Session()
+        grants = sent = errors = 0
+        while time.time() < deadline:
+            response = session.post(f"{COORDINATOR_URL}/request_access",
+                                    json={"client_id": client_id, "wait": 5}, timeout=30)
+            sent += 1
+            if response.status_code != 200:
+                errors += 1
+                continue
+            grants += 1
+            for _ in range(heartbeats):
+                session.post(f"{COORDINATOR_URL}/heartbeat", json={"client_id": client_id}, timeout=30)
+            session.get(f"{COORDINATOR_URL}/server_status", timeout=30)
+            session.post(f"{COORDINATOR_URL}/release_access", json={"client_id": client_id}, timeout=30)
+            sent += heartbeats + 2
+        with lock:
+            counts["grants"] += grants
+            counts["requests"] += sent
+            counts["errors"] += errors
+
+    pool = [threading.Thread(target=client, args=(f"bench-{index}-{n}",)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((counts["grants"], counts["requests"], counts["errors"]))
+
+
+def run(workers, clients, processes, duration, heartbeats):
+    with tempfile.TemporaryDirectory() as state_dir:
+        coordinator = start_coordinator(workers, state_dir)
+        try:
+            results = multiprocessing.Queue()
+            per_process = [clients // processes + (i < clients % processes) for i in range(processes)]
+            pool = [multiprocessing.Process(target=client_process,
+                                            args=(i, n, duration, heartbeats, results))
+                    for i, n in enumerate(per_process) if n]
+            started = time.time()
+            for process in pool:
+                process.start()
+            totals = [results.get() for _ in pool]
+            elapsed = time.time() - started
+            for process in pool:
+                process.join()
+        finally:
+            stop_coordinator(coordinator)
+        records = shared_log_records(state_dir) if workers > 1 else None
+    grants, sent, errors = (sum(column) for column in zip(*totals))
+    return grants / elapsed, sent / elapsed, errors, records / grants if records and grants else None
+
+
+def shared_log_records(state_dir):
+    """Tổng số bản ghi đã ghi vào lease_log (kể cả phần đã nén vào snapshot)"""
+    db = sqlite3.connect(os.path.join(state_dir, "coordinator_state.db"))
+    try:
+        row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'lease_log'").fetchone()
+        return row[0] if row else 0
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="các số worker cần đo, cách nhau bởi dấu phẩy")
+    parser.add_argument("--clients", type=int, default=32, help="số client đồng thời")
+    parser.add_argument("--processes", type=int, default=4, help="số tiến trình sinh tải")
+    parser.add_argument("--duration", type=float, default=10, help="thời gian đo mỗi cấu hình (giây)")
+    parser.add_argument("--heartbeats", type=int, default=2, help="số heartbeat mỗi lease")
+    args = parser.parse_args()
+
+    servers = [multiprocessing.Process(target=fake_database_server, args=(port,), daemon=True)
+               for port in FAKE_SERVER_PORTS]
+    for server in servers:
+        server.start()
+
+    print(f"CPU: {os.cpu_count()}, clients: {args.clients}, {args.heartbeats} heartbeat/lease, "
+          f"{args.duration:g}s mỗi cấu hình")
+    print(f"{'workers':>7} {'grants/s':>10} {'requests/s':>11} {'errors':>7} {'log records/grant':>18}")
+    for workers in (int(n) for n in args.workers.split(",")):
+        grants, sent, errors, records = run(workers, args.clients, args.processes,
+                                            args.duration, args.heartbeats)
+        records = f"{records:.2f}" if records is not None else "-"
+        print(f"{workers:>7} {grants:>10.1f} {sent:>11.1f} {errors:>7} {records:>18}")
+
+    for server in servers:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Benchmark số request GET /data mỗi giây của database server
+
+Với mỗi DB_POOL_SIZE, chạy db_server/db-server-websocket.py trong một thư mục
+tạm (database WAL, pool kết nối đọc dùng lại và access_log ghi theo lô), nạp
+bảng sample_data tới --rows dòng, báo các client qua /notify_access rồi cho
+chúng đồng thời lặp GET /data một trang --limit dòng. In số request mỗi
+giây, độ trễ p50/p99 và số lỗi theo từng mức đồng thời. DB_POOL_SIZE=1 cho
+thấy thông lượng khi mọi truy vấn dùng chung một kết nối; --write-rate thêm
+một tiến trình ghi sample_data trong lúc đo để thấy đọc không bị ghi chặn
+(WAL).
+
+    python benchmarks/data_throughput.py --pool-sizes 1,8 --concurrency 1,8,32 --write-rate 200
+
+Database server nghe cổng 5701 và không tới được coordinator (COORDINATOR_URL
+trỏ vào cổng đóng), việc đăng ký lỗi không ảnh hưởng /data.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+DB_SERVER_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "db_server", "db-server-websocket.py"
+)
+DB_SERVER_PORT = 5701
+DB_SERVER_URL = f"http://127.0.0.1:{DB_SERVER_PORT}"
+
+
+def start_database_server(state_dir, pool_size, rows):
+    """Chạy database server với DB_POOL_SIZE=pool_size, nạp sample_data tới rows dòng"""
+    env = dict(os.environ, PORT=str(DB_SERVER_PORT), DB_POOL_SIZE=str(pool_size),
+               COORDINATOR_URL="http://127.0.0.1:9", SERVER_URL=DB_SERVER_URL)
+    process = subprocess.Popen([sys.executable, DB_SERVER_PATH], env=env, cwd=state_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{DB_SERVER_URL}/status", timeout=1).status_code == 200:
+                break
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    else:
+        stop_database_server(process)
+        raise RuntimeError("Database server không khởi động được")
+
+    # Server đã tạo bảng và dữ liệu mẫu; thêm dòng qua một kết nối riêng (WAL
+    # cho phép ghi khi server đang mở database)
+    db = sqlite3.connect(os.path.join(state_dir, "database_server1.db"), timeout=10)
+    try:
+        count = db.execute("SELECT COUNT(*) FROM sample_data").fetchone()[0]
+        db.executemany("INSERT INTO sample_data (name, value) VALUES (?, ?)",
+                       ((f"Item {n}", f"Value {n}") for n in range(count + 1, rows + 1)))
+        db.commit()
+    finally:
+        db.close()
+    return process
+
+
+def stop_database_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def writer_process(path, rate, duration):
+    """Ghi rate dòng mỗi giây vào sample_data, mỗi dòng một giao dịch"""
+    db = sqlite3.connect(path, timeout=10)
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            db.execute("INSERT INTO sample_data (name, value) VALUES (?, ?)", ("Written", "Written"))
+            db.commit()
+            time.sleep(1 / rate)
+    finally:
+        db.close()
+
+
+def client_process(index, threads, duration, limit, results):
+    """Một tiến trình sinh tải gồm threads client, trả (độ trễ, errors) qua results"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(client_id):
+        nonlocal errors
+        session = requests.Session()
+        own = []
+        failed = 0
+        while time.time() < deadline:
+            started = time.time()
+            response = session.get(f"{DB_SERVER_URL}/data", params={"limit": limit},
+                                   headers={"X-Client-ID": client_id}, timeout=30)
+            if response.status_code != 200:
+                failed += 1
+                continue
+            own.append(time.time() - started)
+        with lock:
+            latencies.extend(own)
+            errors += failed
+
+    pool = [threading.Thread(target=client, args=(f"bench-{index}-{n}",)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((latencies, errors))
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(state_dir, clients, processes, duration, limit, write_rate):
+    """Đo với clients client chia cho processes tiến trình, trả về (req/s, độ trễ, errors)"""
+    per_process = [clients // processes + (i < clients % processes) for i in range(processes)]
+    for index, threads in enumerate(per_process):
+        for n in range(threads):
+            requests.post(f"{DB_SERVER_URL}/notify_access", json={"client_id": f"bench-{index}-{n}"},
+                          timeout=10).raise_for_status()
+
+    results = multiprocessing.Queue()
+    loaders = [multiprocessing.Process(target=client_process, args=(i, n, duration, limit, results))
+               for i, n in enumerate(per_process) if n]
+    pool = list(loaders)
+    if write_rate:
+        pool.append(multiprocessing.Process(target=writer_process, args=(
+            os.path.join(state_dir, "database_server1.db"), write_rate, duration)))
+    started = time.time()
+    for process in pool:
+        process.start()
+    totals = [results.get() for _ in loaders]
+    elapsed = time.time() - started
+    for process in pool:
+        process.join()
+    latencies = [latency for own, _ in totals for latency in own]
+    return len(latencies) / elapsed, latencies, sum(errors for _, errors in totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pool-sizes", default="1,8", help="các DB_POOL_SIZE cần đo, cách nhau bởi dấu phẩy")
+    parser.add_argument("--concurrency", default="1,8,32", help="các số client đồng thời, cách nhau bởi dấu phẩy")
+    parser.add_argument("--processes", type=int, default=4, help="số tiến trình sinh tải")
+    parser.add_argument("--duration", type=float, default=10, help="thời gian đo mỗi cấu hình (giây)")
+    parser.add_argument("--rows", type=int, default=100000, help="số dòng trong sample_data")
+    parser.add_argument("--limit", type=int, default=100, help="số dòng mỗi trang /data")
+    parser.add_argument("--write-rate", type=float, default=0, help="số dòng ghi mỗi giây trong lúc đo (0: không ghi)")
+    args = parser.parse_args()
+
+    print(f"CPU: {os.cpu_count()}, {args.rows} dòng, {args.limit} dòng/trang, "
+          f"{args.write_rate:g} dòng ghi/s, {args.duration:g}s mỗi cấu hình")
+    print(f"{'pool':>5} {'clients':>8} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for pool_size in (int(n) for n in args.pool_sizes.split(",")):
+        with tempfile.TemporaryDirectory() as state_dir:
+            server = start_database_server(state_dir, pool_size, args.rows)
+            try:
+                for clients in (int(n) for n in args.concurrency.split(",")):
+                    rate, latencies, errors = run(state_dir, clients, min(args.processes, clients),
+                                                  args.duration, args.limit, args.write_rate)
+                    print(f"{pool_size:>5} {clients:>8} {rate:>9.1f} {percentile(latencies, 0.5) * 1000:>8.1f} "
+                          f"{percentile(latencies, 0.99) * 1000:>8.1f} {errors:>7}")
+            finally:
+                stop_database_server(server)
+
+
+if __name__ == "__main__":
+    main()
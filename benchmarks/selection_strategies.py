@@ -0,0 +1,142 @@
+"""Benchmark so sánh các chiến lược chọn database server (LB_STRATEGY)
+
+Với mỗi chiến lược, chạy coordinator cùng các database server giả có độ trễ
+và sức chứa khác nhau, rồi cho nhiều client hơn tổng số slot cùng lặp:
+request_access (long-poll) -> vài lượt /data trên server được cấp ->
+heartbeat kèm data_latency -> release_access. In độ trễ cấp lease (p50, p95,
+p99), độ trễ /data trung bình và mức sử dụng từng server (thời gian giữ lease
+trên tổng slot-giây).
+
+    python benchmarks/selection_strategies.py --servers 2:4,5:4,10:4,40:4 --clients 24 --duration 10
+
+Coordinator nghe cổng 5000 nên cổng này phải đang trống.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+from coordinator_workers import COORDINATOR_URL, start_coordinator, stop_coordinator
+
+STRATEGIES = ("oldest", "least_connections", "weighted_round_robin", "power_of_two", "latency")
+FAKE_SERVER_BASE_PORT = 5611
+
+
+def fake_database_server(port, latency):
+    """Database server giả trả lời /data và /notify_access sau latency giây"""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"] in ("/data", "/notify_access"):
+            time.sleep(latency)
+        body = json.dumps({"status": "success", "data": [], "next_after": None}).encode()
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(strategy, servers, clients, duration, data_requests):
+    """Chạy một chiến lược, trả về (grants/s, độ trễ cấp lease, độ trễ /data, giây giữ lease theo server)"""
+    grant_latencies = []
+    data_latencies = []
+    held = {server_id: 0.0 for server_id in range(1, len(servers) + 1)}
+    lock = threading.Lock()
+
+    def client(client_id, deadline):
+        session = requests.Session()
+        while time.time() < deadline:
+            started = time.time()
+            response = session.post(f"{COORDINATOR_URL}/request_access",
+                                    json={"client_id": client_id, "wait": 30}, timeout=60)
+            granted = time.time()
+            if response.status_code != 200:
+                continue
+            assignment = response.json()
+            latencies = []
+            for _ in range(data_requests):
+                sent = time.time()
+                session.get(f"{assignment['server_url']}/data", headers={"X-Client-ID": client_id}, timeout=30)
+                latencies.append(time.time() - sent)
+            latency = sum(latencies) / len(latencies)
+            session.post(f"{COORDINATOR_URL}/heartbeat",
+                         json={"client_id": client_id, "data_latency": latency}, timeout=30)
+            session.post(f"{COORDINATOR_URL}/release_access", json={"client_id": client_id}, timeout=30)
+            with lock:
+                grant_latencies.append(granted - started)
+                data_latencies.extend(latencies)
+                held[assignment["server_id"]] += time.time() - granted
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        coordinator = start_coordinator(1, state_dir, servers=servers, LB_STRATEGY=strategy)
+        try:
+            started = time.time()
+            deadline = started + duration
+            pool = [threading.Thread(target=client, args=(f"bench-{n}", deadline)) for n in range(clients)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            elapsed = time.time() - started
+        finally:
+            stop_coordinator(coordinator)
+    return len(grant_latencies) / elapsed, grant_latencies, data_latencies, held, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="các chiến lược cần đo, cách nhau bởi dấu phẩy")
+    parser.add_argument("--servers", default="2:4,5:4,10:4,40:4",
+                        help="độ trễ (ms):capacity của từng server giả, cách nhau bởi dấu phẩy")
+    parser.add_argument("--clients", type=int, default=24, help="số client đồng thời")
+    parser.add_argument("--duration", type=float, default=10, help="thời gian đo mỗi chiến lược (giây)")
+    parser.add_argument("--data-requests", type=int, default=3, help="số lượt /data mỗi lease")
+    args = parser.parse_args()
+
+    specs = [tuple(float(part) for part in item.split(":")) for item in args.servers.split(",")]
+    servers = []
+    processes = []
+    for index, (latency_ms, capacity) in enumerate(specs):
+        port = FAKE_SERVER_BASE_PORT + index
+        servers.append({"url": f"http://127.0.0.1:{port}", "capacity": int(capacity)})
+        processes.append(multiprocessing.Process(target=fake_database_server,
+                                                 args=(port, latency_ms / 1000), daemon=True))
+    for process in processes:
+        process.start()
+
+    print(f"CPU: {os.cpu_count()}, clients: {args.clients}, servers (ms:capacity): {args.servers}, "
+          f"{args.duration:g}s mỗi chiến lược")
+    print(f"{'strategy':>20} {'grants/s':>9} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+          f"{'data ms':>8}  utilization/server")
+    for strategy in args.strategies.split(","):
+        rate, grants, data, held, elapsed = run(strategy, servers, args.clients,
+                                                args.duration, args.data_requests)
+        utilization = " ".join(
+            f"{held[server_id] / (server['capacity'] * elapsed):4.0%}"
+            for server_id, server in enumerate(servers, start=1)
+        )
+        mean_data = sum(data) / len(data) * 1000 if data else float("nan")
+        print(f"{strategy:>20} {rate:>9.1f} {percentile(grants, 0.5) * 1000:>7.1f} "
+              f"{percentile(grants, 0.95) * 1000:>7.1f} {percentile(grants, 0.99) * 1000:>7.1f} "
+              f"{mean_data:>8.1f}  {utilization}")
+
+    for process in processes:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
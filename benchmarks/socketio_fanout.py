@@ -0,0 +1,263 @@
+"""Benchmark thời gian phát sự kiện Socket.IO của coordinator tới N socket
+
+Mở N socket websocket tới coordinator, chia đều ba vai: dashboard (phòng
+dashboards), client đã register (phòng client:<id>) và người theo dõi một
+server (phòng server:<id>, luân phiên các server giả). Mỗi vòng:
+
+- dashboard/server: một client không có socket xin lease qua HTTP, đo từ lúc
+  gửi tới khi từng dashboard nhận server_status_delta và từng người theo dõi
+  server được cấp nhận server_status có client đó;
+- client: xin lease cho một client đã register, đo tới khi socket của nó nhận
+  server_assigned (lượt cấp này cũng phát notification tới mọi dashboard).
+
+Vòng sau chỉ bắt đầu khi sự kiện đã tới mọi socket cần nhận (hoặc không
+socket nào nhận thêm trong --timeout giây). In số lần nhận, độ trễ p50/p99 và
+thời gian tới socket cuối cùng (trung vị theo vòng) của mỗi loại phòng.
+
+    python benchmarks/socketio_fanout.py --sockets 5000 --processes 4 --rounds 10
+
+Coordinator nghe cổng 5000 nên cổng này phải đang trống.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+from coordinator_workers import (COORDINATOR_URL, FAKE_SERVER_PORTS, fake_database_server,
+                                 start_coordinator, stop_coordinator)
+
+ROLES = ("dashboard", "client", "server")
+
+
+def socket_process(index, count, processes, received, dropped, ready, subscribe_dashboards, done, results):
+    """Một tiến trình giữ count socket, trả về thời điểm nhận sự kiện qua results
+
+    received đếm số lần nhận trên mọi tiến trình để tiến trình chính biết khi
+    nào một vòng đã tới hết các socket, dropped đếm số socket bị ngắt giữa chừng.
+
+    Socket thứ i (đánh số toàn cục index + k * processes) có vai ROLES[i % 3].
+    Dashboard chỉ subscribe sau khi mọi client đã register để không nhận
+    thông báo register của nhau.
+    """
+    arrivals = {role: {} for role in ROLES}
+    lock = threading.Lock()
+    sockets = []
+
+    def arrived(role, key):
+        now = time.time()
+        with lock:
+            arrivals[role].setdefault(key, []).append(now)
+        with received.get_lock():
+            received.value += 1
+
+    def connect(number):
+        role = ROLES[number % len(ROLES)]
+        sio = socketio.Client(reconnection=False)
+        seen = set()
+
+        @sio.on("disconnect")
+        def on_disconnect():
+            if not done.is_set():
+                with dropped.get_lock():
+                    dropped.value += 1
+
+        def first(key):
+            # Mỗi socket chỉ tính lần đầu thấy một client_id
+            if key not in seen:
+                seen.add(key)
+                arrived(role, key)
+
+        if role == "dashboard":
+            @sio.on("server_status_delta")
+            def on_delta(delta):
+                for entry in delta.get("changed", {}).values():
+                    for client_id in entry["status"]["clients"]:
+                        first(client_id)
+        elif role == "server":
+            @sio.on("server_status")
+            def on_status(entry):
+                for client_id in entry.get("status", {}).get("clients", []):
+                    first(client_id)
+        else:
+            client_id = f"fanout-{number}"
+
+            @sio.on("server_assigned")
+            def on_assigned(info):
+                first(client_id)
+        sio.connect(COORDINATOR_URL, transports=["websocket"])
+        if role == "client":
+            sio.emit("register", {"client_id": client_id})
+        elif role == "server":
+            sio.emit("subscribe", {"server_id": number // len(ROLES) % len(FAKE_SERVER_PORTS) + 1})
+        sockets.append((role, sio))
+
+    numbers = range(index, count * processes, processes)
+    for number in numbers:
+        if ROLES[number % len(ROLES)] != "dashboard":
+            connect(number)
+    ready.put(index)
+    subscribe_dashboards.wait()
+    for number in numbers:
+        if ROLES[number % len(ROLES)] == "dashboard":
+            connect(number)
+    for role, sio in sockets:
+        if role == "dashboard":
+            sio.emit("subscribe", {"role": "dashboard"})
+    ready.put(index)
+    done.wait()
+    results.put(arrivals)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def wait_for(received, target, timeout):
+    """Chờ tới khi received đạt target hoặc không tăng thêm trong timeout giây"""
+    last, changed = received.value, time.time()
+    while received.value < target and time.time() - changed < timeout:
+        time.sleep(0.01)
+        if received.value != last:
+            last, changed = received.value, time.time()
+
+
+def run(sockets, processes, rounds, gap, timeout):
+    per_process = sockets // processes
+    members = {role: [n for n in range(per_process * processes) if ROLES[n % len(ROLES)] == role]
+               for role in ROLES}
+
+    def watchers(server_id):
+        return sum(1 for n in members["server"] if n // len(ROLES) % len(FAKE_SERVER_PORTS) + 1 == server_id)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        # STATUS_COALESCE_MS=0: phát delta ngay, không cộng cửa sổ gộp vào độ trễ
+        coordinator = start_coordinator(1, state_dir, STATUS_COALESCE_MS="0", LEASE_TTL="0")
+        pool = []
+        try:
+            received, dropped = multiprocessing.Value("i", 0), multiprocessing.Value("i", 0)
+            ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+            subscribe_dashboards, done = multiprocessing.Event(), multiprocessing.Event()
+            pool = [multiprocessing.Process(target=socket_process,
+                                            args=(i, per_process, processes, received, dropped, ready,
+                                                  subscribe_dashboards, done, results))
+                    for i in range(processes)]
+            started = time.time()
+            for process in pool:
+                process.start()
+            for _ in pool:
+                ready.get()
+            subscribe_dashboards.set()
+            for _ in pool:
+                ready.get()
+            connect_time = time.time() - started
+            time.sleep(gap)
+
+            session = requests.Session()
+            sent = {"dashboard": {}, "server": {}, "client": {}}
+            watched = {}
+            failed = 0
+
+            def grant(client_id, sent_to, targets):
+                """Xin lease cho client_id, chờ sự kiện tới đủ targets(server_id) socket rồi giải phóng"""
+                nonlocal failed
+                before = received.value
+                for role in sent_to:
+                    sent[role][client_id] = time.time()
+                response = session.post(f"{COORDINATOR_URL}/request_access",
+                                        json={"client_id": client_id}, timeout=60)
+                if response.status_code != 200:
+                    failed += 1
+                    for role in sent_to:
+                        del sent[role][client_id]
+                    return None
+                server_id = response.json()["server_id"]
+                wait_for(received, before + targets(server_id), timeout)
+                session.post(f"{COORDINATOR_URL}/release_access", json={"client_id": client_id}, timeout=60)
+                time.sleep(gap)
+                return server_id
+
+            for round_index in range(rounds):
+                # Vòng dashboard/server: client thăm dò không có socket
+                probe = f"fanout-probe-{round_index}"
+                server_id = grant(probe, ("dashboard", "server"),
+                                  lambda server_id: len(members["dashboard"]) + watchers(server_id))
+                if server_id is not None:
+                    watched[probe] = server_id
+
+                # Vòng client: xin lease cho một client đã register; dashboard và
+                # người theo dõi server cũng nhận lượt cấp này nên chờ cả họ
+                client_id = f"fanout-{members['client'][round_index % len(members['client'])]}"
+                grant(client_id, ("client",),
+                      lambda server_id: 1 + len(members["dashboard"]) + watchers(server_id))
+
+            done.set()
+            arrivals = [results.get() for _ in pool]
+            for process in pool:
+                process.join()
+        finally:
+            for process in pool:
+                if process.is_alive():
+                    process.terminate()
+            stop_coordinator(coordinator)
+
+    rows = {}
+    for role in ROLES:
+        latencies = []
+        completions = []
+        count = 0
+        for key, at in sent[role].items():
+            times = [t for result in arrivals for t in result[role].get(key, [])]
+            if not times:
+                continue
+            count += len(times)
+            latencies.extend(t - at for t in times)
+            completions.append(max(times) - at)
+        if role == "server":
+            # Chỉ người theo dõi server được cấp lease mới nhận server_status
+            expected = sum(watchers(server_id) for server_id in watched.values())
+        elif role == "client":
+            expected = len(sent[role])
+        else:
+            expected = len(members[role]) * len(sent[role])
+        rows[role] = (len(members[role]), count, expected, latencies, completions)
+    return connect_time, rows, failed, dropped.value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sockets", type=int, default=1500, help="tổng số socket, chia đều ba vai")
+    parser.add_argument("--processes", type=int, default=4, help="số tiến trình giữ socket")
+    parser.add_argument("--rounds", type=int, default=10, help="số vòng đo mỗi loại phòng")
+    parser.add_argument("--gap", type=float, default=0.5, help="thời gian nghỉ sau mỗi lần giải phóng lease (giây)")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="bỏ chờ một vòng nếu không socket nào nhận thêm trong từng ấy giây")
+    args = parser.parse_args()
+
+    servers = [multiprocessing.Process(target=fake_database_server, args=(port,), daemon=True)
+               for port in FAKE_SERVER_PORTS]
+    for server in servers:
+        server.start()
+
+    connect_time, rows, failed, dropped = run(args.sockets, args.processes, args.rounds, args.gap, args.timeout)
+    print(f"CPU: {os.cpu_count()}, sockets: {args.sockets} (kết nối trong {connect_time:.1f}s), "
+          f"{args.rounds} vòng mỗi loại phòng, {failed} lượt cấp lease lỗi, {dropped} socket bị ngắt")
+    print(f"{'room':>10} {'sockets':>8} {'received':>14} {'p50 ms':>8} {'p99 ms':>8} {'last ms':>8}")
+    for role, (members, received, expected, latencies, completions) in rows.items():
+        print(f"{role:>10} {members:>8} {f'{received}/{expected}':>14} "
+              f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} "
+              f"{percentile(completions, 0.5) * 1000:>8.1f}")
+
+    for server in servers:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,20 @@ import sys
 import socketio
 import argparse
 import json
+import threading
 
 class DatabaseClient:
-    def __init__(self, coordinator_url=None, client_id=None):
+    def __init__(self, coordinator_url=None, client_id=None, lease_mode="shared", priority=None):
         self.client_id = client_id or str(uuid.uuid4())[:8]
         self.coordinator_url = coordinator_url or "http://192.168.214.103:5000"
         self.current_server = None
         
+        # Chế độ lease: "shared" (chỉ đọc) hoặc "exclusive" (độc quyền)
+        self.lease_mode = lease_mode
+        
+        # Lớp ưu tiên (ví dụ "interactive", "batch"), None để dùng mặc định của coordinator
+        self.priority = priority
+        
         # Khởi tạo socket cho coordinator
         self.socket = socketio.Client()
         self.setup_coordinator_socket()
@@ -22,6 +29,16 @@ class DatabaseClient:
         # Trạng thái
         self.is_connected_to_coordinator = False
         self.is_connected_to_db = False
+        
+        # Heartbeat giữ lease
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+        
+        # Độ trễ /data gần nhất, gửi kèm heartbeat để coordinator cân bằng tải
+        self.last_data_latency = None
+        
+        # Server đang theo dõi trạng thái trên coordinator
+        self.watched_server = None
     
     def setup_coordinator_socket(self):
         """Thiết lập các event handler cho WebSocket tới Coordinator"""
@@ -31,6 +48,10 @@ class DatabaseClient:
             print(f"[WebSocket] Đã kết nối tới Coordinator")
             # Đăng ký client với coordinator
             self.socket.emit('register', {'client_id': self.client_id})
+            # Phòng Socket.IO mất khi kết nối lại, theo dõi lại server đang được gán
+            self.watched_server = None
+            if self.current_server:
+                self.watch_server(self.current_server['server_id'])
         
         @self.socket.event
         def disconnect():
@@ -45,22 +66,45 @@ class DatabaseClient:
         def server_assigned(data):
             print(f"[WebSocket] Thông báo từ Coordinator: Được gán vào {data['server_name']}")
             self.current_server = data
+            self.start_heartbeat(data.get('lease_ttl'))
+            self.watch_server(data['server_id'])
             
             # Kết nối đến database server thông qua websocket
             self.connect_to_db_server()
         
         @self.socket.event
-        def server_status_change(data):
-            # Cập nhật trạng thái server từ Coordinator
-            if self.current_server:
-                server_id = self.current_server["server_id"]
-                for server in data["servers"]:
-                    if server["id"] == server_id:
-                        status = data["status"].get(str(server_id), {})
-                        current_client = status.get("current_client")
-                        
-                        if current_client != self.client_id:
-                            print(f"[WebSocket] Cảnh báo: Server {server_id} đã được gán cho client khác hoặc đã được giải phóng")
+        def lease_expired(data):
+            print(f"[WebSocket] {data['message']}")
+            self.stop_heartbeat()
+            self.watch_server(None)
+            self.current_server = None
+        
+        @self.socket.event
+        def lease_preempted(data):
+            # Coordinator lấy lại lease cho client ưu tiên cao hơn, cần yêu cầu lại
+            print(f"[WebSocket] {data['message']}")
+            self.stop_heartbeat()
+            self.watch_server(None)
+            self.current_server = None
+        
+        @self.socket.event
+        def heartbeat_ack(data):
+            # Coordinator cấp lại lease token với hạn mới mỗi lần gia hạn
+            if self.current_server and data.get('lease_token'):
+                self.current_server['lease_token'] = data['lease_token']
+        
+        @self.socket.event
+        def queued(data):
+            print(f"[WebSocket] Đang chờ server rảnh, vị trí trong hàng đợi: {data['queue_position']}")
+        
+        @self.socket.event
+        def server_status(data):
+            # Trạng thái server đang được gán (chỉ nhận khi đã subscribe server đó)
+            if self.current_server and data["server_id"] == self.current_server["server_id"]:
+                clients = data.get("status", {}).get("clients", [])
+                
+                if data.get("removed") or self.client_id not in clients:
+                    print(f"[WebSocket] Cảnh báo: Server {data['server_id']} đã được gán cho client khác hoặc đã được giải phóng")
     
     def setup_db_socket(self):
         """Thiết lập các event handler cho WebSocket tới Database Server"""
@@ -127,21 +171,31 @@ class DatabaseClient:
             print(f"Lỗi kết nối WebSocket đến database server: {str(e)}")
             return False
     
-    def request_database_access(self):
-        """Yêu cầu quyền truy cập database từ coordinator"""
+    def request_database_access(self, wait=15):
+        """Yêu cầu quyền truy cập database từ coordinator
+
+        Nếu tất cả server đều bận, coordinator giữ yêu cầu trong hàng đợi
+        tối đa `wait` giây thay vì từ chối ngay.
+        """
         print(f"Client {self.client_id} đang yêu cầu quyền truy cập database...")
         
+        payload = {"client_id": self.client_id, "wait": wait, "mode": self.lease_mode}
+        if self.priority:
+            payload["priority"] = self.priority
+        
         try:
             response = requests.post(
                 f"{self.coordinator_url}/request_access",
-                json={"client_id": self.client_id},
-                timeout=20
+                json=payload,
+                timeout=wait + 20
             )
             
             # Xử lý response thành công
             if response.status_code == 200:
                 self.current_server = response.json()
                 print(f"✅ Được cấp quyền truy cập vào {self.current_server['server_name']}")
+                self.start_heartbeat(self.current_server.get('lease_ttl'))
+                self.watch_server(self.current_server['server_id'])
                 
                 # Kết nối WebSocket đến database server nếu chưa kết nối
                 if not self.is_connected_to_db:
@@ -153,8 +207,16 @@ class DatabaseClient:
             elif response.status_code == 409:
                 self.current_server = response.json()
                 print(f"ℹ️ {response.json().get('message', 'Bạn đã được kết nối đến một server')}")
+                if not (self.heartbeat_thread and self.heartbeat_thread.is_alive()):
+                    self.send_heartbeat()
                 return True
             
+            # Đang chờ trong hàng đợi (status code 202)
+            elif response.status_code == 202:
+                data = response.json()
+                print(f"⏳ Đang chờ trong hàng đợi: vị trí {data.get('queue_position')}/{data.get('queue_depth')}")
+                return False
+            
             # Các server đều bận (status code 503)
             elif response.status_code == 503:
                 print(f"⚠️ {response.json().get('error', 'Tất cả server đều đang bận')}")
@@ -169,23 +231,113 @@ class DatabaseClient:
             print(f"❌ Lỗi kết nối tới coordinator: {str(e)}")
             return False
     
-    def access_database(self):
-        """Truy cập database server đã được chỉ định"""
+    def watch_server(self, server_id):
+        """Chỉ theo dõi trạng thái của server đang được gán (phòng server:<id> trên coordinator)"""
+        watched = self.watched_server
+        if watched == server_id or not self.is_connected_to_coordinator:
+            return
+        try:
+            if watched is not None:
+                self.socket.emit('unsubscribe', {'server_id': watched})
+            if server_id is not None:
+                self.socket.emit('subscribe', {'server_id': server_id})
+            self.watched_server = server_id
+        except Exception as e:
+            print(f"Lỗi khi theo dõi trạng thái server: {str(e)}")
+    
+    def start_heartbeat(self, lease_ttl):
+        """Gửi heartbeat định kỳ (mỗi 1/3 thời hạn lease) để coordinator không thu hồi lease"""
+        self.stop_heartbeat()
+        if not lease_ttl:
+            return
+        
+        interval = max(lease_ttl / 3, 1)
+        stop_event = threading.Event()
+        self.heartbeat_stop = stop_event
+        
+        def run():
+            while not stop_event.wait(interval):
+                if not self.send_heartbeat():
+                    break
+        
+        self.heartbeat_thread = threading.Thread(target=run, daemon=True)
+        self.heartbeat_thread.start()
+    
+    def stop_heartbeat(self):
+        """Dừng gửi heartbeat"""
+        self.heartbeat_stop.set()
+    
+    def send_heartbeat(self):
+        """Gia hạn lease qua WebSocket, hoặc qua REST nếu chưa kết nối WebSocket"""
+        payload = {'client_id': self.client_id}
+        if self.last_data_latency is not None:
+            payload['data_latency'] = self.last_data_latency
+            self.last_data_latency = None
+        
+        try:
+            if self.is_connected_to_coordinator:
+                self.socket.emit('heartbeat', payload)
+                return True
+            
+            response = requests.post(
+                f"{self.coordinator_url}/heartbeat",
+                json=payload,
+                timeout=5
+            )
+            if response.status_code == 404:
+                print("⚠️ Lease đã hết hạn hoặc đã bị thu hồi.")
+                self.current_server = None
+                return False
+            lease_token = response.json().get('lease_token')
+            if self.current_server and lease_token:
+                self.current_server['lease_token'] = lease_token
+            return True
+        except Exception as e:
+            print(f"Lỗi khi gửi heartbeat: {str(e)}")
+            return True
+    
+    def data_headers(self):
+        """Header client ID và lease token (database server tự xác thực token)"""
+        headers = {"X-Client-ID": self.client_id}
+        if self.current_server.get('lease_token'):
+            headers["X-Lease-Token"] = self.current_server['lease_token']
+        return headers
+    
+    @staticmethod
+    def data_params(query, after=None, limit=None):
+        """Tham số /data: truy vấn (fields, order, name__prefix=...) và cursor trang"""
+        params = dict(query)
+        if after is not None:
+            # Cursor [giá trị, id] khi sắp xếp theo cột khác id
+            params["after"] = json.dumps(after) if isinstance(after, list) else after
+        if limit is not None:
+            params["limit"] = limit
+        return params
+    
+    def access_database(self, after=None, limit=None, **query):
+        """Truy cập database server đã được chỉ định
+
+        Trả về một trang dữ liệu sau cursor after; "next_after" trong kết quả
+        là cursor của trang sau, None khi đã hết. query là các tham số truy
+        vấn của /data, ví dụ fields="id,name", name__prefix="Item", order="-id".
+        """
         if not self.current_server:
             print("❌ Chưa được cấp quyền truy cập database. Hãy yêu cầu quyền trước.")
             return None
         
+        params = self.data_params(query, after, limit)
+        
         try:
-            # Thêm header client ID vào request
-            headers = {"X-Client-ID": self.client_id}
-            
             # Truy vấn dữ liệu
             print(f"📤 Đang gửi yêu cầu truy xuất dữ liệu đến {self.current_server['server_name']}...")
+            started = time.time()
             response = requests.get(
                 f"{self.current_server['server_url']}/data",
-                headers=headers,
+                headers=self.data_headers(),
+                params=params,
                 timeout=5
             )
+            self.last_data_latency = time.time() - started
             
             if response.status_code == 200:
                 print("📥 Nhận dữ liệu thành công!")
@@ -198,6 +350,44 @@ class DatabaseClient:
             print(f"❌ Lỗi kết nối tới database server: {str(e)}")
             return None
     
+    def iter_data(self, after=None, page_size=None, stream=True, **query):
+        """Duyệt toàn bộ kết quả truy vấn (sau cursor after), trả về từng dòng
+
+        stream=True đọc một response NDJSON theo từng dòng, bộ nhớ không phụ
+        thuộc kích thước bảng; stream=False lần lượt lấy từng trang bằng
+        cursor next_after. Lỗi (chưa có lease, lease bị thu hồi giữa chừng)
+        được báo bằng exception. query giống access_database.
+        """
+        if not self.current_server:
+            raise RuntimeError("Chưa được cấp quyền truy cập database")
+        url = f"{self.current_server['server_url']}/data"
+        
+        if not stream:
+            while True:
+                params = self.data_params(query, after, page_size)
+                response = requests.get(url, headers=self.data_headers(), params=params, timeout=5)
+                if response.status_code != 200:
+                    raise RuntimeError(response.json().get('error'))
+                page = response.json()
+                yield from page["data"]
+                after = page.get("next_after")
+                if after is None:
+                    return
+        
+        params = dict(self.data_params(query, after), stream=1)
+        started = time.time()
+        with requests.get(url, headers=self.data_headers(), params=params, stream=True, timeout=5) as response:
+            if response.status_code != 200:
+                raise RuntimeError(response.json().get('error'))
+            self.last_data_latency = time.time() - started
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                row = json.loads(line)
+                if "error" in row:
+                    raise RuntimeError(row["error"])
+                yield row
+    
     def release_access(self):
         """Giải phóng quyền truy cập database"""
         if not self.current_server:
@@ -209,7 +399,10 @@ class DatabaseClient:
             print(f"📤 Đang thông báo giải phóng đến {self.current_server['server_name']}...")
             db_response = requests.post(
                 f"{self.current_server['server_url']}/release",
-                json={"client_id": self.client_id},
+                json={
+                    "client_id": self.client_id,
+                    "lease_token": self.current_server.get('lease_token')
+                },
                 timeout=5
             )
             
@@ -226,6 +419,8 @@ class DatabaseClient:
             
             if db_response.status_code == 200 and coord_response.status_code == 200:
                 print(f"✅ Đã giải phóng quyền truy cập từ {self.current_server['server_name']}")
+                self.stop_heartbeat()
+                self.watch_server(None)
                 self.current_server = None
                 return True
             else:
@@ -252,13 +447,14 @@ class DatabaseClient:
                     server_id = server["id"]
                     status = data["status"].get(str(server_id), {})
                     is_busy = status.get("busy", False)
-                    current_client = status.get("current_client", "Không có")
+                    clients = status.get("clients", [])
                     
                     print(f"Server {server['name']}:")
                     print(f"  - URL: {server['url']}")
                     print(f"  - Trạng thái: {'Đang bận' if is_busy else 'Sẵn sàng'}")
-                    if is_busy:
-                        print(f"  - Client đang truy cập: {current_client}")
+                    print(f"  - Slot đang dùng: {len(clients)}/{status.get('capacity', 1)}")
+                    if clients:
+                        print(f"  - Client đang truy cập: {', '.join(clients)}")
                     print("")
                 
                 return data
@@ -366,6 +562,7 @@ class DatabaseClient:
     
     def cleanup(self):
         """Dọn dẹp kết nối khi kết thúc"""
+        self.stop_heartbeat()
         try:
             if self.db_socket and self.db_socket.connected:
                 print("Đang ngắt kết nối từ Database Server...")
@@ -385,6 +582,11 @@ def parse_arguments():
                         help='URL của Coordinator (mặc định: http://localhost:5000)')
     parser.add_argument('-i', '--id', 
                         help='ID của client (mặc định: tự động tạo)')
+    parser.add_argument('-m', '--mode', choices=['shared', 'exclusive'],
+                        default='shared',
+                        help='Chế độ lease: shared (chỉ đọc, dùng chung) hoặc exclusive (mặc định: shared)')
+    parser.add_argument('-p', '--priority',
+                        help='Lớp ưu tiên, ví dụ interactive hoặc batch (mặc định: theo coordinator)')
     parser.add_argument('--gui', action='store_true',
                         help='Mở giao diện web dashboard thay vì chạy demo')
     parser.add_argument('--interactive', action='store_true',
@@ -404,7 +606,7 @@ if __name__ == "__main__":
     
     try:
         # Tạo và chạy client
-        client = DatabaseClient(args.coordinator, args.id)
+        client = DatabaseClient(args.coordinator, args.id, args.mode, args.priority)
         
         if args.interactive:
             client.run_interactive()
@@ -1,26 +1,1798 @@
+# Dùng eventlet khi có: monkey patch để các lời gọi HTTP tới database server
+# nhường event loop thay vì chặn toàn bộ coordinator
+try:
+    import eventlet
+    eventlet.monkey_patch()
+except ImportError:
+    pass
+
 from flask import Flask, request, jsonify, send_from_directory
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import PubSubManager
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import json
 import os
+import heapq
+import threading
+import itertools
+import random
+import hmac
+import hashlib
+import base64
+import socket
+import signal
+import sqlite3
+from collections import OrderedDict, deque
 from flask_cors import CORS
+from werkzeug.serving import make_server
 
 app = Flask(__name__)
-CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+CORS(app, expose_headers=["ETag"])
+# Khởi tạo với app ở cuối phần khai báo, khi đã biết có dùng message queue không
+socketio = SocketIO(cors_allowed_origins="*")
 
-# Thông tin về các database servers
+# Các database servers khởi tạo sẵn ("capacity": số client phục vụ đồng thời).
+# Database server cũng có thể tự đăng ký qua /register_server lúc chạy
 database_servers = [
     {"id": 1, "name": "Database Server 1", "url": "http://192.168.214.103:5001"},
     {"id": 2, "name": "Database Server 2", "url": "http://192.168.214.103:5002"}
 ]
 
-# Lưu trữ trạng thái của các database servers
-server_status = {}
+# Số slot mặc định của một server nếu không khai báo "capacity"
+DEFAULT_SERVER_CAPACITY = int(os.environ.get('SERVER_CAPACITY', 1))
+
+# Thời hạn (giây) của một lease nếu client không gửi heartbeat, 0 để tắt
+LEASE_TTL_SECONDS = float(os.environ.get('LEASE_TTL', 30))
+
+# Chiến lược chọn server: oldest, least_connections, weighted_round_robin,
+# power_of_two, latency
+LB_STRATEGY = os.environ.get('LB_STRATEGY', 'oldest')
+
+# Hệ số làm mượt EWMA cho độ trễ quan sát được của các server
+LATENCY_EWMA_ALPHA = 0.3
+
+# Kiểm tra sức khỏe database server: chu kỳ (giây), timeout, backoff tối đa,
+# ngưỡng độ trễ coi là degraded và số lần lỗi liên tiếp trước khi coi là down
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 5))
+HEALTH_CHECK_TIMEOUT = 2
+HEALTH_CHECK_MAX_BACKOFF = 60
+HEALTH_DEGRADED_LATENCY = 1.0
+HEALTH_FAILURE_THRESHOLD = 2
+
+# Gọi tới database server: timeout kết nối/đọc (giây), số request đồng thời
+# tối đa tới mỗi server và thời gian chờ tối đa để lấy lượt gọi
+DB_CONNECT_TIMEOUT = 2
+DB_NOTIFY_TIMEOUT = 12
+DB_RELEASE_TIMEOUT = 10
+DB_SERVER_MAX_CONCURRENCY = int(os.environ.get('DB_SERVER_MAX_CONCURRENCY', 16))
+DB_SERVER_SLOT_TIMEOUT = 5
+
+# Thông báo giải phóng lease chạy nền, thử lại với backoff theo hàm mũ
+RELEASE_RETRIES = 3
+RELEASE_RETRY_BACKOFF = 0.5
+
+# Circuit breaker cho từng database server: mở khi tỉ lệ lỗi (kể cả gọi chậm
+# hơn BREAKER_SLOW_CALL giây) trong BREAKER_WINDOW lần gọi gần nhất vượt
+# BREAKER_ERROR_RATE, sau BREAKER_OPEN_SECONDS chuyển half_open cho một lần thử
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_SLOW_CALL = 2.0
+BREAKER_OPEN_SECONDS = 10
+
+# Notify chậm hơn NOTIFY_HEDGE_AFTER giây thì chuyển lease sang server rảnh
+# khác (0 để tắt); mỗi lần cấp thử tối đa GRANT_MAX_ATTEMPTS server
+NOTIFY_HEDGE_AFTER = float(os.environ.get('NOTIFY_HEDGE_AFTER', 1.0))
+GRANT_MAX_ATTEMPTS = 3
+
+# Lease token ký HMAC-SHA256 bằng khóa dùng chung với các database server, để
+# database server tự xác thực client mà không cần hỏi coordinator. Token của
+# lease không có TTL (LEASE_TTL=0) hết hạn sau LEASE_TOKEN_MAX_TTL giây
+LEASE_TOKEN_SECRET = os.environ.get('LEASE_TOKEN_SECRET', 'dev-lease-token-secret')
+LEASE_TOKEN_MAX_TTL = 3600
+
+# Cách gọi /notify_access khi cấp lease: "async" (chạy nền, client nhận lease
+# và token ngay) hoặc "sync" (chờ database server xác nhận, có failover)
+LEASE_NOTIFY = os.environ.get('LEASE_NOTIFY', 'async')
+
+# Cửa sổ (mili giây) gộp các thay đổi trạng thái server thành một sự kiện
+# server_status_delta, 0 để phát ngay từng thay đổi
+STATUS_COALESCE_SECONDS = float(os.environ.get('STATUS_COALESCE_MS', 50)) / 1000
+
+# Số delta gần nhất giữ lại cho /server_status?since=<version>
+STATUS_HISTORY_SIZE = 256
+
+# Nhật ký lease (WAL) và snapshot để khởi động lại không mất lease; đặt
+# LEASE_JOURNAL="" để tắt. Ghi đĩa + fsync theo lô mỗi JOURNAL_FLUSH_INTERVAL
+# giây, nén thành snapshot sau JOURNAL_COMPACT_RECORDS bản ghi
+LEASE_JOURNAL = os.environ.get('LEASE_JOURNAL', 'lease_state')
+JOURNAL_FLUSH_INTERVAL = 0.05
+JOURNAL_COMPACT_RECORDS = 5000
+
+# Số tiến trình coordinator dùng chung cổng 5000. Khi lớn hơn 1, bảng lease
+# dùng chung qua SQLite (WAL) tại COORDINATOR_STATE.db và sự kiện Socket.IO
+# được chuyển giữa các worker qua message queue: SOCKETIO_MESSAGE_QUEUE
+# (redis://, kafka://, amqp://...) nếu đặt, nếu không thì hàng đợi SQLite tại
+# COORDINATOR_STATE.events.db trên cùng máy
+COORDINATOR_WORKERS = int(os.environ.get('COORDINATOR_WORKERS', 1))
+COORDINATOR_STATE = os.environ.get('COORDINATOR_STATE', 'coordinator_state')
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+# Số kết nối đồng thời tối đa của mỗi worker khi chạy eventlet: mỗi socket
+# websocket giữ một greenthread, mặc định 1024 của eventlet.wsgi chặn accept
+# khi có hơn ~1000 client/dashboard cùng kết nối
+COORDINATOR_MAX_CONNECTIONS = int(os.environ.get('COORDINATOR_MAX_CONNECTIONS', 10000))
+SHARED_SYNC_INTERVAL = 0.05
+SHARED_COMPACT_RECORDS = 20000
+SOCKETIO_QUEUE_POLL = 0.005
+SOCKETIO_QUEUE_KEEP = 10000
+
+# Database server tự đăng ký phải gửi heartbeat trong khoảng này (giây),
+# quá hạn thì bị hủy đăng ký
+SERVER_REGISTRATION_TTL = float(os.environ.get('SERVER_REGISTRATION_TTL', 30))
+
+# Chế độ lease: shared (chỉ đọc, nhiều client dùng chung) và exclusive (độc quyền)
+LEASE_MODES = ("shared", "exclusive")
+
+# Lớp ưu tiên của client ("priority" trong yêu cầu) và trọng số chia slot
+# giữa các lớp cùng chờ, dạng "tên:trọng số,..."; client không gửi priority
+# thuộc DEFAULT_PRIORITY
+PRIORITY_CLASSES = {
+    name.strip(): float(weight)
+    for name, weight in (
+        item.split(":") for item in os.environ.get('PRIORITY_CLASSES', 'interactive:4,batch:1').split(",")
+    )
+}
+DEFAULT_PRIORITY = os.environ.get('DEFAULT_PRIORITY', 'interactive')
+
+# Yêu cầu đã chờ quá PREEMPT_GRACE giây được lấy lại lease của lớp có trọng
+# số thấp hơn (lease cũ nhất trước), âm để tắt; kiểm tra mỗi
+# PREEMPT_CHECK_INTERVAL giây
+PREEMPT_GRACE_SECONDS = float(os.environ.get('PREEMPT_GRACE', -1))
+PREEMPT_CHECK_INTERVAL = 0.25
+
+# Số độ trễ cấp lease gần nhất giữ lại cho mỗi lớp ưu tiên
+PRIORITY_LATENCY_WINDOW = 1024
+
+class LeaseRegistry:
+    """Bảng lease có chỉ mục của các database server
+
+    - servers: server_id -> thông tin server
+    - status: server_id -> trạng thái (clients, capacity, exclusive,
+      writer_waiting, health, breaker, draining, deregistered, last_access)
+    - client_leases: client_id -> lease {server_id, state, mode, priority,
+      granted_at, expires_at}
+    - writer_targets: client_id của yêu cầu exclusive đang chờ -> server_id
+      mà nó đang đợi trống
+    - free_heap: heap (last_access, server_id) của các server nhận được lease
+      shared mới; idle_heap: các server trống nhận được lease exclusive;
+      expiry_heap: heap (expires_at, client_id) để thu hồi lease hết hạn.
+      Phần tử cũ được loại bỏ khi lấy ra (xóa lười)
+
+    server_id luôn là int, mọi thao tác cấp/giải phóng là O(log n).
+
+    Cấp lease gồm hai bước: reserve giữ chỗ server (state "reserved") trong
+    lúc chờ database server xác nhận, sau đó commit (state "active") hoặc
+    abort. Mọi thao tác thay đổi bảng đều giữ self.lock nên hai yêu cầu song
+    song không thể nhận cùng một slot; thao tác chỉ đọc và gia hạn lease giữ
+    self.read_lock (cùng khóa khi chạy một tiến trình).
+
+    Lease shared dùng chung server tới hết capacity; lease exclusive cần
+    server trống hoàn toàn. Khi một yêu cầu exclusive phải chờ, server nó
+    nhắm tới ngừng nhận lease shared mới để writer không bị đói. Server có
+    health "down", circuit breaker đang mở, đang drain hoặc đã hủy đăng ký
+    không nhận lease mới (lease
+    đang có vẫn chạy tới khi giải phóng/hết hạn); server hủy đăng ký chỉ bị
+    xóa khỏi bảng khi lease cuối cùng trên nó được giải phóng.
+
+    Mọi thay đổi được ghi thành bản ghi qua journal (LeaseJournal khi chạy
+    một tiến trình, SharedLeaseStore khi chạy nhiều worker); apply() áp dụng
+    lại bản ghi do worker khác ghi. health và breaker là trạng thái riêng của
+    từng worker và không được ghi.
+    """
+
+    def __init__(self):
+        self.servers = {}
+        self.status = {}
+        self.client_leases = {}
+        self.writer_targets = {}
+        self.free_heap = []
+        self.idle_heap = []
+        self.expiry_heap = []
+        self.journal = None
+        self.replaying = False
+        self.lock = threading.RLock()
+        self.read_lock = self.lock
+
+    def _record(self, op, **fields):
+        """Ghi thay đổi vào nhật ký (gọi khi đang giữ self.lock để giữ thứ tự)"""
+        if self.journal and not self.replaying:
+            self.journal.record(op, **fields)
+
+    def record_event(self, op, **fields):
+        """Ghi sự kiện không đổi bảng lease để các worker khác cùng thấy (ví dụ heartbeat của server)"""
+        with self.lock:
+            self._record(op, **fields)
+
+    def apply(self, entry):
+        """Áp dụng một bản ghi do worker khác ghi, không kiểm tra điều kiện và không ghi lại"""
+        op = entry["op"]
+        self.replaying = True
+        try:
+            if op == "server":
+                self.add_server(entry["server"])
+            elif op == "deregister":
+                self.remove_server(entry["server_id"])
+            elif op == "server_removed":
+                if entry["server_id"] in self.status:
+                    del self.status[entry["server_id"]]
+                    del self.servers[entry["server_id"]]
+            elif op in ("reserve", "grant"):
+                client_id = entry["client_id"]
+                if client_id not in self.client_leases and entry["server_id"] in self.status:
+                    self._insert_lease(client_id, entry["server_id"], entry["mode"],
+                                       entry["granted_at"], "reserved",
+                                       entry.get("priority", DEFAULT_PRIORITY))
+                if op == "grant" and client_id in self.client_leases:
+                    self.client_leases[client_id]["state"] = "active"
+            elif op == "release":
+                self.release(entry["client_id"])
+            elif op == "renew":
+                # Gia hạn ghi theo lô có thể tới sau một lần gia hạn mới hơn
+                lease = self.client_leases.get(entry["client_id"])
+                if lease and (lease["expires_at"] or 0) < entry["expires_at"]:
+                    self.renew(entry["client_id"], entry["expires_at"])
+            elif op == "writer_wait":
+                self.stop_waiting(entry["client_id"])
+                status = self.status.get(entry["server_id"])
+                if status is not None:
+                    status["writer_waiting"] = entry["client_id"]
+                    self.writer_targets[entry["client_id"]] = entry["server_id"]
+            elif op == "writer_done":
+                self.stop_waiting(entry["client_id"])
+            elif op == "drain":
+                if entry["server_id"] in self.status:
+                    self.set_draining(entry["server_id"], entry["draining"])
+        finally:
+            self.replaying = False
+
+    def export_state(self):
+        """Toàn bộ bảng lease (trừ health/breaker) dạng JSON, cho snapshot của SharedLeaseStore"""
+        with self.lock:
+            return {
+                "servers": list(self.servers.values()),
+                "status": {
+                    server_id: {
+                        "draining": status["draining"],
+                        "deregistered": status["deregistered"],
+                        "writer_waiting": status["writer_waiting"]
+                    }
+                    for server_id, status in self.status.items()
+                },
+                "leases": [dict(lease, client_id=client_id) for client_id, lease in self.client_leases.items()]
+            }
+
+    def load_state(self, state):
+        """Thay bảng lease bằng state từ export_state(), giữ health/breaker đang có của server"""
+        with self.lock:
+            local = {
+                server_id: (status["health"], status["breaker"])
+                for server_id, status in self.status.items()
+            }
+            self.servers = {}
+            self.status = {}
+            self.client_leases = {}
+            self.writer_targets = {}
+            self.free_heap = []
+            self.idle_heap = []
+            self.expiry_heap = []
+            self.replaying = True
+            try:
+                for server in state["servers"]:
+                    self.add_server(server)
+                    status = self.status[server["id"]]
+                    status["health"], status["breaker"] = local.get(server["id"], ("unknown", "closed"))
+                    saved = state["status"][str(server["id"])]
+                    status["draining"] = saved["draining"]
+                    status["deregistered"] = saved["deregistered"]
+                    if saved["writer_waiting"] is not None:
+                        status["writer_waiting"] = saved["writer_waiting"]
+                        self.writer_targets[saved["writer_waiting"]] = server["id"]
+                for lease in state["leases"]:
+                    self._insert_lease(lease["client_id"], lease["server_id"], lease["mode"],
+                                       lease["granted_at"], lease["state"],
+                                       lease.get("priority", DEFAULT_PRIORITY))
+                    if lease["expires_at"] is not None:
+                        self.renew(lease["client_id"], lease["expires_at"])
+                for server_id in self.status:
+                    self._push_free(server_id)
+            finally:
+                self.replaying = False
+
+    def add_server(self, server):
+        """Thêm một database server vào bảng, ở trạng thái rảnh
+
+        Nếu server_id đã có (server đăng ký lại, ví dụ sau khi khởi động lại),
+        chỉ cập nhật thông tin và giữ nguyên các lease đang có trên server.
+        """
+        server_id = int(server["id"])
+        server = dict(server, id=server_id)
+        capacity = max(1, int(server.get("capacity", DEFAULT_SERVER_CAPACITY)))
+        with self.lock:
+            self.servers[server_id] = server
+            self._record("server", server=server)
+            status = self.status.get(server_id)
+            if status is not None:
+                status["capacity"] = capacity
+                status["deregistered"] = False
+                self._push_free(server_id)
+                return
+            self.status[server_id] = {
+                "clients": set(),
+                "capacity": capacity,
+                "exclusive": False,
+                "writer_waiting": None,
+                "health": "unknown",
+                "breaker": "closed",
+                "draining": False,
+                "deregistered": False,
+                "last_access": 0
+            }
+            self._push_free(server_id)
+
+    def remove_server(self, server_id):
+        """Hủy đăng ký server: ngừng cấp lease mới trên server
+
+        Server trống bị xóa ngay; server còn lease được giữ lại tới khi
+        prune() thấy nó trống. Trả về True nếu server đã bị xóa khỏi bảng.
+        """
+        with self.lock:
+            status = self.status.get(server_id)
+            if status is None:
+                return True
+            status["deregistered"] = True
+            self._retarget_writer(server_id)
+            if status["clients"]:
+                self._record("deregister", server_id=server_id)
+                return False
+            del self.status[server_id]
+            del self.servers[server_id]
+            self._record("server_removed", server_id=server_id)
+            return True
+
+    def prune(self):
+        """Xóa các server đã hủy đăng ký và không còn lease, trả về danh sách server_id"""
+        with self.lock:
+            removed = [
+                server_id for server_id, status in self.status.items()
+                if status["deregistered"] and not status["clients"]
+            ]
+            for server_id in removed:
+                del self.status[server_id]
+                del self.servers[server_id]
+                self._record("server_removed", server_id=server_id)
+            return removed
+
+    def find_server(self, url):
+        """server_id của server có url này, None nếu chưa đăng ký"""
+        with self.read_lock:
+            for server_id, server in self.servers.items():
+                if server["url"] == url:
+                    return server_id
+            return None
+
+    def next_server_id(self):
+        with self.read_lock:
+            return max(self.servers, default=0) + 1
+
+    def leases_on(self, server_id):
+        """Các lease (client_id, mode) đang có trên server"""
+        with self.read_lock:
+            return [
+                {"client_id": client_id, "mode": lease["mode"]}
+                for client_id, lease in self.client_leases.items()
+                if lease["server_id"] == server_id
+            ]
+
+    @staticmethod
+    def has_free_slot(status):
+        """Server còn slot trống hay không"""
+        return len(status["clients"]) < status["capacity"]
+
+    @staticmethod
+    def in_rotation(status):
+        """Server có được cấp lease mới không (không down, breaker không mở, không drain, chưa hủy đăng ký)"""
+        return not (status["health"] == "down" or status["breaker"] == "open"
+                    or status["draining"] or status["deregistered"])
+
+    @classmethod
+    def accepts(cls, status, mode, client_id=None):
+        """Server có nhận thêm lease ở chế độ mode cho client này không"""
+        if not cls.in_rotation(status) or status["exclusive"]:
+            return False
+        if status["writer_waiting"] not in (None, client_id):
+            return False
+        if mode == "exclusive":
+            return not status["clients"]
+        return cls.has_free_slot(status)
+
+    def _push_free(self, server_id):
+        """Đưa server vào các heap mà nó đang đủ điều kiện"""
+        status = self.status[server_id]
+        entry = (status["last_access"], server_id)
+        if self.accepts(status, "shared"):
+            heapq.heappush(self.free_heap, entry)
+        if self.accepts(status, "exclusive"):
+            heapq.heappush(self.idle_heap, entry)
+
+    def server_of(self, client_id):
+        """Server mà client đang giữ lease, None nếu không có"""
+        lease = self.client_leases.get(client_id)
+        if lease is None:
+            return None
+        return self.servers.get(lease["server_id"])
+
+    def writer_target(self, client_id):
+        """Server mà writer này đã chờ sẵn, nếu server đó đã trống"""
+        with self.read_lock:
+            target = self.writer_targets.get(client_id)
+            if target is not None and self.accepts(self.status[target], "exclusive", client_id):
+                return self.servers[target]
+            return None
+
+    def candidates(self, mode="shared"):
+        """Các server đang nhận lease mode (O(n), dùng cho các chiến lược chọn server)"""
+        with self.read_lock:
+            return [
+                self.servers[server_id]
+                for server_id, status in self.status.items()
+                if self.accepts(status, mode)
+            ]
+
+    def load(self, server_id):
+        """Tỉ lệ slot đang dùng của server"""
+        status = self.status.get(server_id)
+        if status is None:
+            return 1.0
+        return len(status["clients"]) / status["capacity"]
+
+    def peek_free(self, mode="shared"):
+        """Server nhận được lease mode có last_access nhỏ nhất, None nếu không có"""
+        with self.read_lock:
+            heap = self.idle_heap if mode == "exclusive" else self.free_heap
+
+            while heap:
+                last_access, server_id = heap[0]
+                status = self.status.get(server_id)
+                if status and self.accepts(status, mode) and status["last_access"] == last_access:
+                    return self.servers[server_id]
+                # Phần tử đã cũ (server đã đầy, đã được cấp tiếp hoặc bị xóa)
+                heapq.heappop(heap)
+            return None
+
+    def wait_for_writer(self, client_id):
+        """Chọn server cho yêu cầu exclusive đang chờ và chặn lease shared mới trên đó
+
+        Chọn server ít client nhất chưa có writer nào chờ; trả về server_id
+        hoặc None nếu mọi server đều đã có writer chờ.
+        """
+        with self.lock:
+            if client_id in self.writer_targets:
+                return self.writer_targets[client_id]
+            candidates = [
+                (len(status["clients"]), status["last_access"], server_id)
+                for server_id, status in self.status.items()
+                if status["writer_waiting"] is None and self.in_rotation(status)
+            ]
+            if not candidates:
+                return None
+            _, _, server_id = min(candidates)
+            self.status[server_id]["writer_waiting"] = client_id
+            self.writer_targets[client_id] = server_id
+            self._record("writer_wait", client_id=client_id, server_id=server_id)
+            return server_id
+
+    def stop_waiting(self, client_id):
+        """Bỏ đánh dấu writer đang chờ (writer đã rời hàng đợi)"""
+        with self.lock:
+            server_id = self.writer_targets.pop(client_id, None)
+            if server_id is None:
+                return
+            self._record("writer_done", client_id=client_id)
+            status = self.status.get(server_id)
+            if status is not None and status["writer_waiting"] == client_id:
+                status["writer_waiting"] = None
+                self._push_free(server_id)
+
+    def set_health(self, server_id, health):
+        """Cập nhật health của server, trả về health cũ
+
+        Writer đang chờ một server vừa down được chuyển sang server khác.
+        """
+        with self.lock:
+            status = self.status[server_id]
+            previous = status["health"]
+            status["health"] = health
+            if previous != health:
+                self._retarget_writer(server_id)
+                self._push_free(server_id)
+            return previous
+
+    def set_breaker(self, server_id, state):
+        """Cập nhật trạng thái circuit breaker của server"""
+        with self.lock:
+            status = self.status.get(server_id)
+            if status is None:
+                return
+            status["breaker"] = state
+            self._retarget_writer(server_id)
+            self._push_free(server_id)
+
+    def set_draining(self, server_id, draining):
+        """Bật/tắt drain cho server, trả về số lease còn lại trên server
+
+        Server đang drain không nhận lease mới; writer đang chờ server này được
+        chuyển sang server khác.
+        """
+        with self.lock:
+            status = self.status[server_id]
+            status["draining"] = draining
+            self._record("drain", server_id=server_id, draining=draining)
+            self._retarget_writer(server_id)
+            self._push_free(server_id)
+            return len(status["clients"])
+
+    def _retarget_writer(self, server_id):
+        """Chuyển writer đang chờ server (đã ra khỏi vòng cấp lease) sang server khác"""
+        status = self.status[server_id]
+        writer = status["writer_waiting"]
+        # Bản ghi của worker gốc đã chứa writer_done/writer_wait tương ứng
+        if writer and not self.in_rotation(status) and not self.replaying:
+            self.stop_waiting(writer)
+            self.wait_for_writer(writer)
+
+    def ready_writers(self):
+        """Các writer đang chờ mà server mục tiêu đã trống"""
+        with self.read_lock:
+            return [
+                client_id for client_id, server_id in self.writer_targets.items()
+                if self.accepts(self.status[server_id], "exclusive", client_id)
+            ]
+
+    def preemption_victim(self, mode, classes, client_id=None):
+        """Lease đang hoạt động cũ nhất thuộc các lớp classes mà lấy lại thì yêu cầu mode có chỗ
+
+        Yêu cầu shared lấy lại trên server đang trong vòng cấp lease và không
+        có writer chờ; yêu cầu exclusive chỉ lấy lại trên server mục tiêu của
+        chính writer đó, khi mọi lease trên server đều thuộc classes. Trả về
+        client_id hoặc None (O(n), chỉ gọi khi có yêu cầu chờ quá hạn).
+        """
+        with self.read_lock:
+            if mode == "exclusive":
+                server_id = self.writer_targets.get(client_id)
+                if server_id is None or not self.in_rotation(self.status[server_id]):
+                    return None
+                held = [(self.client_leases[holder], holder) for holder in self.status[server_id]["clients"]]
+                if not held or any(lease["state"] != "active" or lease["priority"] not in classes
+                                   for lease, _ in held):
+                    return None
+                return min(held, key=lambda item: item[0]["granted_at"])[1]
+
+            victim = None
+            for holder, lease in self.client_leases.items():
+                if lease["state"] != "active" or lease["priority"] not in classes:
+                    continue
+                status = self.status[lease["server_id"]]
+                if not self.in_rotation(status) or status["writer_waiting"] is not None:
+                    continue
+                if victim is None or lease["granted_at"] < self.client_leases[victim]["granted_at"]:
+                    victim = holder
+            return victim
+
+    def reserve(self, server_id, client_id, mode="shared", priority=DEFAULT_PRIORITY):
+        """Giữ chỗ server cho client, False nếu server không nhận hoặc client đã có lease"""
+        with self.lock:
+            status = self.status[server_id]
+            if client_id in self.client_leases or not self.accepts(status, mode, client_id):
+                return False
+            granted_at = time.time()
+            self._record("reserve", client_id=client_id, server_id=server_id,
+                         mode=mode, priority=priority, granted_at=granted_at)
+            self._insert_lease(client_id, server_id, mode, granted_at, "reserved", priority)
+            return True
+
+    def _insert_lease(self, client_id, server_id, mode, granted_at, state, priority=DEFAULT_PRIORITY):
+        """Thêm lease vào bảng (điều kiện đã được kiểm tra hoặc bản ghi từ worker khác)"""
+        status = self.status[server_id]
+        status["clients"].add(client_id)
+        status["exclusive"] = mode == "exclusive"
+        status["last_access"] = max(status["last_access"], granted_at)
+        self.client_leases[client_id] = {
+            "server_id": server_id,
+            "state": state,
+            "mode": mode,
+            "priority": priority,
+            "granted_at": granted_at,
+            "expires_at": None
+        }
+        self.renew(client_id)
+        if status["writer_waiting"] == client_id:
+            status["writer_waiting"] = None
+            self.writer_targets.pop(client_id, None)
+        else:
+            self.stop_waiting(client_id)
+        self._push_free(server_id)
+
+    def commit(self, client_id, server_id):
+        """Xác nhận lease đã giữ chỗ, False nếu lease không còn (đã bị giải phóng)"""
+        with self.lock:
+            lease = self.client_leases.get(client_id)
+            if not lease or lease["server_id"] != server_id or lease["state"] != "reserved":
+                return False
+            lease["state"] = "active"
+            self._record("grant", client_id=client_id, server_id=server_id, mode=lease["mode"],
+                         priority=lease["priority"], granted_at=lease["granted_at"])
+            return True
+
+    def restore(self, client_id, server_id, mode, granted_at, priority=DEFAULT_PRIORITY):
+        """Khôi phục một lease đang hoạt động (từ nhật ký hoặc từ /status của database server)
+
+        Lease được gia hạn đủ một TTL tính từ bây giờ để client kịp gửi
+        heartbeat. Không kiểm tra sức chứa (client đang thực sự được phục vụ),
+        chỉ từ chối khi server không còn hoặc xung đột với lease độc quyền.
+        """
+        with self.lock:
+            status = self.status.get(server_id)
+            if status is None or client_id in self.client_leases:
+                return False
+            if status["exclusive"] or (mode == "exclusive" and status["clients"]):
+                return False
+            self._record("grant", client_id=client_id, server_id=server_id,
+                         mode=mode, priority=priority, granted_at=granted_at)
+            self._insert_lease(client_id, server_id, mode, granted_at, "active", priority)
+            return True
+
+    def durable_state(self):
+        """Trạng thái cần lưu vào snapshot: các server và các lease đang hoạt động"""
+        with self.read_lock:
+            return {
+                "servers": list(self.servers.values()),
+                "leases": {
+                    client_id: {
+                        "server_id": lease["server_id"],
+                        "mode": lease["mode"],
+                        "priority": lease["priority"],
+                        "granted_at": lease["granted_at"]
+                    }
+                    for client_id, lease in self.client_leases.items()
+                    if lease["state"] == "active"
+                }
+            }
+
+    def abort(self, client_id, server_id):
+        """Hủy lease đang giữ chỗ; không đụng tới lease của yêu cầu khác"""
+        with self.lock:
+            lease = self.client_leases.get(client_id)
+            if not lease or lease["server_id"] != server_id or lease["state"] != "reserved":
+                return False
+            self.release(client_id)
+            return True
+
+    def release(self, client_id):
+        """Giải phóng lease của client, trả về lease vừa giải phóng hoặc None"""
+        with self.lock:
+            lease = self.client_leases.pop(client_id, None)
+            if lease is None:
+                return None
+            server_id = lease["server_id"]
+            status = self.status[server_id]
+            status["clients"].discard(client_id)
+            if lease["mode"] == "exclusive":
+                status["exclusive"] = False
+            self._push_free(server_id)
+            self._record("release", client_id=client_id)
+            return lease
+
+    def renew(self, client_id, expires_at=None):
+        """Gia hạn lease của client (heartbeat), trả về thời điểm hết hạn mới
+
+        Trả về None nếu client không giữ lease hoặc lease không có thời hạn.
+        """
+        with self.read_lock:
+            lease = self.client_leases.get(client_id)
+            if lease is None or LEASE_TTL_SECONDS <= 0:
+                return None
+            lease["expires_at"] = expires_at or time.time() + LEASE_TTL_SECONDS
+            self._record("renew", client_id=client_id, expires_at=lease["expires_at"])
+            heapq.heappush(self.expiry_heap, (lease["expires_at"], client_id))
+            return lease["expires_at"]
+
+    def expire(self, now):
+        """Giải phóng các lease đã hết hạn, trả về danh sách (client_id, lease)"""
+        with self.lock:
+            expired = []
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expires_at, client_id = heapq.heappop(self.expiry_heap)
+                lease = self.client_leases.get(client_id)
+                # Bỏ qua phần tử cũ (lease đã được gia hạn hoặc đã giải phóng)
+                if lease and lease["expires_at"] == expires_at:
+                    expired.append((client_id, self.release(client_id)))
+            return expired
+
+    def next_expiry(self):
+        """Thời điểm hết hạn sớm nhất trong heap, None nếu heap rỗng"""
+        with self.read_lock:
+            return self.expiry_heap[0][0] if self.expiry_heap else None
+
+    def token_claims(self, client_id):
+        """Nội dung lease token cho lease đang hoạt động của client, None nếu không có"""
+        with self.read_lock:
+            lease = self.client_leases.get(client_id)
+            if lease is None or lease["state"] != "active":
+                return None
+            return {
+                "client_id": client_id,
+                "server_id": lease["server_id"],
+                "mode": lease["mode"],
+                "granted_at": lease["granted_at"],
+                "exp": lease["expires_at"] or lease["granted_at"] + LEASE_TOKEN_MAX_TTL
+            }
+
+    def active_leases(self):
+        """Danh sách các lease đang hoạt động"""
+        with self.read_lock:
+            return [
+                {
+                    "server_id": lease["server_id"],
+                    "client_id": client_id,
+                    "mode": lease["mode"],
+                    "priority": lease["priority"],
+                    "expires_at": lease["expires_at"]
+                }
+                for client_id, lease in self.client_leases.items()
+            ]
+
+    def snapshot(self):
+        """Bản sao trạng thái các server, an toàn để tuần tự hóa ngoài khóa"""
+        with self.read_lock:
+            return {
+                server_id: {
+                    "busy": not self.accepts(status, "shared"),
+                    "clients": sorted(status["clients"]),
+                    "capacity": status["capacity"],
+                    "mode": ("exclusive" if status["exclusive"]
+                             else "shared" if status["clients"] else None),
+                    "writer_waiting": status["writer_waiting"],
+                    "health": status["health"],
+                    "breaker": status["breaker"],
+                    "draining": status["draining"],
+                    "drained": status["draining"] and not status["clients"],
+                    "deregistered": status["deregistered"],
+                    "last_access": status["last_access"]
+                }
+                for server_id, status in self.status.items()
+            }
+
+class LatencyTracker:
+    """Độ trễ trung bình trượt (EWMA) của từng server, tính bằng giây"""
+
+    def __init__(self, alpha=LATENCY_EWMA_ALPHA):
+        self.alpha = alpha
+        self.ewma = {}
+
+    def record(self, server_id, seconds):
+        previous = self.ewma.get(server_id)
+        if previous is None:
+            self.ewma[server_id] = seconds
+        else:
+            self.ewma[server_id] = self.alpha * seconds + (1 - self.alpha) * previous
+
+    def get(self, server_id):
+        return self.ewma.get(server_id)
+
+class SelectionStrategy:
+    """Giao diện chiến lược chọn database server
+
+    select nhận bảng lease (đang giữ registry.lock), chế độ lease và trả về
+    một server đang nhận lease ở chế độ đó, hoặc None.
+    """
+    name = None
+
+    def select(self, registry, mode):
+        raise NotImplementedError
+
+class OldestAccessStrategy(SelectionStrategy):
+    """Server được cấp lease lâu nhất (heap last_access, O(log n))"""
+    name = "oldest"
+
+    def select(self, registry, mode):
+        return registry.peek_free(mode)
+
+class LeastConnectionsStrategy(SelectionStrategy):
+    """Server có tỉ lệ slot đang dùng thấp nhất"""
+    name = "least_connections"
+
+    def select(self, registry, mode):
+        candidates = registry.candidates(mode)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda server: (
+            registry.load(server["id"]),
+            registry.status[server["id"]]["last_access"]
+        ))
+
+class WeightedRoundRobinStrategy(SelectionStrategy):
+    """Round-robin có trọng số (smooth WRR), trọng số là "weight" hoặc capacity của server"""
+    name = "weighted_round_robin"
+
+    def __init__(self):
+        self.current = {}
+
+    def select(self, registry, mode):
+        candidates = registry.candidates(mode)
+        if not candidates:
+            return None
+        total = 0
+        best = None
+        for server in candidates:
+            weight = server.get("weight", registry.status[server["id"]]["capacity"])
+            total += weight
+            self.current[server["id"]] = self.current.get(server["id"], 0) + weight
+            if best is None or self.current[server["id"]] > self.current[best["id"]]:
+                best = server
+        self.current[best["id"]] -= total
+        return best
+
+class PowerOfTwoChoicesStrategy(SelectionStrategy):
+    """Chọn ngẫu nhiên hai server, lấy server có tải thấp hơn"""
+    name = "power_of_two"
+
+    def select(self, registry, mode):
+        candidates = registry.candidates(mode)
+        if len(candidates) < 2:
+            return candidates[0] if candidates else None
+        first, second = random.sample(candidates, 2)
+        if registry.load(second["id"]) < registry.load(first["id"]):
+            return second
+        return first
+
+class LatencyAwareStrategy(SelectionStrategy):
+    """Server có EWMA độ trễ /notify_access và /data thấp nhất
+
+    Server chưa có số đo được ưu tiên để có dữ liệu; hòa thì chọn server ít tải.
+    """
+    name = "latency"
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def select(self, registry, mode):
+        candidates = registry.candidates(mode)
+        if not candidates:
+            return None
+
+        def score(server):
+            latency = self.tracker.get(server["id"])
+            return (latency is not None, latency or 0, registry.load(server["id"]))
+
+        return min(candidates, key=score)
+
+def create_strategy(name, tracker):
+    """Tạo chiến lược chọn server theo tên cấu hình"""
+    strategies = {
+        OldestAccessStrategy.name: OldestAccessStrategy,
+        LeastConnectionsStrategy.name: LeastConnectionsStrategy,
+        WeightedRoundRobinStrategy.name: WeightedRoundRobinStrategy,
+        PowerOfTwoChoicesStrategy.name: PowerOfTwoChoicesStrategy,
+    }
+    if name == LatencyAwareStrategy.name:
+        return LatencyAwareStrategy(tracker)
+    if name not in strategies:
+        raise ValueError(f"Unknown load balancing strategy: {name}")
+    return strategies[name]()
+
+class HealthChecker:
+    """Lịch kiểm tra sức khỏe các database server
+
+    Mỗi server có thời điểm kiểm tra kế tiếp trong heap (next_check, server_id);
+    phần tử không khớp next_check của server là phần tử cũ và bị bỏ qua.
+    Khoảng cách giữa các lần kiểm tra được làm nhiễu ±20% để các probe không
+    dồn cùng lúc, và tăng theo hàm mũ khi server lỗi liên tiếp.
+
+    Server tự đăng ký có thêm last_seen (heartbeat gần nhất) để phát hiện
+    server đã biến mất mà không kịp hủy đăng ký.
+    """
+
+    def __init__(self, interval=HEALTH_CHECK_INTERVAL):
+        self.interval = interval
+        self.failures = {}
+        self.next_check = {}
+        self.last_seen = {}
+        self.schedule = []
+        self.lock = threading.Lock()
+
+    def _schedule(self, server_id, at):
+        self.next_check[server_id] = at
+        heapq.heappush(self.schedule, (at, server_id))
+
+    def add_server(self, server_id, delay=0, registered=False):
+        with self.lock:
+            self.failures[server_id] = 0
+            self._schedule(server_id, time.time() + delay)
+            if registered:
+                self.last_seen[server_id] = time.time()
+
+    def remove_server(self, server_id):
+        with self.lock:
+            self.failures.pop(server_id, None)
+            self.next_check.pop(server_id, None)
+            self.last_seen.pop(server_id, None)
+
+    def seen(self, server_id):
+        """Ghi nhận heartbeat của server tự đăng ký, False nếu server không có trong lịch"""
+        with self.lock:
+            if server_id not in self.failures:
+                return False
+            self.last_seen[server_id] = time.time()
+            return True
+
+    def stale(self, now, ttl=SERVER_REGISTRATION_TTL):
+        """Các server tự đăng ký đã quá ttl giây không gửi heartbeat"""
+        with self.lock:
+            return [
+                server_id for server_id, seen_at in self.last_seen.items()
+                if now - seen_at > ttl
+            ]
+
+    def due(self, now):
+        """Lấy ra các server đã tới lượt kiểm tra"""
+        with self.lock:
+            servers = []
+            while self.schedule and self.schedule[0][0] <= now:
+                at, server_id = heapq.heappop(self.schedule)
+                if self.next_check.get(server_id) == at:
+                    servers.append(server_id)
+            return servers
+
+    def next_due(self):
+        with self.lock:
+            return self.schedule[0][0] if self.schedule else None
+
+    def report(self, server_id, ok, latency):
+        """Ghi nhận kết quả probe, lên lịch lần kế tiếp và trả về health mới"""
+        with self.lock:
+            if server_id not in self.failures:
+                return None
+            if ok:
+                self.failures[server_id] = 0
+                delay = self.interval
+                health = "degraded" if latency > HEALTH_DEGRADED_LATENCY else "up"
+            else:
+                self.failures[server_id] += 1
+                failures = self.failures[server_id]
+                delay = min(self.interval * 2 ** failures, HEALTH_CHECK_MAX_BACKOFF)
+                health = "down" if failures >= HEALTH_FAILURE_THRESHOLD else "degraded"
+            self._schedule(server_id, time.time() + delay * random.uniform(0.8, 1.2))
+            return health
+
+class CircuitOpenError(Exception):
+    """Circuit breaker của database server đang mở, không gọi tới server"""
+
+class CircuitBreaker:
+    """Circuit breaker của một database server
+
+    - closed: gọi bình thường, ghi kết quả vào cửa sổ BREAKER_WINDOW lần gọi
+    - open: từ chối ngay mọi lời gọi trong BREAKER_OPEN_SECONDS
+    - half_open: cho đúng một lời gọi thử; thành công thì closed, lỗi thì open lại
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.opened_at = 0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Xin phép gọi server, ném CircuitOpenError nếu breaker không cho"""
+        with self.lock:
+            if self.state == "open" or (self.state == "half_open" and self.trial_in_flight):
+                raise CircuitOpenError("Circuit breaker đang mở")
+            if self.state == "half_open":
+                self.trial_in_flight = True
+
+    def after_call(self, ok, latency):
+        """Ghi nhận kết quả lời gọi, trả về trạng thái mới nếu breaker đổi trạng thái"""
+        failed = not ok or latency > BREAKER_SLOW_CALL
+        with self.lock:
+            if self.state == "half_open":
+                self.trial_in_flight = False
+                return self._open() if failed else self._close()
+            self.outcomes.append(failed)
+            if (self.state == "closed" and len(self.outcomes) >= BREAKER_MIN_CALLS
+                    and sum(self.outcomes) / len(self.outcomes) >= BREAKER_ERROR_RATE):
+                return self._open()
+            return None
+
+    def tick(self, now):
+        """Chuyển open -> half_open khi hết BREAKER_OPEN_SECONDS, trả về trạng thái mới nếu đổi"""
+        with self.lock:
+            if self.state == "open" and now - self.opened_at >= BREAKER_OPEN_SECONDS:
+                self.state = "half_open"
+                self.trial_in_flight = False
+                return self.state
+            return None
 
-# Lưu trữ socket connections
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.time()
+        return self.state
+
+    def _close(self):
+        self.state = "closed"
+        self.outcomes.clear()
+        return self.state
+
+class DatabaseServerClient:
+    """HTTP client dùng chung cho mọi lời gọi coordinator -> database server
+
+    - session: requests.Session với pool kết nối keep-alive cho từng server
+    - limits: server_id -> semaphore giới hạn số request đồng thời tới server,
+      để một server chậm không giữ hết worker của coordinator
+    - breakers: server_id -> CircuitBreaker; thay đổi trạng thái được báo qua
+      breaker_changed()
+
+    Các lời gọi chạy trong greenlet (eventlet) hoặc thread của
+    socketio.start_background_task, không chặn event loop.
+    """
+
+    def __init__(self, max_per_server=DB_SERVER_MAX_CONCURRENCY):
+        self.max_per_server = max_per_server
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=max_per_server)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.limits = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, server_id):
+        with self.lock:
+            breaker = self.breakers.get(server_id)
+            if breaker is None:
+                breaker = self.breakers[server_id] = CircuitBreaker()
+            return breaker
+
+    def tick_breakers(self, now):
+        """Chuyển các breaker đã mở đủ lâu sang half_open"""
+        with self.lock:
+            breakers = list(self.breakers.items())
+        for server_id, breaker in breakers:
+            state = breaker.tick(now)
+            if state:
+                breaker_changed(server_id, state)
+
+    def _limit(self, server_id):
+        with self.lock:
+            limit = self.limits.get(server_id)
+            if limit is None:
+                limit = self.limits[server_id] = threading.BoundedSemaphore(self.max_per_server)
+            return limit
+
+    def request(self, method, server, path, timeout, limited=True, guarded=True, **kwargs):
+        """Gọi database server qua pool kết nối, trong giới hạn đồng thời của server
+
+        Lời gọi guarded đi qua circuit breaker của server: ném CircuitOpenError
+        ngay khi breaker mở. Ném Exception nếu không lấy được lượt gọi trong
+        DB_SERVER_SLOT_TIMEOUT. Health probe (limited=False) bỏ qua cả hai.
+        """
+        if not limited:
+            return self.session.request(
+                method, f"{server['url']}{path}",
+                timeout=(DB_CONNECT_TIMEOUT, timeout), **kwargs
+            )
+
+        breaker = self.breaker(server["id"])
+        if guarded:
+            breaker.before_call()
+        limit = self._limit(server["id"])
+        if not limit.acquire(timeout=DB_SERVER_SLOT_TIMEOUT):
+            state = breaker.after_call(False, 0) if guarded else None
+            if state:
+                breaker_changed(server["id"], state)
+            raise Exception(f"{server['name']} đang có quá nhiều yêu cầu đồng thời")
+
+        started = time.time()
+        ok = False
+        try:
+            response = self.session.request(
+                method, f"{server['url']}{path}",
+                timeout=(DB_CONNECT_TIMEOUT, timeout), **kwargs
+            )
+            ok = response.status_code < 500
+            return response
+        finally:
+            limit.release()
+            state = breaker.after_call(ok, time.time() - started) if guarded else None
+            if state:
+                breaker_changed(server["id"], state)
+
+    def post(self, server, path, payload, timeout, guarded=True):
+        return self.request("POST", server, path, timeout, guarded=guarded, json=payload)
+
+    def post_in_background(self, server, path, payload, timeout, retries=RELEASE_RETRIES):
+        """Gửi POST chạy nền (fire-and-forget), thử lại khi lỗi kết nối hoặc lỗi 5xx
+
+        Không đi qua circuit breaker: thông báo giải phóng vẫn phải tới được
+        server đang bị breaker chặn cấp lease mới.
+        """
+        socketio.start_background_task(self._post_with_retry, server, path, payload, timeout, retries)
+
+    def _post_with_retry(self, server, path, payload, timeout, retries):
+        for attempt in range(retries + 1):
+            try:
+                response = self.post(server, path, payload, timeout, guarded=False)
+                if response.status_code < 500:
+                    return response
+                error = f"HTTP {response.status_code}"
+            except Exception as e:
+                error = str(e)
+            if attempt < retries:
+                socketio.sleep(RELEASE_RETRY_BACKOFF * 2 ** attempt)
+        print(f"Lỗi khi gọi {path} trên {server['name']} sau {retries + 1} lần: {error}")
+        return None
+
+class FairShareQueue:
+    """Hàng đợi các client chờ server, chia theo lớp ưu tiên
+
+    Mỗi lớp là một hàng FIFO (client_id -> yêu cầu). Giữa các lớp dùng
+    weighted fair queueing kiểu stride scheduling: mỗi lần một client của
+    lớp c được trao slot, pass của lớp tăng 1/weight, lớp có pass nhỏ nhất
+    (hòa thì trọng số lớn hơn) được phục vụ trước. Khi các lớp cùng chờ, lớp
+    trọng số w nhận khoảng w/tổng trọng số số slot được trao; lớp vừa có
+    client chờ trở lại bắt đầu từ virtual_time nên không dồn lượt lúc rảnh.
+
+    Duyệt hàng đợi cho ra client_id theo đúng thứ tự sẽ được phục vụ (lười,
+    O(log số lớp) mỗi phần tử); ngoài ra dùng như một dict: len, in, get, pop.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.queues = {name: OrderedDict() for name in weights}
+        self.passes = dict.fromkeys(weights, 0.0)
+        self.virtual_time = 0.0
+        self.priority_of = {}
+
+    def __len__(self):
+        return len(self.priority_of)
+
+    def __contains__(self, client_id):
+        return client_id in self.priority_of
+
+    def __setitem__(self, client_id, entry):
+        priority = entry["priority"]
+        queue = self.queues[priority]
+        if not queue:
+            self.passes[priority] = max(self.passes[priority], self.virtual_time)
+        queue[client_id] = entry
+        self.priority_of[client_id] = priority
+
+    def get(self, client_id, default=None):
+        priority = self.priority_of.get(client_id)
+        if priority is None:
+            return default
+        return self.queues[priority][client_id]
+
+    def pop(self, client_id, default=None):
+        """Rút client khỏi hàng đợi mà không tính lượt cho lớp của nó"""
+        priority = self.priority_of.pop(client_id, None)
+        if priority is None:
+            return default
+        return self.queues[priority].pop(client_id)
+
+    def serve(self, client_id):
+        """Rút client vừa được trao slot và tính lượt cho lớp của nó"""
+        entry = self.pop(client_id)
+        priority = entry["priority"]
+        self.virtual_time = self.passes[priority]
+        self.passes[priority] += 1 / self.weights[priority]
+        return entry
+
+    def depths(self):
+        """Số client đang chờ của từng lớp"""
+        return {name: len(queue) for name, queue in self.queues.items()}
+
+    def __iter__(self):
+        # Không được thêm/rút client trong lúc đang duyệt
+        heap = [
+            (self.passes[name], -self.weights[name], rank, name, iter(queue))
+            for rank, (name, queue) in enumerate(self.queues.items()) if queue
+        ]
+        heapq.heapify(heap)
+        while heap:
+            passed, order, rank, name, clients = heapq.heappop(heap)
+            client_id = next(clients, None)
+            if client_id is None:
+                continue
+            yield client_id
+            heapq.heappush(heap, (passed + 1 / self.weights[name], order, rank, name, clients))
+
+    def values(self):
+        for client_id in self:
+            yield self.get(client_id)
+
+class PriorityStats:
+    """Độ trễ cấp lease theo lớp ưu tiên, để kiểm tra SLO của từng lớp
+
+    Độ trễ tính từ lúc nhận yêu cầu (hoặc vào hàng đợi) tới lúc được cấp;
+    giữ PRIORITY_LATENCY_WINDOW giá trị gần nhất của mỗi lớp cùng số lease
+    đã cấp và số lease bị lấy lại cho lớp cao hơn. Số liệu riêng của từng
+    worker.
+    """
+
+    def __init__(self, classes, window=PRIORITY_LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.samples = {name: deque(maxlen=window) for name in classes}
+        self.granted = dict.fromkeys(classes, 0)
+        self.preempted = dict.fromkeys(classes, 0)
+
+    def record(self, priority, seconds):
+        with self.lock:
+            self.samples[priority].append(seconds)
+            self.granted[priority] += 1
+
+    def record_preempted(self, priority):
+        with self.lock:
+            if priority in self.preempted:
+                self.preempted[priority] += 1
+
+    def snapshot(self):
+        """Số lần cấp/lấy lại và các phân vị độ trễ (giây) của mỗi lớp"""
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            granted, preempted = dict(self.granted), dict(self.preempted)
+
+        def percentile(values, q):
+            return round(values[min(len(values) - 1, int(q * len(values)))], 4) if values else None
+
+        return {
+            name: {
+                "granted": granted[name],
+                "preempted": preempted[name],
+                "wait_p50": percentile(values, 0.5),
+                "wait_p95": percentile(values, 0.95),
+                "wait_p99": percentile(values, 0.99),
+                "wait_max": round(values[-1], 4) if values else None
+            }
+            for name, values in samples.items()
+        }
+
+# Phòng Socket.IO: dashboard nhận thông báo và trạng thái tổng hợp, client
+# chỉ nhận sự kiện gửi riêng cho client_room(client_id) của mình (tới được
+# socket ở worker khác qua message queue), server_room(id) nhận trạng thái
+# của một server
+DASHBOARD_ROOM = "dashboards"
+CLIENT_ROOM = "clients"
+
+def server_room(server_id):
+    return f"server:{server_id}"
+
+def client_room(client_id):
+    return f"client:{client_id}"
+
+class StatusBroadcaster:
+    """Phát trạng thái server cho dashboard/client dạng delta có version
+
+    publish() chỉ đánh dấu trạng thái đã đổi; mọi thay đổi trong cửa sổ
+    window giây được gộp thành một sự kiện server_status_delta chứa các
+    server khác với bản đã phát trước đó (mỗi server gửi nguyên trạng thái,
+    nên áp dụng lại một delta không gây sai). version tăng đơn điệu theo
+    từng delta; client thấy version nhảy cóc thì gửi status_resync để nhận
+    lại snapshot.
+
+    - published: server_id -> {"server", "status"} đã phát ở version hiện tại
+    - history: STATUS_HISTORY_SIZE delta gần nhất, để client poll chỉ lấy phần
+      thay đổi từ version nó đang có
+    """
+
+    def __init__(self, window=STATUS_COALESCE_SECONDS):
+        self.window = window
+        self.version = 0
+        self.published = {}
+        self.history = deque(maxlen=STATUS_HISTORY_SIZE)
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def publish(self):
+        """Báo trạng thái đã đổi, phát delta sau cửa sổ gộp"""
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+        if self.window > 0:
+            socketio.start_background_task(self._flush_later)
+        else:
+            self.flush()
+
+    def _flush_later(self):
+        socketio.sleep(self.window)
+        self.flush()
+
+    def flush(self):
+        """Phát delta giữa trạng thái hiện tại và bản đã phát, trả về delta hoặc None"""
+        with self.lock:
+            self.pending = False
+            payload = status_payload()
+            current = {
+                server["id"]: {"server": server, "status": payload["status"][server["id"]]}
+                for server in payload["servers"]
+            }
+            changed = {
+                server_id: entry for server_id, entry in current.items()
+                if self.published.get(server_id) != entry
+            }
+            removed = [server_id for server_id in self.published if server_id not in current]
+            if not changed and not removed:
+                return None
+            self.version += 1
+            self.published = current
+            delta = {"version": self.version, "changed": changed, "removed": removed}
+            self.history.append(delta)
+            # Phát trong khóa để các delta tới client đúng thứ tự version.
+            # Dashboard nhận delta tổng hợp, người theo dõi một server chỉ
+            # nhận trạng thái của server đó. Khi chạy nhiều worker, mỗi worker
+            # tự phát cho socket của mình (ignore_queue) vì version là riêng
+            # của từng worker
+            socketio.emit('server_status_delta', delta, room=DASHBOARD_ROOM, ignore_queue=True)
+            for server_id, entry in changed.items():
+                socketio.emit('server_status', dict(entry, version=self.version, server_id=server_id),
+                              room=server_room(server_id), ignore_queue=True)
+            for server_id in removed:
+                socketio.emit('server_status', {
+                    "version": self.version, "server_id": server_id, "removed": True
+                }, room=server_room(server_id), ignore_queue=True)
+            return delta
+
+    def current_version(self):
+        """Version của trạng thái hiện tại, phát ngay các thay đổi đang chờ gộp"""
+        if self.pending:
+            self.flush()
+        return self.version
+
+    def changes_since(self, version):
+        """Gộp các delta sau version thành một delta, None nếu lịch sử không còn đủ"""
+        with self.lock:
+            if version == self.version:
+                return {"version": self.version, "changed": {}, "removed": []}
+            if not self.history or version < self.history[0]["version"] - 1 or version > self.version:
+                return None
+            changed = {}
+            removed = set()
+            for delta in self.history:
+                if delta["version"] <= version:
+                    continue
+                for server_id in delta["removed"]:
+                    changed.pop(server_id, None)
+                    removed.add(server_id)
+                for server_id, entry in delta["changed"].items():
+                    changed[server_id] = entry
+                    removed.discard(server_id)
+            return {"version": self.version, "changed": changed, "removed": sorted(removed)}
+
+    def snapshot(self):
+        """Trạng thái đã phát ở version hiện tại, cho client mới kết nối hoặc resync"""
+        with self.lock:
+            return {
+                "version": self.version,
+                "servers": [entry["server"] for entry in self.published.values()],
+                "status": {server_id: entry["status"] for server_id, entry in self.published.items()}
+            }
+
+class LeaseJournal:
+    """Nhật ký bền vững của bảng lease: WAL dạng JSON lines + snapshot nén
+
+    record() chỉ đưa bản ghi vào bộ đệm (gọi trong leases.lock nên đúng thứ
+    tự); flush() ghi bộ đệm ra <path>.wal và fsync một lần cho cả lô. Khi WAL
+    đủ dài, compact() ghi toàn bộ trạng thái ra <path>.snapshot.json (ghi file
+    tạm, fsync, rename) rồi xóa WAL. Mỗi bản ghi có seq tăng dần và snapshot
+    lưu seq cuối cùng nó chứa, nên nếu dừng giữa lúc nén thì các bản ghi cũ
+    còn sót trong WAL bị bỏ qua khi phát lại.
+
+    Chỉ giữ các bản ghi trong DURABLE_OPS; gia hạn (heartbeat), giữ chỗ và
+    writer đang chờ không được ghi, lease khôi phục được cấp lại một TTL đầy đủ.
+    """
+
+    DURABLE_OPS = ("server", "server_removed", "grant", "release")
+
+    def __init__(self, path):
+        self.wal_path = f"{path}.wal"
+        self.snapshot_path = f"{path}.snapshot.json"
+        self.seq = 0
+        self.buffer = []
+        self.records_since_snapshot = 0
+        self.wal = None
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+
+    def record(self, op, **fields):
+        if op not in self.DURABLE_OPS:
+            return
+        with self.lock:
+            self.seq += 1
+            fields["op"] = op
+            fields["seq"] = self.seq
+            self.buffer.append(fields)
+
+    def load(self):
+        """Đọc snapshot rồi phát lại WAL, trả về {"servers", "leases"}"""
+        state = {"servers": {}, "leases": {}}
+        last_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            last_seq = snapshot["seq"]
+            state["servers"] = {server["id"]: server for server in snapshot["servers"]}
+            state["leases"] = snapshot["leases"]
+
+        replayed = 0
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Dòng cuối ghi dở khi coordinator dừng đột ngột
+                        break
+                    if entry["seq"] <= last_seq:
+                        continue
+                    last_seq = entry["seq"]
+                    replayed += 1
+                    self._apply(state, entry)
+
+        self.seq = last_seq
+        self.records_since_snapshot = replayed
+        return state
+
+    @staticmethod
+    def _apply(state, entry):
+        op = entry["op"]
+        if op == "server":
+            state["servers"][entry["server"]["id"]] = entry["server"]
+        elif op == "server_removed":
+            state["servers"].pop(entry["server_id"], None)
+        elif op == "grant":
+            state["leases"][entry["client_id"]] = {
+                "server_id": entry["server_id"],
+                "mode": entry["mode"],
+                "priority": entry.get("priority", DEFAULT_PRIORITY),
+                "granted_at": entry["granted_at"]
+            }
+        elif op == "release":
+            state["leases"].pop(entry["client_id"], None)
+
+    def flush(self):
+        """Ghi các bản ghi đang đệm ra WAL, một lần fsync cho cả lô"""
+        with self.io_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+            if not batch:
+                return 0
+            if self.wal is None:
+                self.wal = open(self.wal_path, "a")
+            self.wal.write("".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in batch))
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            self.records_since_snapshot += len(batch)
+            return len(batch)
+
+    def compact(self, registry):
+        """Ghi snapshot trạng thái hiện tại và bắt đầu WAL mới"""
+        with self.io_lock:
+            with registry.lock:
+                state = registry.durable_state()
+                with self.lock:
+                    # Bản ghi đang đệm đã nằm trong state
+                    self.buffer = []
+                    state["seq"] = self.seq
+
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            if self.wal is not None:
+                self.wal.close()
+            self.wal = open(self.wal_path, "w")
+            self.records_since_snapshot = 0
+
+class SharedLeaseStore:
+    """Bảng lease dùng chung giữa các worker coordinator, lưu trong SQLite (WAL)
+
+    Mỗi worker giữ bản sao LeaseRegistry trong bộ nhớ; mọi thay đổi được ghi
+    vào bảng lease_log thành bản ghi cùng dạng với LeaseJournal. attach() thay
+    khóa của registry bằng store: lần giữ khóa ngoài cùng mở transaction
+    BEGIN IMMEDIATE (khóa ghi SQLite, loại trừ giữa các tiến trình), áp dụng
+    các bản ghi worker khác đã ghi, và khi nhả khóa thì ghi các bản ghi mới rồi
+    COMMIT. Nhờ vậy kiểm tra + giữ chỗ slot là nguyên tử giữa mọi worker và các
+    bản sao áp dụng cùng một chuỗi thay đổi.
+
+    Thao tác chỉ đọc giữ reader (registry.read_lock): chỉ áp dụng bản ghi mới
+    trong transaction đọc, không lấy khóa ghi SQLite. Gia hạn lease (heartbeat)
+    ngoài transaction ghi được gộp theo client trong renewals và ghi theo lô
+    ở transaction ghi kế tiếp của worker hoặc bởi flush_renewals().
+
+    compact() lưu toàn bộ bảng vào lease_snapshot và xóa các bản ghi cũ hơn;
+    worker khởi động (hoặc tụt lại quá xa) nạp snapshot rồi áp dụng phần còn
+    lại. Bản ghi của worker khác được đưa vào events để vòng nền xử lý phần
+    ngoài bảng lease (lịch health check, hàng đợi, phát trạng thái).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.registry = None
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.buffer = []
+        self.renewals = {}
+        self.events = []
+        self.depth = 0
+        self.mutex = threading.RLock()
+        self.reader = SharedLeaseReader(self)
+
+    def attach(self, registry):
+        """Nạp trạng thái chung vào registry và dùng store làm khóa + journal của registry"""
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lease_log "
+                        "(seq INTEGER PRIMARY KEY AUTOINCREMENT, entry TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lease_snapshot "
+                        "(id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL, state TEXT NOT NULL)")
+        self.registry = registry
+        self.sync()
+        # Bản ghi lúc nạp là trạng thái sẵn có, không phải thay đổi mới
+        self.events = []
+        registry.journal = self
+        registry.lock = self
+        registry.read_lock = self.reader
+
+    def record(self, op, **fields):
+        fields["op"] = op
+        if op == "renew" and not self.depth:
+            # Gia hạn dưới khóa đọc: chỉ giữ lần gia hạn mới nhất của mỗi client
+            self.renewals[fields["client_id"]] = fields
+            return
+        if op == "release":
+            # Lease đã giải phóng thì không cần ghi các lần gia hạn còn gộp
+            self.renewals.pop(fields["client_id"], None)
+        self.buffer.append(fields)
+
+    def __enter__(self):
+        self.mutex.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                self._catch_up()
+            except Exception:
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
+                self.depth -= 1
+                self.mutex.release()
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if self.depth == 1:
+                # Các lần gia hạn đang gộp đều xảy ra trước transaction này
+                entries = list(self.renewals.values()) + self.buffer
+                if entries:
+                    self.db.executemany("INSERT INTO lease_log (entry) VALUES (?)", [
+                        (json.dumps(entry, separators=(",", ":")),) for entry in entries
+                    ])
+                    self.buffer = []
+                    self.renewals = {}
+                    self.seq = self.db.execute("SELECT last_insert_rowid()").fetchone()[0]
+                self.db.execute("COMMIT")
+        finally:
+            self.depth -= 1
+            self.mutex.release()
+
+    def _catch_up(self):
+        """Áp dụng các bản ghi worker khác đã ghi sau self.seq (gọi trong transaction)"""
+        rows = self.db.execute("SELECT seq, entry FROM lease_log WHERE seq > ? ORDER BY seq",
+                               (self.seq,)).fetchall()
+        if rows and rows[0][0] != self.seq + 1:
+            # Các bản ghi cần đã bị nén vào snapshot
+            row = self.db.execute("SELECT seq, state FROM lease_snapshot WHERE id = 0").fetchone()
+            if row is not None and row[0] > self.seq:
+                self.registry.load_state(json.loads(row[1]))
+                self.seq = self.snapshot_seq = row[0]
+                rows = [(seq, entry) for seq, entry in rows if seq > self.seq]
+        for seq, entry in rows:
+            entry = json.loads(entry)
+            self.registry.apply(entry)
+            self.events.append(entry)
+            self.seq = seq
+
+    def sync(self):
+        """Áp dụng các bản ghi mới của worker khác mà không giữ khóa ghi"""
+        with self.mutex:
+            if self.depth:
+                return
+            # depth > 0 để registry (đang áp dụng bản ghi) không mở transaction ghi
+            self.depth += 1
+            try:
+                self.db.execute("BEGIN")
+                try:
+                    self._catch_up()
+                finally:
+                    self.db.execute("COMMIT")
+            finally:
+                self.depth -= 1
+
+    def flush_renewals(self):
+        """Ghi các lần gia hạn đang gộp vào lease_log trong một transaction"""
+        with self.mutex:
+            if self.renewals and not self.depth:
+                # __exit__ ghi self.renewals cùng buffer (đang rỗng)
+                with self:
+                    pass
+
+    def take_events(self):
+        with self.mutex:
+            events, self.events = self.events, []
+            return events
+
+    def compact(self):
+        """Lưu toàn bộ bảng lease vào snapshot và xóa các bản ghi đã nằm trong snapshot"""
+        with self:
+            row = self.db.execute("SELECT seq FROM lease_snapshot WHERE id = 0").fetchone()
+            if row is not None and self.seq - row[0] < SHARED_COMPACT_RECORDS:
+                # Worker khác vừa nén
+                self.snapshot_seq = row[0]
+                return
+            state = json.dumps(self.registry.export_state(), separators=(",", ":"))
+            self.db.execute("INSERT OR REPLACE INTO lease_snapshot (id, seq, state) VALUES (0, ?, ?)",
+                            (self.seq, state))
+            # Giữ lại bản ghi cuối để worker tụt lại phát hiện được khoảng trống
+            self.db.execute("DELETE FROM lease_log WHERE seq < ?", (self.seq,))
+            self.snapshot_seq = self.seq
+
+class SharedLeaseReader:
+    """Khóa đọc của SharedLeaseStore (registry.read_lock)
+
+    Lần giữ ngoài cùng chỉ gọi store.sync() để áp dụng bản ghi mới của worker
+    khác, không mở BEGIN IMMEDIATE nên các worker đọc trạng thái và gia hạn
+    lease song song, không xếp hàng sau khóa ghi. Trong transaction ghi của
+    store (depth > 0) thì chỉ giữ mutex.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.depth = 0
+
+    def __enter__(self):
+        self.store.mutex.acquire()
+        if self.depth == 0:
+            try:
+                self.store.sync()
+            except Exception:
+                self.store.mutex.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        self.store.mutex.release()
+
+class SqliteMessageQueue(PubSubManager):
+    """Message queue Socket.IO giữa các worker trên cùng máy, lưu trong SQLite
+
+    Thay cho Redis/Kafka khi chạy nhiều worker trên một máy: _publish chèn
+    message vào bảng socketio_messages, luồng nghe của mỗi worker đọc message
+    mới sau mỗi SOCKETIO_QUEUE_POLL giây. Chỉ giữ SOCKETIO_QUEUE_KEEP message
+    gần nhất. Dùng file riêng với bảng lease để phát sự kiện khi đang giữ khóa
+    ghi của SharedLeaseStore không bị chặn.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.db = None
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("CREATE TABLE IF NOT EXISTS socketio_messages "
+                   "(id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL)")
+        return db
+
+    def _publish(self, data):
+        with self.lock:
+            if self.db is None:
+                self.db = self._connect()
+            self.db.execute("INSERT INTO socketio_messages (message) VALUES (?)", (json.dumps(data),))
+            self.published += 1
+            if self.published % 1000 == 0:
+                self.db.execute("DELETE FROM socketio_messages WHERE id < last_insert_rowid() - ?",
+                                (SOCKETIO_QUEUE_KEEP,))
+
+    def _listen(self):
+        db = self._connect()
+        last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_messages").fetchone()[0]
+        while True:
+            rows = db.execute("SELECT id, message FROM socketio_messages WHERE id > ? ORDER BY id",
+                              (last_id,)).fetchall()
+            for message_id, message in rows:
+                last_id = message_id
+                yield message
+            if not rows:
+                self.server.sleep(SOCKETIO_QUEUE_POLL)
+
+def socketio_queue_options():
+    """Tham số message queue cho Socket.IO: chỉ cần khi chạy nhiều worker"""
+    if SOCKETIO_MESSAGE_QUEUE:
+        return {"message_queue": SOCKETIO_MESSAGE_QUEUE}
+    if COORDINATOR_WORKERS > 1:
+        return {"client_manager": SqliteMessageQueue(f"{COORDINATOR_STATE}.events.db")}
+    return {}
+
+# Bảng lease của các database servers
+leases = LeaseRegistry()
+
+# Lịch kiểm tra sức khỏe các database servers
+health_checker = HealthChecker()
+
+# HTTP client dùng chung tới các database servers
+db_client = DatabaseServerClient()
+
+# Phát trạng thái server dạng delta
+status_broadcaster = StatusBroadcaster()
+
+# Nhật ký bền vững của bảng lease khi chạy một tiến trình; nhiều worker thì
+# bảng lease dùng chung (đã bền vững) qua SharedLeaseStore
+shared_store = SharedLeaseStore(f"{COORDINATOR_STATE}.db") if COORDINATOR_WORKERS > 1 else None
+lease_journal = LeaseJournal(LEASE_JOURNAL) if LEASE_JOURNAL and not shared_store else None
+
+# Chỉ số của worker hiện tại (0 khi chạy một tiến trình)
+worker_index = 0
+
+socketio.init_app(app, **socketio_queue_options())
+
+# Độ trễ quan sát được và chiến lược chọn server
+server_latency = LatencyTracker()
+selection_strategy = create_strategy(LB_STRATEGY, server_latency)
+
+# Lưu trữ socket connections: client_id -> sid và sid -> client_id
 socket_connections = {}
+socket_clients = {}
+
+# Hàng đợi các client đang chờ server rảnh: FIFO trong mỗi lớp ưu tiên,
+# chia slot giữa các lớp theo trọng số
+wait_queue = FairShareQueue(PRIORITY_CLASSES)
+
+# Độ trễ cấp lease của từng lớp ưu tiên
+priority_stats = PriorityStats(PRIORITY_CLASSES)
+
+# Thời gian chờ tối đa (giây) cho một yêu cầu long-poll
+MAX_WAIT_SECONDS = 60
+
+# Số client tối đa trong một yêu cầu cấp/giải phóng theo lô
+BATCH_MAX_CLIENTS = 500
+
+# Khoảng ngủ tối đa (giây) của vòng thu hồi lease hết hạn
+EXPIRY_MAX_SLEEP = 1.0
 
 @app.route('/')
 def serve_dashboard():
@@ -30,10 +1802,28 @@ def serve_dashboard():
 def handle_connect():
     """Xử lý khi client kết nối websocket"""
     print(f"Client connected: {request.sid}")
-    emit('server_status_update', {
-        'servers': database_servers,
-        'status': server_status
-    })
+
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    """Đăng ký nhận sự kiện: {"role": "dashboard"} và/hoặc {"server_id": id}"""
+    data = data or {}
+    if data.get('role') == 'dashboard':
+        join_room(DASHBOARD_ROOM)
+        emit('server_status_update', status_broadcaster.snapshot())
+    if data.get('server_id') is not None:
+        join_room(server_room(data['server_id']))
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data=None):
+    """Hủy đăng ký theo dõi một server"""
+    data = data or {}
+    if data.get('server_id') is not None:
+        leave_room(server_room(data['server_id']))
+
+@socketio.on('status_resync')
+def handle_status_resync(data=None):
+    """Client phát hiện version nhảy cóc: gửi lại snapshot trạng thái"""
+    emit('server_status_snapshot', status_broadcaster.snapshot())
 
 # @socketio.on('register')
 # def handle_register(data):
@@ -51,144 +1841,188 @@ def handle_connect():
 def handle_register(data):
     client_id = data.get('client_id')
     if client_id:
+        # Bỏ chỉ mục của socket cũ nếu client đăng ký lại
+        old_sid = socket_connections.get(client_id)
+        if old_sid and old_sid != request.sid:
+            socket_clients.pop(old_sid, None)
         socket_connections[client_id] = request.sid
+        socket_clients[request.sid] = client_id
+        join_room(CLIENT_ROOM)
+        join_room(client_room(client_id))
         print(f"Client {client_id} registered with socket {request.sid}")
         emit('registered', {
             'status': 'success', 
             'message': f'Đăng ký kết nối WebSocket thành công cho client {client_id}.'
         })
-        # Phát thông báo tới tất cả client (bao gồm dashboard)
+        # Phát thông báo tới các dashboard
         socketio.emit('notification', {
             'message': f'Client {client_id} đã đăng ký kết nối.',
             'type': 'info'
-        })
+        }, room=DASHBOARD_ROOM)
 
 
+@socketio.on('heartbeat')
+def handle_heartbeat(data=None):
+    """Gia hạn lease qua WebSocket"""
+    data = data or {}
+    client_id = data.get('client_id') or socket_clients.get(request.sid)
+    record_data_latency(client_id, data.get('data_latency'))
+    expires_at = leases.renew(client_id) if client_id else None
+    if expires_at is None and leases.server_of(client_id) is None:
+        emit('lease_expired', {
+            'client_id': client_id,
+            'message': f'Client {client_id} không còn giữ lease nào.'
+        })
+        return
+    emit('heartbeat_ack', {
+        'client_id': client_id,
+        'expires_at': expires_at,
+        'lease_ttl': LEASE_TTL_SECONDS,
+        'lease_token': issue_lease_token(client_id)
+    })
+
 @socketio.on('disconnect')
 def handle_disconnect():
     """Xử lý khi client ngắt kết nối"""
-    # Tìm và xóa client_id khỏi socket_connections
-    for client_id, sid in list(socket_connections.items()):
-        if sid == request.sid:
-            # Tự động giải phóng server nếu client disconnect
-            for server_id, status in server_status.items(): 
-                if status["current_client"] == client_id:
-                    server_status[server_id]["busy"] = False
-                    server_status[server_id]["current_client"] = None
-                    print(f"Client {client_id} ngắt kết nối, tự động giải phóng server {server_id}")
-                    
-                    # Thông báo cho database server nếu cần
-                    try:
-                        server = next((s for s in database_servers if s["id"] == server_id), None)
-                        if server:
-                            requests.post(
-                                f"{server['url']}/release",
-                                json={"client_id": client_id},
-                                timeout=10
-                            )
-                    except Exception as e:
-                        print(f"Lỗi khi giải phóng server: {str(e)}")
-            
-            del socket_connections[client_id]
-            print(f"Client {client_id} disconnected")
-            
-            # Thông báo cập nhật trạng thái server cho tất cả client
-            socketio.emit('server_status_change', {
-                'servers': database_servers,
-                'status': server_status
-            })
-            break
+    client_id = socket_clients.pop(request.sid, None)
+    if client_id is None:
+        return
+    if socket_connections.get(client_id) == request.sid:
+        del socket_connections[client_id]
+
+    # Client đang chờ trong hàng đợi thì rút khỏi hàng đợi
+    leave_queue(client_id, "Client đã ngắt kết nối")
+
+    # Tự động giải phóng server nếu client disconnect
+    lease = leases.release(client_id)
+    if lease is not None:
+        server_id = lease["server_id"]
+        print(f"Client {client_id} ngắt kết nối, tự động giải phóng server {server_id}")
+        
+        # Thông báo cho database server để thu hồi lease token
+        release_database_server(leases.servers[server_id], client_id, lease)
+    
+    print(f"Client {client_id} disconnected")
+    
+    # Thông báo cập nhật trạng thái server cho tất cả client
+    status_broadcaster.publish()
+
+    # Trao server vừa được giải phóng cho client đang chờ
+    dispatch_queue()
 
 @app.route('/request_access', methods=['POST'])
 def request_access():
-    """Endpoint cho client yêu cầu quyền truy cập database"""
+    """Endpoint cho client yêu cầu quyền truy cập database
+
+    Tham số tùy chọn:
+    - mode: "shared" (mặc định, chỉ đọc, dùng chung server) hoặc "exclusive"
+    - wait: số giây tối đa chờ server rảnh (long-poll)
+    - queue: true để giữ chỗ trong hàng đợi; khi có server rảnh, coordinator
+      gán server và gửi sự kiện 'server_assigned' qua WebSocket
+    - priority: lớp ưu tiên (PRIORITY_CLASSES, mặc định DEFAULT_PRIORITY)
+    """
+    received_at = time.time()
     data = request.json
     client_id = data.get('client_id')
     
     if not client_id:
         return jsonify({"error": "Client ID is required"}), 400
+
+    try:
+        wait = min(float(data.get('wait', 0) or 0), MAX_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+    stay_queued = bool(data.get('queue', False))
+
+    mode = data.get('mode', 'shared')
+    if mode not in LEASE_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(LEASE_MODES)}"}), 400
+
+    priority = data.get('priority', DEFAULT_PRIORITY)
+    if priority not in PRIORITY_CLASSES:
+        return jsonify({"error": f"priority must be one of {', '.join(PRIORITY_CLASSES)}"}), 400
     
-    # Kiểm tra xem client này đã đang kết nối tới server nào chưa
-    for server_id, status in server_status.items():
-        if status.get("current_client") == client_id:
-            # Client đã kết nối tới một server
-            server = next((s for s in database_servers if s["id"] == int(server_id)), None)
-            if server:
-                return jsonify({
-                    "error": "Client already connected", 
-                    "message": f"Client {client_id} đã đang truy cập {server['name']}",
-                    "server_id": server["id"],
-                    "server_name": server["name"],
-                    "server_url": server["url"]
-                }), 409  # Conflict status code
-    
-    # Kiểm tra xem tất cả server có đang bận không TRƯỚC KHI thử chọn server
-    busy_servers = 0
-    for status in server_status.values():
-        if status.get("busy", False):
-            busy_servers += 1
-    
-    if busy_servers >= len(database_servers):
-        # Thu thập thông tin các client đang kết nối để hiển thị
-        connected_clients = []
-        for srv_id, status in server_status.items():
-            if status.get("current_client"):
-                connected_clients.append(f"Server {srv_id}: Client {status.get('current_client')}")
-        
-        connected_info = ", ".join(connected_clients)
+    selected_server = None
+    with leases.lock:
+        # Kiểm tra xem client này đã đang kết nối tới server nào chưa
+        server = leases.server_of(client_id)
+        if server:
+            return jsonify({
+                "error": "Client already connected", 
+                "message": f"Client {client_id} đã đang truy cập {server['name']}",
+                "server_id": server["id"],
+                "server_name": server["name"],
+                "server_url": server["url"],
+                "lease_token": issue_lease_token(client_id)
+            }), 409  # Conflict status code
         
+        entry = find_queue_entry(client_id)
+        if entry is None:
+            # Chỉ cấp ngay khi không có ai đang chờ, tránh chen ngang hàng đợi
+            if not wait_queue:
+                selected_server = reserve_server(client_id, mode, priority=priority)
+
+            if not selected_server:
+                entry = enqueue_client(client_id, mode, priority)
+
+    if selected_server:
+        # Thông báo database server ngoài khóa, sau đó commit hoặc abort lease
+        try:
+            selected_server, lease_token = grant_server(selected_server, client_id, mode)
+        except Exception as e:
+            return jsonify({"error": f"Không thể thông báo cho database server: {str(e)}"}), 500
+        priority_stats.record(priority, time.time() - received_at)
+        return jsonify(server_info(selected_server, mode, lease_token))
+
+    # Hàng đợi được xử lý theo thứ tự chia lượt giữa các lớp, yêu cầu này có thể được cấp ngay
+    dispatch_queue()
+
+    if (wait or stay_queued) and not entry["event"].is_set():
+        socketio.emit('queued', {
+            "queue_position": queue_position(client_id),
+            "queue_depth": len(wait_queue)
+        }, room=client_room(client_id))
+
+    # Long-poll: chờ tới khi được gán server hoặc hết hạn
+    if wait and not entry["event"].is_set():
+        entry["event"].wait(timeout=wait)
+
+    if entry.get("error"):
+        return jsonify({"error": entry["error"]}), 500
+
+    if entry.get("result"):
+        return jsonify(entry["result"])
+
+    if stay_queued:
         return jsonify({
-            "error": f"All database servers are busy. Clients đang kết nối: {connected_info}"
-        }), 503
-    
-    # Chọn database server phù hợp
-    selected_server = select_database_server()
-    
-    if not selected_server:
-        return jsonify({"error": "All database servers are busy. Please try again later."}), 503
-    
-    # Cập nhật trạng thái server
-    server_id = selected_server["id"]
-    server_status[server_id]["busy"] = True
-    server_status[server_id]["current_client"] = client_id
-    server_status[server_id]["last_access"] = time.time()
-    
-    print(f"CLIENT {client_id} được điều phối đến {selected_server['name']}")
-    
-    # Thông báo cho database server về client sắp kết nối
-    try:
-        notify_database_server(selected_server, client_id)
-    except Exception as e:
-        # Reset trạng thái server nếu thông báo thất bại
-        server_status[server_id]["busy"] = False
-        server_status[server_id]["current_client"] = None
-        print(f"Lỗi thông báo DB server: {str(e)}")
-        return jsonify({"error": f"Không thể thông báo cho database server: {str(e)}"}), 500
-    
-    # Thông báo qua WebSocket nếu client đã đăng ký
-    if client_id in socket_connections:
-        socketio.emit('server_assigned', {
-            "server_id": selected_server["id"],
-            "server_name": selected_server["name"],
-            "server_url": selected_server["url"]
-        }, room=socket_connections[client_id])
+            "status": "queued",
+            "message": f"Client {client_id} đang chờ trong hàng đợi",
+            "queue_position": queue_position(client_id),
+            "queue_depth": len(wait_queue)
+        }), 202
 
-        socketio.emit('notification', {
-            'message': f'Client {client_id} được gán tới {selected_server["name"]}.',
-            'type': 'success'
-        })
-    
-    # Thông báo cập nhật trạng thái server cho tất cả client
-    socketio.emit('server_status_change', {
-        'servers': database_servers,
-        'status': server_status
-    })
-    
+    if not leave_queue(client_id):
+        # Được gán server ngay khi vừa hết hạn chờ: dispatch_queue ở luồng khác
+        # đã giữ chỗ nhưng grant_queued có thể chưa xong, chờ kết quả của nó
+        entry["event"].wait()
+        if entry.get("error"):
+            return jsonify({"error": entry["error"]}), 500
+        if entry.get("result"):
+            return jsonify(entry["result"])
+
+    if wait:
+        message = f"All database servers are busy. Hết thời gian chờ sau {wait:g} giây."
+    else:
+        # Thu thập thông tin các client đang kết nối để hiển thị
+        connected_info = ", ".join(
+            f"Server {lease['server_id']}: Client {lease['client_id']}"
+            for lease in leases.active_leases()
+        )
+        message = f"All database servers are busy. Clients đang kết nối: {connected_info}"
     return jsonify({
-        "server_id": selected_server["id"],
-        "server_name": selected_server["name"],
-        "server_url": selected_server["url"]
-    })
+        "error": message,
+        "queue_depth": len(wait_queue)
+    }), 503
 
 @app.route('/release_access', methods=['POST'])
 def release_access():
@@ -199,118 +2033,1186 @@ def release_access():
     if not client_id:
         return jsonify({"error": "Client ID is required"}), 400
     
-    # Nếu không cung cấp server_id, tìm tất cả server mà client này đang sử dụng
-    released_servers = []
+    # Giải phóng server mà client này đang sử dụng
+    lease = leases.release(client_id)
     
-    # Giải phóng tất cả server mà client này đang sử dụng
-    for svr_id_str, status in server_status.items():
-        # Chuyển đổi svr_id từ string sang int nếu cần
-        svr_id = int(svr_id_str) if isinstance(svr_id_str, str) else svr_id_str
-        
-        current_client = status.get("current_client")
-        
-        if current_client == client_id:
-            server_status[svr_id]["busy"] = False
-            server_status[svr_id]["current_client"] = None
-            released_servers.append(svr_id)
-            print(f"Released server {svr_id}")
+    if lease is not None:
+        server_id = lease["server_id"]
+        print(f"Released server {server_id}")
 
+        # Thu hồi lease token trên database server (client có thể chỉ báo coordinator)
+        release_database_server(leases.servers[server_id], client_id, lease)
         socketio.emit('notification', {
             'message': f'Client {client_id} đã ngắt kết nối/giải phóng quyền truy cập.',
             'type': 'warning'
-        })
+        }, room=DASHBOARD_ROOM)
 
-    
-    if released_servers:
         # Thông báo cập nhật trạng thái server cho tất cả client
-        socketio.emit('server_status_change', {
-            'servers': database_servers,
-            'status': server_status
-        })
+        status_broadcaster.publish()
+
+        # Trao server vừa được giải phóng cho client đang chờ
+        dispatch_queue()
         
         return jsonify({
             "status": "success", 
-            "message": f"Access released successfully for {len(released_servers)} servers",
-            "released_servers": released_servers
+            "message": "Access released successfully for 1 servers",
+            "released_servers": [server_id]
         })
     
-    # Nếu không tìm thấy server nào, kiểm tra lại tất cả những client đang kết nối
-    connected_clients = []
-    for svr_id, status in server_status.items():
-        if status.get("current_client"):
-            connected_clients.append({
-                "server_id": svr_id,
-                "client_id": status.get("current_client")
-            })
-    
+    # Nếu không tìm thấy server nào, trả về danh sách những client đang kết nối
     return jsonify({
         "error": "No servers found for this client", 
         "client_id": client_id,
-        "connected_clients": connected_clients
+        "connected_clients": leases.active_leases()
     }), 404
     
+def parse_batch_clients(data):
+    """Danh sách (client_id, mode) của yêu cầu theo lô, hoặc chuỗi lỗi
+
+    "clients" gồm client_id hoặc {"client_id", "mode"}; "mode" ở ngoài là
+    chế độ mặc định.
+    """
+    default_mode = data.get('mode', 'shared')
+    clients = data.get('clients')
+    if not isinstance(clients, list) or not clients:
+        return "clients must be a non-empty list"
+    if len(clients) > BATCH_MAX_CLIENTS:
+        return f"At most {BATCH_MAX_CLIENTS} clients per batch"
+
+    parsed = []
+    for index, item in enumerate(clients):
+        if isinstance(item, dict):
+            client_id, mode = item.get('client_id'), item.get('mode', default_mode)
+        else:
+            client_id, mode = item, default_mode
+        if not isinstance(client_id, str) or not client_id:
+            return f"clients[{index}]: client_id must be a non-empty string"
+        if mode not in LEASE_MODES:
+            return f"clients[{index}]: mode must be one of {', '.join(LEASE_MODES)}"
+        parsed.append((client_id, mode))
+    if len({client_id for client_id, _ in parsed}) != len(parsed):
+        return "Duplicate client IDs in batch"
+    return parsed
+
+def grant_batch(reserved):
+    """Hoàn tất các lease đã giữ chỗ, trả về (granted, failed)
+
+    Với LEASE_NOTIFY="sync", các database server được thông báo song song;
+    mặc định grant_server không chờ database server nên chạy lần lượt.
+    """
+    granted = {}
+    failed = {}
+
+    def grant(server, client_id, mode):
+        try:
+            server, lease_token = grant_server(server, client_id, mode, announce=False)
+            granted[client_id] = server_info(server, mode, lease_token)
+        except Exception as e:
+            failed[client_id] = f"Không thể thông báo cho database server: {str(e)}"
+
+    if LEASE_NOTIFY != "sync":
+        for server, client_id, mode in reserved:
+            grant(server, client_id, mode)
+        return granted, failed
+
+    pending = []
+    for server, client_id, mode in reserved:
+        done = socketio.server.eio.create_event()
+
+        def call(server=server, client_id=client_id, mode=mode, done=done):
+            try:
+                grant(server, client_id, mode)
+            finally:
+                done.set()
+
+        socketio.start_background_task(call)
+        pending.append(done)
+    for done in pending:
+        done.wait()
+    return granted, failed
+
+@app.route('/request_access_batch', methods=['POST'])
+def request_access_batch():
+    """Cấp lease cho nhiều client trong một yêu cầu
+
+    Body: {"clients": ["a", {"client_id": "b", "mode": "exclusive"}],
+    "mode": "shared", "priority": "batch", "atomic": false}; cả lô cùng một
+    lớp ưu tiên. Mọi client được giữ chỗ trong cùng
+    một lần giữ leases.lock; với atomic=true, nếu một client không được cấp
+    thì không client nào được cấp (các lease đã cấp được giải phóng lại).
+    Không xếp hàng đợi: client không có server rảnh nằm trong "failed".
+    """
+    received_at = time.time()
+    data = request.json or {}
+    clients = parse_batch_clients(data)
+    if isinstance(clients, str):
+        return jsonify({"error": clients}), 400
+    atomic = bool(data.get('atomic', False))
+    priority = data.get('priority', DEFAULT_PRIORITY)
+    if priority not in PRIORITY_CLASSES:
+        return jsonify({"error": f"priority must be one of {', '.join(PRIORITY_CLASSES)}"}), 400
+
+    reserved = []
+    failed = {}
+    with leases.lock:
+        for client_id, mode in clients:
+            if leases.server_of(client_id):
+                failed[client_id] = "Client already connected"
+            elif wait_queue or find_queue_entry(client_id):
+                # Không chen ngang các client đang chờ trong hàng đợi
+                failed[client_id] = "All database servers are busy"
+            else:
+                server = reserve_server(client_id, mode, priority=priority)
+                if server:
+                    reserved.append((server, client_id, mode))
+                else:
+                    failed[client_id] = "All database servers are busy"
+            if atomic and failed:
+                break
+
+        if atomic and failed:
+            for server, client_id, mode in reserved:
+                leases.abort(client_id, server["id"])
+            reserved = []
+
+    granted, grant_failed = grant_batch(reserved)
+    failed.update(grant_failed)
+
+    if atomic and failed and granted:
+        # Một database server từ chối: trả lại các lease vừa cấp
+        with leases.lock:
+            rolled_back = [(client_id, leases.release(client_id)) for client_id in granted]
+        for client_id, lease in rolled_back:
+            if lease is not None:
+                release_database_server(leases.servers[lease["server_id"]], client_id, lease)
+        granted = {}
+        status_broadcaster.publish()
+        dispatch_queue()
+
+    if granted:
+        elapsed = time.time() - received_at
+        for _ in granted:
+            priority_stats.record(priority, elapsed)
+        print(f"Cấp {len(granted)} lease theo lô ({len(failed)} thất bại)")
+        socketio.emit('notification', {
+            'message': f'Cấp {len(granted)} lease theo lô.',
+            'type': 'success'
+        }, room=DASHBOARD_ROOM)
+
+    if not granted:
+        return jsonify({"error": "No lease granted", "granted": {}, "failed": failed}), 503
+    return jsonify({
+        "status": "success" if not failed else "partial",
+        "granted": granted,
+        "failed": failed
+    })
+
+@app.route('/release_access_batch', methods=['POST'])
+def release_access_batch():
+    """Giải phóng lease của nhiều client trong một yêu cầu
+
+    Body: {"clients": ["a", "b"]}. Các lease được giải phóng trong cùng một
+    lần giữ leases.lock; database server được báo chạy nền song song.
+    """
+    data = request.json or {}
+    clients = parse_batch_clients(data)
+    if isinstance(clients, str):
+        return jsonify({"error": clients}), 400
+
+    with leases.lock:
+        released = [(client_id, leases.release(client_id)) for client_id, _ in clients]
+
+    released_servers = {}
+    not_found = []
+    for client_id, lease in released:
+        if lease is None:
+            not_found.append(client_id)
+            continue
+        released_servers[client_id] = lease["server_id"]
+        release_database_server(leases.servers[lease["server_id"]], client_id, lease)
+
+    if released_servers:
+        print(f"Giải phóng {len(released_servers)} lease theo lô")
+        socketio.emit('notification', {
+            'message': f'Giải phóng {len(released_servers)} lease theo lô.',
+            'type': 'warning'
+        }, room=DASHBOARD_ROOM)
+        status_broadcaster.publish()
+        dispatch_queue()
+
+    return jsonify({
+        "status": "success" if released_servers else "not_found",
+        "released": released_servers,
+        "not_found": not_found
+    }), 200 if released_servers else 404
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    """Endpoint REST để client gia hạn lease"""
+    data = request.json
+    client_id = data.get('client_id')
+    
+    if not client_id:
+        return jsonify({"error": "Client ID is required"}), 400
+
+    record_data_latency(client_id, data.get('data_latency'))
+    expires_at = leases.renew(client_id)
+    if expires_at is None and leases.server_of(client_id) is None:
+        return jsonify({
+            "error": "No active lease for this client",
+            "client_id": client_id
+        }), 404
+
+    return jsonify({
+        "status": "success",
+        "client_id": client_id,
+        "expires_at": expires_at,
+        "lease_ttl": LEASE_TTL_SECONDS,
+        "lease_token": issue_lease_token(client_id)
+    })
+
+@app.route('/register_server', methods=['POST'])
+def register_server():
+    """Endpoint cho database server tự đăng ký (hoặc đăng ký lại) với coordinator
+
+    Server đăng ký lại với cùng id hoặc url giữ nguyên các lease đang có; danh
+    sách lease được trả về để database server khôi phục client được phép truy cập.
+    """
+    data = request.json or {}
+    url = data.get('url')
+
+    if not url:
+        return jsonify({"error": "Server url is required"}), 400
+
+    with leases.lock:
+        server_id = data.get('id') or leases.find_server(url) or leases.next_server_id()
+        try:
+            server_id = int(server_id)
+            capacity = int(data.get('capacity', DEFAULT_SERVER_CAPACITY))
+        except (TypeError, ValueError):
+            return jsonify({"error": "id and capacity must be integers"}), 400
+        server = {
+            "id": server_id,
+            "name": data.get('name') or f"Database Server {server_id}",
+            "url": url,
+            "capacity": capacity
+        }
+        if 'weight' in data:
+            server["weight"] = data['weight']
+        leases.add_server(server)
+        leases.record_event("server_registered", server_id=server_id)
+        carried_leases = leases.leases_on(server_id)
+    health_checker.add_server(server_id, registered=True)
+
+    print(f"{server['name']} đã đăng ký tại {url} ({len(carried_leases)} lease đang có)")
+    socketio.emit('notification', {
+        'message': f'{server["name"]} đã đăng ký với coordinator.',
+        'type': 'success'
+    }, room=DASHBOARD_ROOM)
+    status_broadcaster.publish()
+    dispatch_queue()
+
+    return jsonify({
+        "status": "success",
+        "server_id": server_id,
+        "leases": carried_leases,
+        "heartbeat_interval": SERVER_REGISTRATION_TTL / 3
+    })
+
+@app.route('/deregister_server', methods=['POST'])
+def deregister_server():
+    """Endpoint cho database server hủy đăng ký (khi tắt)
+
+    Server ngừng nhận lease mới ngay; các lease đang có vẫn giữ tới khi được
+    giải phóng hoặc hết hạn.
+    """
+    data = request.json or {}
+    server_id = data.get('server_id')
+
+    if server_id is None:
+        return jsonify({"error": "Server ID is required"}), 400
+
+    try:
+        server_id = int(server_id)
+    except (TypeError, ValueError):
+        return jsonify({"error": "server_id must be an integer"}), 400
+    server = leases.servers.get(server_id)
+    if server is None:
+        return jsonify({"error": "Unknown server", "server_id": server_id}), 404
+
+    remaining = len(leases.leases_on(server_id))
+    removed = leases.remove_server(server_id)
+    health_checker.remove_server(server_id)
+
+    print(f"{server['name']} đã hủy đăng ký ({remaining} lease còn lại)")
+    socketio.emit('notification', {
+        'message': f'{server["name"]} đã hủy đăng ký khỏi coordinator.',
+        'type': 'warning'
+    }, room=DASHBOARD_ROOM)
+    status_broadcaster.publish()
+    dispatch_queue()
+
+    return jsonify({
+        "status": "success",
+        "server_id": server_id,
+        "removed": removed,
+        "remaining_leases": remaining
+    })
+
+@app.route('/server_heartbeat', methods=['POST'])
+def server_heartbeat():
+    """Endpoint để database server tự đăng ký duy trì đăng ký của mình
+
+    Trả về 404 nếu coordinator không biết server (ví dụ coordinator vừa khởi
+    động lại); database server cần đăng ký lại.
+    """
+    data = request.json or {}
+    server_id = data.get('server_id')
+
+    if server_id is None:
+        return jsonify({"error": "Server ID is required"}), 400
+
+    try:
+        server_id = int(server_id)
+    except (TypeError, ValueError):
+        return jsonify({"error": "server_id must be an integer"}), 400
+    status = leases.status.get(server_id)
+    if status is None or status["deregistered"] or not health_checker.seen(server_id):
+        return jsonify({"error": "Unknown server, register again", "server_id": server_id}), 404
+    # Các worker khác cũng cần biết server còn sống
+    leases.record_event("server_seen", server_id=server_id)
+
+    return jsonify({"status": "success", "server_id": server_id})
+
+@app.route('/drain_server', methods=['GET', 'POST'])
+def drain_server():
+    """Bật/tắt drain cho một server (POST) hoặc xem tiến độ drain (GET)
+
+    Server đang drain không nhận lease mới, lease đang có chạy tới khi được
+    giải phóng hoặc hết hạn; "drained" là True khi server đã trống.
+    """
+    if request.method == 'POST':
+        data = request.json or {}
+        server_id = data.get('server_id')
+        draining = bool(data.get('drain', True))
+    else:
+        server_id = request.args.get('server_id')
+        draining = None
+
+    if server_id is None:
+        return jsonify({"error": "Server ID is required"}), 400
+
+    try:
+        server_id = int(server_id)
+    except (TypeError, ValueError):
+        return jsonify({"error": "server_id must be an integer"}), 400
+    server = leases.servers.get(server_id)
+    if server is None:
+        return jsonify({"error": "Unknown server", "server_id": server_id}), 404
+
+    if draining is not None:
+        remaining = leases.set_draining(server_id, draining)
+        print(f"{server['name']} {'bắt đầu drain' if draining else 'trở lại vòng cấp lease'}, còn {remaining} lease")
+        socketio.emit('notification', {
+            'message': (f'{server["name"]} đang drain, còn {remaining} lease.' if draining
+                        else f'{server["name"]} đã trở lại nhận lease mới.'),
+            'type': 'warning' if draining else 'success'
+        }, room=DASHBOARD_ROOM)
+        status_broadcaster.publish()
+        # Yêu cầu đang chờ được chuyển sang server khác / server vừa trở lại
+        dispatch_queue()
+
+    with leases.read_lock:
+        status = leases.status[server_id]
+        remaining_clients = sorted(status["clients"])
+        draining = status["draining"]
+
+    return jsonify({
+        "status": "success",
+        "server_id": server_id,
+        "draining": draining,
+        "drained": draining and not remaining_clients,
+        "remaining_clients": remaining_clients
+    })
+
 @app.route('/server_status', methods=['GET'])
 def get_server_status():
+    """Trạng thái các server kèm version và ETag
+
+    Trả 304 khi If-None-Match khớp ETag hiện tại. Với since=<version>, chỉ trả
+    các server thay đổi sau version đó ("changed"/"removed"); nếu version quá
+    cũ so với lịch sử delta thì trả toàn bộ snapshot.
+    """
+    version = status_broadcaster.current_version()
+    queue_depth = len(wait_queue)
+    etag = f"{version}-{queue_depth}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    payload = None
+    since = request.args.get('since', type=int)
+    if since is not None:
+        payload = status_broadcaster.changes_since(since)
+    if payload is None:
+        payload = status_broadcaster.snapshot()
+    payload["queue_depth"] = queue_depth
+    payload["strategy"] = selection_strategy.name
+
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/queue_status', methods=['GET'])
+def get_queue_status():
+    """Độ dài hàng đợi, vị trí của từng client đang chờ và số liệu theo lớp ưu tiên"""
+    client_id = request.args.get('client_id')
+    now = time.time()
+    with leases.read_lock:
+        queued_entries = list(wait_queue.values())
+        depths = wait_queue.depths()
+
+    if client_id:
+        position = queue_position(client_id)
+        if position is None:
+            return jsonify({
+                "error": "Client is not waiting in queue",
+                "client_id": client_id,
+                "queue_depth": len(wait_queue)
+            }), 404
+        return jsonify({
+            "client_id": client_id,
+            "queue_position": position,
+            "queue_depth": len(wait_queue)
+        })
+
     return jsonify({
-        "servers": database_servers,
-        "status": server_status
+        "queue_depth": len(wait_queue),
+        "queue": [
+            {
+                "client_id": entry["client_id"],
+                "priority": entry["priority"],
+                "position": index + 1,
+                "waited": round(now - entry["enqueued_at"], 3)
+            }
+            for index, entry in enumerate(queued_entries)
+        ],
+        "priority_classes": {
+            name: dict(stats, weight=PRIORITY_CLASSES[name], queued=depths[name])
+            for name, stats in priority_stats.snapshot().items()
+        }
     })
 
-def select_database_server():
-    """Thuật toán chọn database server dựa trên trạng thái hiện tại"""
-    # Kiểm tra xem có server nào không bận
-    available_servers = []
-    
-    for server_id, status in server_status.items():
-        is_busy = status.get("busy", False)
-        
-        if not is_busy:
-            available_servers.append(server_id)
-    
-    # Nếu không có server nào available
-    if not available_servers:
+def select_database_server(mode="shared", client_id=None, exclude=None):
+    """Chọn database server theo chiến lược đã cấu hình (LB_STRATEGY)
+
+    Writer đang chờ luôn nhận lại server mục tiêu của mình khi server đó trống.
+    Khi chuyển sang server khác sau một lần cấp thất bại (exclude là các server
+    đã thử), chọn server ít tải nhất còn lại.
+    """
+    with leases.lock:
+        if exclude:
+            candidates = [s for s in leases.candidates(mode) if s["id"] not in exclude]
+            return min(candidates, key=lambda s: leases.load(s["id"]), default=None)
+        if mode == "exclusive":
+            server = leases.writer_target(client_id)
+            if server:
+                return server
+        return selection_strategy.select(leases, mode)
+
+def record_data_latency(client_id, latency):
+    """Ghi nhận độ trễ /data do client báo về kèm heartbeat"""
+    if latency is None or not client_id:
+        return
+    server = leases.server_of(client_id)
+    if server is None:
+        return
+    try:
+        server_latency.record(server["id"], float(latency))
+    except (TypeError, ValueError):
+        pass
+
+def reserve_server(client_id, mode="shared", exclude=None, priority=DEFAULT_PRIORITY):
+    """Chọn và giữ chỗ một server rảnh cho client một cách nguyên tử"""
+    with leases.lock:
+        server = select_database_server(mode, client_id, exclude)
+        if server and leases.reserve(server["id"], client_id, mode, priority):
+            return server
         return None
-    
-    # Nếu có nhiều server available, chọn server được truy cập lâu nhất
-    if len(available_servers) > 1:
-        min_last_access = float('inf')
-        selected_id = None
-        
-        for server_id in available_servers:
-            if server_status[server_id]["last_access"] < min_last_access:
-                min_last_access = server_status[server_id]["last_access"]
-                selected_id = server_id
-        
-        return next((s for s in database_servers if s["id"] == int(selected_id)), None)
-    
-    # Nếu chỉ có một server available
-    server_id = available_servers[0]
-    return next((s for s in database_servers if s["id"] == int(server_id)), None)
 
-def notify_database_server(server, client_id):
+def notify_database_server(server, client_id, mode="shared", granted_at=None):
     """Thông báo cho database server về client sắp kết nối"""
     try:
-        response = requests.post(
-            f"{server['url']}/notify_access",
-            json={"client_id": client_id},
-            timeout=12
+        started = time.time()
+        response = db_client.post(
+            server, "/notify_access",
+            {"client_id": client_id, "mode": mode, "granted_at": granted_at},
+            timeout=DB_NOTIFY_TIMEOUT
         )
+        server_latency.record(server["id"], time.time() - started)
         response.raise_for_status()
         return response.json()
     except Exception as e:
         print(f"Lỗi khi thông báo cho server {server['name']}: {str(e)}")
         raise
 
+def notify_with_hedge(server, client_id, mode="shared", tried=()):
+    """Gọi notify_database_server, bỏ server nếu chậm quá NOTIFY_HEDGE_AFTER giây
+
+    Chỉ bỏ khi còn server rảnh khác để chuyển sang: lease giữ chỗ trên server
+    chậm bị hủy và ném TimeoutError. Nếu notify bị bỏ sau đó vẫn thành công,
+    database server được báo giải phóng client.
+    """
+    if NOTIFY_HEDGE_AFTER <= 0:
+        return notify_database_server(server, client_id, mode)
+
+    done = socketio.server.eio.create_event()
+    outcome = {"abandoned": False}
+    outcome_lock = threading.Lock()
+
+    def call():
+        try:
+            result = notify_database_server(server, client_id, mode)
+            with outcome_lock:
+                outcome["result"] = result
+                abandoned = outcome["abandoned"]
+            if abandoned:
+                release_database_server(server, client_id)
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    socketio.start_background_task(call)
+    if not done.wait(NOTIFY_HEDGE_AFTER):
+        exclude = set(tried) | {server["id"]}
+        has_alternative = any(s["id"] not in exclude for s in leases.candidates(mode))
+        with outcome_lock:
+            if has_alternative and "result" not in outcome and "error" not in outcome:
+                outcome["abandoned"] = True
+        if outcome["abandoned"]:
+            leases.abort(client_id, server["id"])
+            raise TimeoutError(f"{server['name']} phản hồi chậm hơn {NOTIFY_HEDGE_AFTER}s")
+        done.wait()
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+def notify_in_background(server, client_id, mode="shared", granted_at=None):
+    """Gọi /notify_access chạy nền (LEASE_NOTIFY="async"), chỉ để database server ghi log"""
+    def call():
+        try:
+            notify_database_server(server, client_id, mode, granted_at)
+        except Exception:
+            pass
+    socketio.start_background_task(call)
+
+def release_database_server(server, client_id, lease=None, reason=None):
+    """Thông báo cho database server rằng client không còn giữ lease
+
+    granted_at của lease được gửi kèm để database server thu hồi các lease
+    token cấp từ lúc đó trở về trước, cùng chữ ký HMAC để database server
+    không nhận granted_at từ nguồn khác. Chạy nền và tự thử lại, người gọi
+    (disconnect, thu hồi lease) không phải chờ.
+    """
+    payload = {"client_id": client_id}
+    if lease:
+        payload = {
+            "client_id": client_id,
+            "server_id": server["id"],
+            "granted_at": lease["granted_at"],
+            "reason": reason
+        }
+        payload["signature"] = sign_release(payload)
+    elif reason:
+        payload["reason"] = reason
+    db_client.post_in_background(server, "/release", payload, timeout=DB_RELEASE_TIMEOUT)
+
+def sign_release(payload):
+    """Chữ ký HMAC-SHA256 (base64url) cho yêu cầu /release gửi database server"""
+    message = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(
+        hmac.new(LEASE_TOKEN_SECRET.encode(), b"release." + message, hashlib.sha256).digest()
+    ).rstrip(b"=").decode()
+
+def sign_lease_token(claims):
+    """Ký claims thành token "<payload>.<chữ ký>" (base64url, HMAC-SHA256)"""
+    payload = base64.urlsafe_b64encode(
+        json.dumps(claims, separators=(",", ":"), sort_keys=True).encode()
+    ).rstrip(b"=")
+    signature = base64.urlsafe_b64encode(
+        hmac.new(LEASE_TOKEN_SECRET.encode(), payload, hashlib.sha256).digest()
+    ).rstrip(b"=")
+    return (payload + b"." + signature).decode()
+
+def issue_lease_token(client_id):
+    """Lease token cho lease đang hoạt động của client, None nếu client không giữ lease"""
+    claims = leases.token_claims(client_id)
+    return sign_lease_token(claims) if claims else None
+
+def server_info(server, mode=None, lease_token=None):
+    """Thông tin server trả về cho client"""
+    info = {
+        "server_id": server["id"],
+        "server_name": server["name"],
+        "server_url": server["url"]
+    }
+    if mode:
+        info["mode"] = mode
+        info["lease_ttl"] = LEASE_TTL_SECONDS
+    if lease_token:
+        info["lease_token"] = lease_token
+    return info
+
+def status_payload():
+    """Ảnh chụp trạng thái các server gửi cho dashboard và client"""
+    with leases.read_lock:
+        status = leases.snapshot()
+        servers = list(leases.servers.values())
+    for server_id, server_status in status.items():
+        server_status["latency"] = server_latency.get(server_id)
+    return {
+        'servers': servers,
+        'status': status
+    }
+
+def grant_server(server, client_id, mode="shared", announce=True):
+    """Hoàn tất lease đã giữ chỗ: commit và cấp lease token cho client
+
+    Gọi ngoài leases.lock. Mặc định (LEASE_NOTIFY="async") database server tự
+    xác thực client bằng lease token nên lease được commit ngay, /notify_access
+    chỉ chạy nền. announce=False bỏ thông báo dashboard cho từng client (cấp
+    theo lô thông báo một lần). Trả về (server, lease_token).
+    """
+    if LEASE_NOTIFY == "sync":
+        server = notify_with_failover(server, client_id, mode)
+
+    if not leases.commit(client_id, server["id"]):
+        # Lease đã bị giải phóng (client ngắt kết nối) trong lúc chờ database server
+        release_database_server(server, client_id)
+        raise Exception(f"Lease của client {client_id} đã bị hủy trước khi được xác nhận")
+
+    print(f"CLIENT {client_id} được điều phối đến {server['name']}")
+    claims = leases.token_claims(client_id)
+    lease_token = sign_lease_token(claims)
+    if LEASE_NOTIFY != "sync":
+        notify_in_background(server, client_id, mode, claims["granted_at"])
+    
+    # Thông báo qua WebSocket nếu client đã đăng ký (socket có thể ở worker khác)
+    socketio.emit('server_assigned', server_info(server, mode, lease_token), room=client_room(client_id))
+    if announce and client_id in socket_connections:
+        socketio.emit('notification', {
+            'message': f'Client {client_id} được gán tới {server["name"]}.',
+            'type': 'success'
+        }, room=DASHBOARD_ROOM)
+    
+    # Thông báo cập nhật trạng thái server cho tất cả client
+    status_broadcaster.publish()
+    return server, lease_token
+
+def notify_with_failover(server, client_id, mode="shared"):
+    """Thông báo đồng bộ cho database server trước khi commit (LEASE_NOTIFY="sync")
+
+    Nếu thông báo thất bại (lỗi, breaker mở hoặc quá chậm) chỉ lease giữ chỗ
+    của chính client này bị hủy và lease được chuyển sang server rảnh khác,
+    tối đa GRANT_MAX_ATTEMPTS server. Trả về server cuối cùng đã xác nhận.
+    """
+    tried = set()
+    # Lease chuyển sang server khác giữ nguyên lớp ưu tiên
+    priority = leases.client_leases.get(client_id, {}).get("priority", DEFAULT_PRIORITY)
+    while True:
+        tried.add(server["id"])
+
+        # Thông báo cho database server về client sắp kết nối
+        try:
+            notify_with_hedge(server, client_id, mode, tried)
+            break
+        except Exception as e:
+            print(f"Lỗi thông báo DB server {server['name']}: {str(e)}")
+            # Hủy lease giữ chỗ; nếu lease đã không còn (client đã giải phóng) thì dừng
+            if not leases.abort(client_id, server["id"]) and not isinstance(e, TimeoutError):
+                raise
+            fallback = None
+            if len(tried) < GRANT_MAX_ATTEMPTS:
+                fallback = reserve_server(client_id, mode, exclude=tried, priority=priority)
+            if fallback is None:
+                raise
+            server = fallback
+    return server
+
+def find_queue_entry(client_id):
+    """Tìm yêu cầu đang chờ của client trong hàng đợi"""
+    return wait_queue.get(client_id)
+
+def queue_position(client_id):
+    """Vị trí (bắt đầu từ 1) của client trong hàng đợi, None nếu không chờ"""
+    with leases.read_lock:
+        if client_id not in wait_queue:
+            return None
+        for index, queued_client in enumerate(wait_queue):
+            if queued_client == client_id:
+                return index + 1
+
+def enqueue_client(client_id, mode="shared", priority=DEFAULT_PRIORITY):
+    """Đưa client vào cuối hàng đợi của lớp ưu tiên (gọi khi đang giữ leases.lock)"""
+    entry = {
+        "client_id": client_id,
+        "mode": mode,
+        "priority": priority,
+        "enqueued_at": time.time(),
+        "event": socketio.server.eio.create_event(),
+        "result": None,
+        "error": None
+    }
+    wait_queue[client_id] = entry
+    if mode == "exclusive":
+        # Chặn lease shared mới trên server mà writer này chờ
+        leases.wait_for_writer(client_id)
+    print(f"Client {client_id} ({priority}) vào hàng đợi, {len(wait_queue)} client đang chờ")
+    return entry
+
+def leave_queue(client_id, reason=None):
+    """Rút client khỏi hàng đợi, đánh thức yêu cầu long-poll nếu có"""
+    with leases.lock:
+        entry = wait_queue.pop(client_id, None)
+        leases.stop_waiting(client_id)
+    if entry is None:
+        return False
+    if reason:
+        entry["error"] = reason
+        entry["event"].set()
+    print(f"Client {client_id} rời hàng đợi")
+
+    if entry["mode"] == "exclusive":
+        # Server writer này chờ lại nhận lease shared
+        dispatch_queue()
+    return True
+
+def dispatch_queue():
+    """Trao các slot đang trống cho những client trong hàng đợi
+
+    Duyệt theo thứ tự chia lượt giữa các lớp ưu tiên (FIFO trong mỗi lớp),
+    ưu tiên writer có server mục tiêu đã trống. Yêu cầu exclusive chưa được
+    đáp ứng không chặn các yêu cầu shared phía sau, nhưng server nó chờ
+    không nhận thêm lease shared nên writer không bị đói.
+    """
+    while True:
+        selected_server = None
+        with leases.lock:
+            for client_id in itertools.chain(leases.ready_writers(), wait_queue):
+                entry = wait_queue.get(client_id)
+                if entry is None:
+                    continue
+                selected_server = reserve_server(client_id, entry["mode"], priority=entry["priority"])
+                if selected_server:
+                    wait_queue.serve(client_id)
+                    break
+                if entry["mode"] == "exclusive":
+                    leases.wait_for_writer(client_id)
+                else:
+                    # Không còn slot shared nào cho các yêu cầu phía sau
+                    break
+
+        if not selected_server:
+            break
+        grant_queued(entry, selected_server)
+
+def grant_queued(entry, server):
+    """Cấp server đã giữ chỗ cho yêu cầu vừa rời hàng đợi và đánh thức long-poll"""
+    try:
+        server, lease_token = grant_server(server, entry["client_id"], entry["mode"])
+        entry["result"] = server_info(server, entry["mode"], lease_token)
+        priority_stats.record(entry["priority"], time.time() - entry["enqueued_at"])
+    except Exception as e:
+        entry["error"] = f"Không thể thông báo cho database server: {str(e)}"
+    finally:
+        # Luôn đánh thức yêu cầu đang chờ kết quả, kể cả khi cấp thất bại
+        entry["event"].set()
+
+def lower_priorities(priority):
+    """Các lớp có trọng số thấp hơn lớp priority (lease của chúng có thể bị lấy lại)"""
+    weight = PRIORITY_CLASSES[priority]
+    return {name for name, other in PRIORITY_CLASSES.items() if other < weight}
+
+def preempt_leases():
+    """Lấy lại lease lớp thấp cho các yêu cầu lớp cao đã chờ quá PREEMPT_GRACE_SECONDS
+
+    Slot vừa lấy lại được trao thẳng cho yêu cầu đang chờ thay vì qua
+    dispatch_queue, để không rơi vào tay một client lớp thấp khác. Client
+    bị lấy lại lease nhận sự kiện 'lease_preempted', database server được
+    báo giải phóng như khi lease hết hạn. Trả về số lease đã lấy lại.
+    """
+    preempted = []
+    handed_over = []
+    with leases.lock:
+        now = time.time()
+        for entry in list(wait_queue.values()):
+            if now - entry["enqueued_at"] < PREEMPT_GRACE_SECONDS:
+                continue
+            lower = lower_priorities(entry["priority"])
+            if not lower:
+                continue
+            client_id = entry["client_id"]
+            while True:
+                victim = leases.preemption_victim(entry["mode"], lower, client_id)
+                if victim is None:
+                    break
+                preempted.append((victim, leases.release(victim), client_id))
+                server = reserve_server(client_id, entry["mode"], priority=entry["priority"])
+                if server:
+                    wait_queue.serve(client_id)
+                    handed_over.append((entry, server))
+                    break
+                if entry["mode"] != "exclusive":
+                    break
+
+    for client_id, lease, waiter in preempted:
+        server = leases.servers[lease["server_id"]]
+        priority_stats.record_preempted(lease["priority"])
+        print(f"Lease của client {client_id} ({lease['priority']}) trên {server['name']} bị lấy lại cho client {waiter}")
+        release_database_server(server, client_id, lease, reason="preempted")
+        socketio.emit('lease_preempted', {
+            'client_id': client_id,
+            'server_id': lease["server_id"],
+            'priority': lease["priority"],
+            'message': f'Lease của client {client_id} trên {server["name"]} đã bị lấy lại cho yêu cầu ưu tiên cao hơn.'
+        }, room=client_room(client_id))
+        socketio.emit('notification', {
+            'message': f'Lease của client {client_id} trên {server["name"]} bị lấy lại cho client {waiter}.',
+            'type': 'warning'
+        }, room=DASHBOARD_ROOM)
+
+    for entry, server in handed_over:
+        grant_queued(entry, server)
+    if preempted:
+        status_broadcaster.publish()
+        # Slot thừa (ví dụ yêu cầu exclusive không đủ chỗ) trả về hàng đợi
+        dispatch_queue()
+    return len(preempted)
+
+def expire_leases():
+    """Thu hồi các lease hết hạn trên coordinator và database server"""
+    expired = leases.expire(time.time())
+    for client_id, lease in expired:
+        server_id = lease["server_id"]
+        server = leases.servers[server_id]
+        print(f"Lease của client {client_id} trên server {server_id} đã hết hạn")
+        release_database_server(server, client_id, lease, reason="lease_expired")
+
+        socketio.emit('lease_expired', {
+            'client_id': client_id,
+            'server_id': server_id,
+            'message': f'Lease của client {client_id} trên {server["name"]} đã hết hạn.'
+        }, room=client_room(client_id))
+
+        socketio.emit('notification', {
+            'message': f'Lease của client {client_id} trên {server["name"]} đã hết hạn.',
+            'type': 'warning'
+        }, room=DASHBOARD_ROOM)
+
+    if expired:
+        status_broadcaster.publish()
+        dispatch_queue()
+    return expired
+
+def lease_expiry_loop():
+    """Vòng nền thu hồi lease: ngủ tới lần hết hạn gần nhất thay vì quét định kỳ"""
+    while True:
+        try:
+            expire_leases()
+        except Exception as e:
+            print(f"Lỗi khi thu hồi lease hết hạn: {str(e)}")
+
+        next_expiry = leases.next_expiry()
+        delay = EXPIRY_MAX_SLEEP
+        if next_expiry is not None:
+            delay = min(max(next_expiry - time.time(), 0.01), EXPIRY_MAX_SLEEP)
+        socketio.sleep(delay)
+
+def preemption_loop():
+    """Vòng nền lấy lại lease lớp thấp cho yêu cầu lớp cao đã chờ quá hạn"""
+    while True:
+        try:
+            if wait_queue:
+                preempt_leases()
+        except Exception as e:
+            print(f"Lỗi khi lấy lại lease cho yêu cầu ưu tiên: {str(e)}")
+        socketio.sleep(PREEMPT_CHECK_INTERVAL)
+
+def probe_server(server_id):
+    """Gọi /status của database server và cập nhật health khi có thay đổi"""
+    server = leases.servers.get(server_id)
+    if server is None:
+        return
+    started = time.time()
+    try:
+        response = db_client.request("GET", server, "/status", HEALTH_CHECK_TIMEOUT, limited=False)
+        ok = response.status_code == 200
+    except Exception:
+        ok = False
+    latency = time.time() - started
+
+    health = health_checker.report(server_id, ok, latency)
+    if health is None:
+        return
+    previous = leases.set_health(server_id, health)
+    if previous == health:
+        return
+
+    print(f"Health của {server['name']}: {previous} -> {health}")
+    health_change = {
+        'server_id': server_id,
+        'previous': previous,
+        'health': health,
+        'latency': round(latency, 3)
+    }
+    # Mỗi worker tự kiểm tra sức khỏe nên chỉ báo cho socket của worker này
+    socketio.emit('server_health_change', health_change, room=DASHBOARD_ROOM, ignore_queue=True)
+    socketio.emit('server_health_change', health_change, room=server_room(server_id), ignore_queue=True)
+    socketio.emit('notification', {
+        'message': f'{server["name"]} chuyển trạng thái {previous} -> {health}.',
+        'type': 'error' if health == 'down' else 'warning' if health == 'degraded' else 'success'
+    }, room=DASHBOARD_ROOM, ignore_queue=True)
+    status_broadcaster.publish()
+
+    if health != "down":
+        # Server hoạt động trở lại có thể nhận client đang chờ
+        dispatch_queue()
+
+def breaker_changed(server_id, state):
+    """Đồng bộ trạng thái circuit breaker vào bảng lease và báo cho dashboard"""
+    server = leases.servers.get(server_id)
+    if server is None:
+        return
+    leases.set_breaker(server_id, state)
+    print(f"Circuit breaker của {server['name']}: {state}")
+    socketio.emit('notification', {
+        'message': f'Circuit breaker của {server["name"]} chuyển sang {state}.',
+        'type': 'error' if state == 'open' else 'warning' if state == 'half_open' else 'success'
+    }, room=DASHBOARD_ROOM, ignore_queue=True)
+    status_broadcaster.publish()
+    if state != "open":
+        dispatch_queue()
+
+def remove_stale_servers(now):
+    """Hủy đăng ký server tự đăng ký đã ngừng heartbeat và xóa server đã hủy đăng ký còn trống"""
+    changed = False
+    for server_id in health_checker.stale(now):
+        server = leases.servers.get(server_id)
+        health_checker.remove_server(server_id)
+        if server is None:
+            continue
+        print(f"{server['name']} không gửi heartbeat quá {SERVER_REGISTRATION_TTL}s, hủy đăng ký")
+        leases.remove_server(server_id)
+        socketio.emit('notification', {
+            'message': f'{server["name"]} mất heartbeat, đã bị hủy đăng ký.',
+            'type': 'error'
+        }, room=DASHBOARD_ROOM)
+        changed = True
+
+    if leases.prune():
+        changed = True
+    if changed:
+        status_broadcaster.publish()
+        dispatch_queue()
+
+def health_check_loop():
+    """Vòng nền lên lịch các probe sức khỏe theo heap thời điểm kiểm tra kế tiếp"""
+    while True:
+        now = time.time()
+        for server_id in health_checker.due(now):
+            socketio.start_background_task(probe_server, server_id)
+        remove_stale_servers(now)
+        db_client.tick_breakers(now)
+
+        next_due = health_checker.next_due()
+        delay = HEALTH_CHECK_INTERVAL
+        if next_due is not None:
+            delay = min(max(next_due - time.time(), 0.05), HEALTH_CHECK_INTERVAL)
+        socketio.sleep(delay)
+
+def journal_loop():
+    """Vòng nền ghi nhật ký lease theo lô và nén thành snapshot khi WAL đủ dài"""
+    while True:
+        try:
+            lease_journal.flush()
+            if lease_journal.records_since_snapshot >= JOURNAL_COMPACT_RECORDS:
+                lease_journal.compact(leases)
+        except Exception as e:
+            print(f"Lỗi khi ghi nhật ký lease: {str(e)}")
+        socketio.sleep(JOURNAL_FLUSH_INTERVAL)
+
+def restore_leases():
+    """Phát lại nhật ký lease: khôi phục server đã đăng ký và các lease đang hoạt động"""
+    started = time.time()
+    state = lease_journal.load()
+    for server_id, server in state["servers"].items():
+        if server_id not in leases.servers:
+            leases.add_server(server)
+            health_checker.add_server(server_id, registered=True)
+
+    restored = 0
+    for client_id, lease in state["leases"].items():
+        if leases.restore(client_id, lease["server_id"], lease["mode"], lease["granted_at"],
+                          lease.get("priority", DEFAULT_PRIORITY)):
+            restored += 1
+    print(f"Khôi phục {restored} lease từ nhật ký trong {(time.time() - started) * 1000:.1f} ms")
+
+def reconcile_with_servers():
+    """Đối chiếu lease đã khôi phục với /status của từng database server
+
+    Client mà database server vẫn đang phục vụ nhưng coordinator không có
+    lease (mất phần cuối nhật ký) được nhận lại nếu server còn chỗ, nếu không
+    thì database server được báo giải phóng client đó.
+    """
+    for server in list(leases.servers.values()):
+        try:
+            response = db_client.request("GET", server, "/status", HEALTH_CHECK_TIMEOUT, limited=False)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            print(f"Không thể đối chiếu lease với {server['name']}: {str(e)}")
+            continue
+
+        for client_id in data.get("current_clients", []):
+            if leases.server_of(client_id) is server:
+                continue
+            mode = "exclusive" if data.get("exclusive_client") == client_id else "shared"
+            if leases.restore(client_id, server["id"], mode, time.time()):
+                print(f"Nhận lại lease của client {client_id} trên {server['name']}")
+            else:
+                release_database_server(server, client_id)
+    status_broadcaster.publish()
+
+def shared_state_loop():
+    """Vòng nền áp dụng thay đổi của các worker khác và nén bảng lease dùng chung"""
+    while True:
+        try:
+            shared_store.flush_renewals()
+            shared_store.sync()
+            handle_remote_changes(shared_store.take_events())
+            if shared_store.seq - shared_store.snapshot_seq >= SHARED_COMPACT_RECORDS:
+                shared_store.compact()
+        except Exception as e:
+            print(f"Lỗi khi đồng bộ bảng lease dùng chung: {str(e)}")
+        socketio.sleep(SHARED_SYNC_INTERVAL)
+
+def handle_remote_changes(events):
+    """Cập nhật phần ngoài bảng lease theo thay đổi của worker khác
+
+    Lịch health check theo server đăng ký/heartbeat/hủy đăng ký, phát trạng
+    thái mới, và trao slot vừa được worker khác giải phóng cho hàng đợi.
+    """
+    if not events:
+        return
+    for entry in events:
+        op = entry["op"]
+        if op == "server_registered":
+            health_checker.add_server(entry["server_id"], registered=True)
+        elif op == "server_seen":
+            health_checker.seen(entry["server_id"])
+        elif op in ("deregister", "server_removed"):
+            health_checker.remove_server(entry["server_id"])
+    status_broadcaster.publish()
+    if wait_queue:
+        dispatch_queue()
+
 def init_server_status():
-    """Khởi tạo trạng thái các server"""
-    global server_status
+    """Khởi tạo trạng thái các server và khôi phục lease từ nhật ký hoặc bảng dùng chung"""
+    if shared_store:
+        shared_store.attach(leases)
+        # Server tự đăng ký mà worker khác (hoặc lần chạy trước) đã ghi nhận
+        seed_ids = {int(server["id"]) for server in database_servers}
+        for server_id in leases.servers:
+            if server_id not in seed_ids:
+                health_checker.add_server(server_id, registered=True)
+
     for server in database_servers:
-        server_status[server["id"]] = {
-            "busy": False,
-            "current_client": None,
-            "last_access": 0
-        }
+        leases.add_server(server)
+        health_checker.add_server(int(server["id"]))
 
-if __name__ == '__main__':
+    if lease_journal:
+        restore_leases()
+        leases.journal = lease_journal
+        lease_journal.compact(leases)
+    status_broadcaster.flush()
+
+def start_coordinator():
+    """Khởi tạo trạng thái và chạy các vòng nền của một tiến trình coordinator"""
+    # Version trạng thái của mỗi worker nằm ở vùng riêng để ETag/since của
+    # worker này không trùng với worker khác
+    status_broadcaster.version = worker_index << 32
     init_server_status()
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    if LEASE_TTL_SECONDS > 0:
+        socketio.start_background_task(lease_expiry_loop)
+    socketio.start_background_task(health_check_loop)
+    if PREEMPT_GRACE_SECONDS >= 0:
+        socketio.start_background_task(preemption_loop)
+    if lease_journal:
+        socketio.start_background_task(journal_loop)
+    if shared_store:
+        socketio.start_background_task(shared_state_loop)
+    if (lease_journal or shared_store) and worker_index == 0:
+        socketio.start_background_task(reconcile_with_servers)
+
+def serve_worker(index, listener, host, port):
+    """Chạy một worker coordinator trên socket đang nghe do tiến trình cha mở"""
+    global worker_index
+    worker_index = index
+    start_coordinator()
+    print(f"Worker {index} (pid {os.getpid()}) sẵn sàng")
+    if socketio.server.eio.async_mode == 'eventlet':
+        import eventlet.wsgi
+        eventlet.wsgi.server(listener, app, log_output=False, max_size=COORDINATOR_MAX_CONNECTIONS)
+    else:
+        make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+def run_workers(host, port):
+    """Chạy COORDINATOR_WORKERS tiến trình coordinator dùng chung một cổng
+
+    Tiến trình cha mở cổng rồi fork các worker; kernel chia kết nối mới cho
+    các worker đang chờ accept. Một kết nối Socket.IO phải nằm trọn ở một
+    worker nên client cần dùng transport websocket (hoặc đặt các worker sau
+    load balancer có sticky session).
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+
+    workers = []
+    for index in range(COORDINATOR_WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            serve_worker(index, listener, host, port)
+            os._exit(0)
+        workers.append(pid)
+    print(f"Coordinator chạy {len(workers)} worker trên {host}:{port}")
+
+    def stop(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for pid in workers:
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    if COORDINATOR_WORKERS > 1:
+        run_workers('0.0.0.0', 5000)
+    else:
+        start_coordinator()
+        # Tắt reloader: tiến trình cha của reloader cũng chạy start_coordinator
+        # (khôi phục, nén nhật ký lease và các vòng nền) song song với tiến trình con
+        server_options = {}
+        if socketio.server.eio.async_mode == 'eventlet':
+            server_options['max_size'] = COORDINATOR_MAX_CONNECTIONS
+        socketio.run(app, host='0.0.0.0', port=5000, debug=True, use_reloader=False, **server_options)
\ No newline at end of file
@@ -1,8 +1,31 @@
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, emit
+# Dùng eventlet khi có (requirements.txt): monkey patch để các vòng nền
+# (ghi access_log, heartbeat tới coordinator), pool kết nối và các lời gọi
+# HTTP nhường event loop thay vì chặn toàn bộ server
+try:
+    import eventlet
+    eventlet.monkey_patch()
+except ImportError:
+    pass
+
+from flask import Flask, Response, request, jsonify
+from flask_socketio import SocketIO, emit, join_room
 import sqlite3
 import datetime
 import os
+import time
+import json
+import hmac
+import hashlib
+import base64
+import atexit
+import signal
+import sys
+import queue
+import threading
+import functools
+import requests
+from collections import deque
+from contextlib import contextmanager
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -13,18 +36,249 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 SERVER_ID = 1  
 SERVER_PORT = 5001  
 
-# Lưu trữ thông tin client hiện tại
-current_client = None
+# Coordinator để tự đăng ký, và địa chỉ mà coordinator dùng để gọi server này
+COORDINATOR_URL = os.environ.get('COORDINATOR_URL', 'http://192.168.214.103:5000')
+SERVER_URL = os.environ.get('SERVER_URL')
+SERVER_CAPACITY = int(os.environ.get('SERVER_CAPACITY', 1))
+
+# Khóa dùng chung với coordinator để xác thực lease token (HMAC-SHA256),
+# và độ lệch đồng hồ (giây) cho phép khi kiểm tra hạn token
+LEASE_TOKEN_SECRET = os.environ.get('LEASE_TOKEN_SECRET', 'dev-lease-token-secret')
+LEASE_TOKEN_LEEWAY = 2
+
+# Lease đã giải phóng: client_id -> (granted_at lớn nhất đã bị thu hồi, thời
+# điểm ghi nhận). Token có granted_at không lớn hơn giá trị này không còn hiệu lực.
+# Được lưu vào bảng lease_revocations và nạp lại khi server khởi động
+revoked_leases = {}
+
+# Thời gian (giây) giữ bản ghi thu hồi, dài hơn thời hạn tối đa của token
+REVOCATION_RETENTION = 7200
+
+# Lưu trữ các client đang được cấp lease trên server này: client_id -> chế độ
+# ("shared" dùng chung với các client khác, "exclusive" độc quyền)
+current_clients = {}
 
 # Lưu trữ socket connections
 socket_connections = {}
 
+# Phòng Socket.IO của các dashboard/giám sát; client thường không nhận các
+# sự kiện truy cập của client khác
+MONITOR_ROOM = "dashboards"
+
+# File cơ sở dữ liệu của server này
+DB_FILE = f'database_server{SERVER_ID}.db'
+
+# Pool kết nối SQLite: số kết nối đọc tối đa, thời gian chờ (giây) khi mọi
+# kết nối đều đang bận, và các pragma (cache tính bằng KiB, mmap bằng byte)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = 5
+DB_BUSY_TIMEOUT = 5
+DB_CACHE_SIZE_KB = 16384
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# access_log được ghi theo lô ở nền: flush khi bộ đệm đủ ACCESS_LOG_BATCH_SIZE
+# bản ghi hoặc sau ACCESS_LOG_FLUSH_INTERVAL giây; bộ đệm giữ tối đa
+# ACCESS_LOG_MAX_PENDING bản ghi khi đĩa không theo kịp
+ACCESS_LOG_BATCH_SIZE = 500
+ACCESS_LOG_FLUSH_INTERVAL = float(os.environ.get('ACCESS_LOG_FLUSH_MS', 50)) / 1000
+ACCESS_LOG_MAX_PENDING = 100000
+
+# Số hoạt động gần nhất trả về trong /status
+RECENT_ACTIVITY_SIZE = 10
+
+# /data phân trang theo id: số dòng mặc định và tối đa mỗi trang, và số dòng
+# đọc từ cursor mỗi lần khi stream NDJSON
+DATA_PAGE_SIZE = 1000
+DATA_PAGE_MAX = 10000
+DATA_STREAM_BATCH = 500
+
+# Truy vấn /data: các cột được chọn/sắp xếp, các cột được lọc và phép lọc
+# (?name=..., ?value__gte=..., ?name__prefix=...). DATA_STATEMENT_CACHE câu
+# SQL đã biên dịch được giữ lại, mỗi kết nối SQLite cũng giữ ngần ấy
+# prepared statement
+DATA_COLUMNS = ("id", "name", "value")
+DATA_FILTER_COLUMNS = ("name", "value")
+DATA_FILTER_OPS = {"eq": "=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "prefix": None}
+DATA_STATEMENT_CACHE = 128
+
+class ConnectionPool:
+    """Pool kết nối SQLite dùng lại trong suốt vòng đời tiến trình
+
+    Database ở chế độ WAL nên đọc không chặn ghi và ngược lại. Kết nối đọc
+    (query_only) được tạo dần tới `size` và mượn/trả qua một hàng đợi LIFO
+    an toàn giữa các thread (và greenlet khi chạy eventlet); SQLite chỉ cho
+    một writer nên mọi thao tác ghi dùng chung một kết nối giữ bằng khóa.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.write_conn = None
+
+    def _connect(self, readonly):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=DATA_STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + synchronous=NORMAL: commit không fsync, chỉ checkpoint mới fsync
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Mượn một kết nối đọc, trả lại pool khi xong"""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    conn = self._connect(readonly=True)
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                try:
+                    conn = self.idle.get(timeout=DB_POOL_TIMEOUT)
+                except queue.Empty:
+                    raise RuntimeError(f"Không có kết nối database rảnh sau {DB_POOL_TIMEOUT} giây")
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """Kết nối ghi duy nhất; commit khi xong, rollback nếu có lỗi"""
+        with self.write_lock:
+            if self.write_conn is None:
+                self.write_conn = self._connect(readonly=False)
+            try:
+                yield self.write_conn
+                self.write_conn.commit()
+            except Exception:
+                self.write_conn.rollback()
+                raise
+
+db_pool = ConnectionPool(DB_FILE)
+
+class AccessLogWriter:
+    """Ghi access_log theo lô ở nền, request không phải chờ commit xuống đĩa
+
+    log() chỉ thêm bản ghi vào bộ đệm trong bộ nhớ; vòng nền run() ghi cả
+    bộ đệm bằng executemany trong một giao dịch khi đủ batch_size bản ghi
+    hoặc sau flush_interval giây. Lô ghi lỗi được đưa lại đầu bộ đệm để thử
+    lại; bản ghi còn trong bộ đệm được ghi nốt khi server tắt. Khi bộ đệm
+    vượt max_pending, bản ghi cũ nhất bị bỏ và được đếm trong dropped.
+
+    Tổng số bản ghi (total) và các hoạt động gần nhất (recent, ring buffer)
+    được giữ trong bộ nhớ, nạp từ database một lần lúc khởi động, để
+    /status không phải quét access_log.
+    """
+
+    def __init__(self, pool, batch_size=ACCESS_LOG_BATCH_SIZE,
+                 flush_interval=ACCESS_LOG_FLUSH_INTERVAL, max_pending=ACCESS_LOG_MAX_PENDING):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.dropped = 0
+        self.total = 0
+        self.recent = deque(maxlen=RECENT_ACTIVITY_SIZE)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def load(self, conn):
+        """Nạp tổng số bản ghi và các hoạt động gần nhất từ database"""
+        total = conn.execute("SELECT COUNT(*) FROM access_log").fetchone()[0]
+        rows = conn.execute(
+            "SELECT client_id, access_time, operation FROM access_log ORDER BY access_time DESC LIMIT ?",
+            (RECENT_ACTIVITY_SIZE,)
+        ).fetchall()
+        with self.lock:
+            self.total = total + len(self.pending)
+            self.recent.extend(tuple(row) for row in reversed(rows))
+            self.recent.extend(self.pending)
+
+    def log(self, client_id, operation):
+        entry = (client_id, datetime.datetime.now().isoformat(), operation)
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+                self.total -= 1
+            self.pending.append(entry)
+            self.recent.append(entry)
+            self.total += 1
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def stats(self):
+        """(tổng số bản ghi, các hoạt động gần nhất mới nhất trước), O(1)"""
+        with self.lock:
+            return self.total, list(reversed(self.recent))
+
+    def flush(self):
+        """Ghi toàn bộ bộ đệm trong một giao dịch, trả về số bản ghi đã ghi"""
+        with self.flush_lock:
+            with self.lock:
+                batch = list(self.pending)
+                self.pending.clear()
+            if not batch:
+                return 0
+            try:
+                with self.pool.writer() as conn:
+                    conn.executemany(
+                        "INSERT INTO access_log (client_id, access_time, operation) VALUES (?, ?, ?)",
+                        batch
+                    )
+            except Exception:
+                with self.lock:
+                    self.pending.extendleft(reversed(batch))
+                raise
+            return len(batch)
+
+    def run(self):
+        """Vòng nền flush bộ đệm theo ngưỡng số bản ghi hoặc thời gian"""
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Lỗi khi ghi access_log: {str(e)}")
+                time.sleep(self.flush_interval)
+
+access_log = AccessLogWriter(db_pool)
+
 # Tạo và khởi tạo cơ sở dữ liệu
 def init_db():
     """Khởi tạo cơ sở dữ liệu nếu chưa tồn tại"""
-    db_file = f'database_server{SERVER_ID}.db'
+    with db_pool.writer() as conn:
+        create_tables(conn)
+        access_log.load(conn)
+        load_revocations(conn)
     
-    conn = sqlite3.connect(db_file)
+    print(f"Database initialized for server {SERVER_ID}")
+
+def create_tables(conn):
+    """Tạo bảng và dữ liệu mẫu (chạy trong giao dịch của kết nối ghi)"""
     c = conn.cursor()
     
     # Tạo bảng access_log để ghi lại lịch sử truy cập
@@ -36,6 +290,16 @@ def init_db():
         operation TEXT
     )
     ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_access_log_time ON access_log (access_time)")
+
+    # Lease token đã bị thu hồi, để token cũ không dùng lại được sau khi khởi động lại
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS lease_revocations (
+        client_id TEXT PRIMARY KEY,
+        granted_at REAL NOT NULL,
+        revoked_at REAL NOT NULL
+    )
+    ''')
     
     # Tạo bảng dữ liệu mẫu nếu chưa có
     c.execute('''
@@ -45,6 +309,9 @@ def init_db():
         value TEXT NOT NULL
     )
     ''')
+    # Chỉ mục cho lọc/sắp xếp /data theo name, value (id đi kèm trong chỉ mục)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sample_data_name ON sample_data (name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sample_data_value ON sample_data (value)")
     
     # Thêm dữ liệu mẫu nếu bảng trống
     c.execute("SELECT COUNT(*) FROM sample_data")
@@ -57,17 +324,17 @@ def init_db():
             ('Item 5', f'Value 5 from Server {SERVER_ID}')
         ]
         c.executemany("INSERT INTO sample_data (name, value) VALUES (?, ?)", sample_data)
-    
-    conn.commit()
-    conn.close()
-    
-    print(f"Database initialized for server {SERVER_ID}")
 
 @socketio.on('connect')
 def handle_connect():
     """Xử lý khi client kết nối websocket"""
     print(f"Client connected to database server {SERVER_ID}: {request.sid}")
 
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    """Dashboard đăng ký nhận các sự kiện truy cập của server"""
+    join_room(MONITOR_ROOM)
+
 @socketio.on('register_db_client')
 def handle_register(data):
     """Đăng ký client với server"""
@@ -76,8 +343,8 @@ def handle_register(data):
         socket_connections[client_id] = request.sid
         print(f"Client {client_id} registered with DB server {SERVER_ID}, socket: {request.sid}")
         
-        # Kiểm tra xem client này có phải là client hiện tại không
-        if client_id == current_client:
+        # Kiểm tra xem client này có đang được cấp lease không
+        if client_id in current_clients:
             emit('db_registered', {
                 'status': 'success', 
                 'message': f'Registered as {client_id} with database server {SERVER_ID}'
@@ -91,15 +358,13 @@ def handle_register(data):
 @socketio.on('disconnect')
 def handle_disconnect():
     """Xử lý khi client ngắt kết nối"""
-    global current_client
-    
     # Tìm và xóa client_id khỏi socket_connections
     for client_id, sid in list(socket_connections.items()):
         if sid == request.sid:
-            # Nếu client này là client hiện tại, reset trạng thái
-            if client_id == current_client:
+            # Nếu client này đang giữ lease, thu hồi lease
+            if client_id in current_clients:
                 print(f"Client {client_id} đã ngắt kết nối từ database server {SERVER_ID}")
-                current_client = None
+                current_clients.pop(client_id, None)
                 
                 # Ghi log giải phóng tự động
                 log_access(client_id, "auto_release")
@@ -109,28 +374,127 @@ def handle_disconnect():
                     'client_id': client_id,
                     'server_id': SERVER_ID,
                     'message': f"Client {client_id} đã ngắt kết nối từ Database Server {SERVER_ID}"
-                })
+                }, room=MONITOR_ROOM)
             
             del socket_connections[client_id]
             break
 
+def verify_lease_token(token):
+    """Kiểm tra lease token do coordinator ký, trả về claims hoặc None
+
+    Token hợp lệ khi chữ ký đúng, cấp cho server này, chưa hết hạn và chưa
+    bị thu hồi. Không cần hỏi coordinator nên vẫn đúng sau khi server khởi
+    động lại.
+    """
+    try:
+        payload, signature = token.encode().split(b".")
+        expected = base64.urlsafe_b64encode(
+            hmac.new(LEASE_TOKEN_SECRET.encode(), payload, hashlib.sha256).digest()
+        ).rstrip(b"=")
+        if not hmac.compare_digest(signature, expected):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + b"=" * (-len(payload) % 4)))
+    except (ValueError, AttributeError):
+        return None
+
+    if claims.get("server_id") != SERVER_ID:
+        return None
+    if claims["exp"] + LEASE_TOKEN_LEEWAY < time.time():
+        return None
+    if claims["granted_at"] <= revoked_until(claims["client_id"]):
+        return None
+    return claims
+
+def verify_release_signature(data):
+    """Yêu cầu /release có chữ ký HMAC của coordinator và dành cho server này"""
+    signature = data.get('signature')
+    if not isinstance(signature, str) or data.get('server_id') != SERVER_ID:
+        return False
+    signed = {key: data.get(key) for key in ('client_id', 'server_id', 'granted_at', 'reason')}
+    message = json.dumps(signed, separators=(",", ":"), sort_keys=True).encode()
+    expected = base64.urlsafe_b64encode(
+        hmac.new(LEASE_TOKEN_SECRET.encode(), b"release." + message, hashlib.sha256).digest()
+    ).rstrip(b"=")
+    return hmac.compare_digest(signature.encode(), expected)
+
+def is_timestamp(value):
+    """granted_at hợp lệ: số (int/float), không phải bool"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_authorized(client_id, token):
+    """Client có quyền truy cập: lease token hợp lệ hoặc đã được coordinator thông báo"""
+    if token:
+        claims = verify_lease_token(token)
+        if claims and claims["client_id"] == client_id:
+            return True
+    return client_id in current_clients
+
+def revoked_until(client_id):
+    """granted_at lớn nhất đã bị thu hồi của client, -inf nếu chưa có"""
+    entry = revoked_leases.get(client_id)
+    return entry[0] if entry else float("-inf")
+
+def revoke_lease(client_id, granted_at):
+    """Thu hồi các lease token của client có granted_at <= granted_at
+
+    Bản ghi được xóa theo thời điểm ghi nhận (không theo granted_at) sau
+    REVOCATION_RETENTION giây, khi mọi token bị thu hồi đều đã hết hạn.
+    """
+    now = time.time()
+    granted_at = max(granted_at, revoked_until(client_id))
+    cutoff = now - REVOCATION_RETENTION
+    # Ghi xuống database trước khi xác nhận, để thu hồi còn hiệu lực sau khi khởi động lại
+    with db_pool.writer() as conn:
+        conn.execute("INSERT OR REPLACE INTO lease_revocations (client_id, granted_at, revoked_at) "
+                     "VALUES (?, ?, ?)", (client_id, granted_at, now))
+        conn.execute("DELETE FROM lease_revocations WHERE revoked_at < ?", (cutoff,))
+    revoked_leases[client_id] = (granted_at, now)
+    for cid, (_, revoked_at) in list(revoked_leases.items()):
+        if revoked_at < cutoff:
+            del revoked_leases[cid]
+
+def load_revocations(conn):
+    """Nạp các thu hồi còn trong thời gian giữ từ bảng lease_revocations"""
+    conn.execute("DELETE FROM lease_revocations WHERE revoked_at < ?",
+                 (time.time() - REVOCATION_RETENTION,))
+    for client_id, granted_at, revoked_at in conn.execute(
+            "SELECT client_id, granted_at, revoked_at FROM lease_revocations"):
+        revoked_leases[client_id] = (granted_at, revoked_at)
+
 @app.route('/notify_access', methods=['POST'])
 def notify_access():
     """Endpoint để coordinator thông báo rằng một client sẽ truy cập server này"""
-    global current_client
-    
     data = request.json
     client_id = data.get('client_id')
     
     if not client_id:
         return jsonify({"error": "Client ID is required"}), 400
+
+    mode = data.get('mode', 'shared')
+    if mode not in ('shared', 'exclusive'):
+        return jsonify({"error": "mode must be shared or exclusive"}), 400
+
+    # Thông báo chạy nền có thể tới sau khi lease đã được giải phóng
+    granted_at = data.get('granted_at')
+    if granted_at is not None and not is_timestamp(granted_at):
+        return jsonify({"error": "granted_at must be a number"}), 400
+    if granted_at is not None and granted_at <= revoked_until(client_id):
+        return jsonify({"error": f"Lease of client {client_id} was already released"}), 410
+
+    # Lease exclusive cần server trống, lease shared không đi cùng lease exclusive
+    others = {cid: m for cid, m in current_clients.items() if cid != client_id}
+    if others and (mode == 'exclusive' or 'exclusive' in others.values()):
+        return jsonify({
+            "error": f"Database Server {SERVER_ID} is held by other clients",
+            "current_clients": sorted(others)
+        }), 409
     
-    # Lưu client hiện tại
-    current_client = client_id
+    # Thêm client vào danh sách được cấp lease
+    current_clients[client_id] = mode
     
     # Hiển thị thông báo về client đang truy cập
     print(f"=== DATABASE SERVER {SERVER_ID} ===")
-    print(f"Client {client_id} đang truy cập Database Server {SERVER_ID}")
+    print(f"Client {client_id} đang truy cập Database Server {SERVER_ID} ({mode})")
     print("=====================================")
     
     # Ghi log truy cập
@@ -142,7 +506,7 @@ def notify_access():
         'server_id': SERVER_ID,
         'timestamp': datetime.datetime.now().isoformat(),
         'message': f"Client {client_id} đang truy cập Database Server {SERVER_ID}"
-    })
+    }, room=MONITOR_ROOM)
     
     return jsonify({
         "status": "success",
@@ -151,17 +515,36 @@ def notify_access():
 
 @app.route('/data', methods=['GET'])
 def get_data():
-    """Endpoint để client truy vấn dữ liệu"""
+    """Endpoint để client truy vấn dữ liệu
+
+    - fields: các cột cần lấy, ví dụ "id,name" (mặc định mọi cột)
+    - lọc trên name/value: ?name=<giá trị>, ?value__gte=..., __gt, __lt,
+      __lte, __prefix
+    - order: cột sắp xếp, "-" phía trước để giảm dần (mặc định id)
+    - phân trang keyset: ?after=<cursor>&limit=<số dòng> (mặc định
+      DATA_PAGE_SIZE, tối đa DATA_PAGE_MAX); "next_after" trong kết quả là
+      cursor của trang sau (id, hoặc [giá trị, id] khi sắp xếp theo cột
+      khác), None khi đã hết
+    - ?stream=1 trả về các dòng dạng NDJSON (application/x-ndjson) đọc dần
+      từ cursor phía server với bộ nhớ không đổi theo kích thước bảng; limit
+      mặc định là không giới hạn
+    """
     client_id = request.headers.get('X-Client-ID')
     
     if not client_id:
         return jsonify({"error": "Client ID header is required"}), 400
     
-    # Kiểm tra xem client này có phải là client đã được thông báo không
-    if client_id != current_client:
+    # Kiểm tra lease token (hoặc client đã được coordinator thông báo)
+    lease_token = request.headers.get('X-Lease-Token')
+    if not is_authorized(client_id, lease_token):
         return jsonify({
             "error": "Unauthorized access. This client was not assigned to this server."
         }), 403
+
+    try:
+        query = parse_data_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     # Log truy cập dữ liệu
     log_access(client_id, "query_data")
@@ -177,49 +560,231 @@ def get_data():
         'server_id': SERVER_ID,
         'timestamp': datetime.datetime.now().isoformat(),
         'message': f"Client {client_id} đang truy xuất dữ liệu từ Database Server {SERVER_ID}"
-    })
+    }, room=MONITOR_ROOM)
     
-    # Lấy dữ liệu từ database
-    db_file = f'database_server{SERVER_ID}.db'
-    conn = sqlite3.connect(db_file)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    limit = query["limit"]
+    sql = compile_data_query(
+        query["fields"], tuple((column, op) for column, op, _ in query["filters"]),
+        query["order"], query["descending"], query["after"] is not None, limit is not None
+    )
+    params = data_query_params(query)
+
+    if query["stream"]:
+        if limit is not None:
+            params.append(limit)
+        return Response(stream_rows(client_id, lease_token, sql, params, query["fields"]),
+                        mimetype='application/x-ndjson')
+
+    # Lấy một trang dữ liệu từ database (thêm một dòng để biết còn trang sau không)
+    with db_pool.reader() as conn:
+        rows = conn.execute(sql, params + [limit + 1]).fetchall()
     
-    c.execute("SELECT * FROM sample_data")
-    rows = c.fetchall()
+    # Chuyển đổi kết quả thành list of dict (chỉ các cột được yêu cầu)
+    data = [{field: row[field] for field in query["fields"]} for row in rows[:limit]]
     
-    # Chuyển đổi kết quả thành list of dict
-    data = [dict(row) for row in rows]
-    conn.close()
+    next_after = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_after = last["id"] if query["order"] == "id" else [last[query["order"]], last["id"]]
     
     return jsonify({
         "server_id": SERVER_ID,
         "data": data,
+        "next_after": next_after,
         "timestamp": datetime.datetime.now().isoformat()
     })
 
+def parse_data_query(args):
+    """Đọc truy vấn /data từ query string theo allow-list
+
+    Trả về {stream, fields, filters, order, descending, after, limit};
+    filters là danh sách (cột, phép lọc, giá trị) đã sắp xếp để cùng một
+    kiểu truy vấn luôn ra cùng một câu SQL. Tham số không hợp lệ (kể cả
+    tham số lặp lại) gây ValueError với thông báo trả về cho client.
+    """
+    # args.get/items chỉ thấy giá trị đầu của khóa lặp lại, không được bỏ qua lặng lẽ
+    for key, values in args.lists():
+        if len(values) > 1:
+            raise ValueError(f"Query parameter {key} must appear at most once")
+
+    stream = args.get('stream', '').lower() in ('1', 'true')
+
+    fields = DATA_COLUMNS
+    if args.get('fields'):
+        fields = tuple(field.strip() for field in args['fields'].split(','))
+        if any(field not in DATA_COLUMNS for field in fields) or len(set(fields)) != len(fields):
+            raise ValueError(f"fields must be a comma-separated list of {', '.join(DATA_COLUMNS)}")
+
+    order = args.get('order', 'id')
+    descending = order.startswith('-')
+    order = order[1:] if descending else order
+    if order not in DATA_COLUMNS:
+        raise ValueError(f"order must be one of {', '.join(DATA_COLUMNS)}, optionally prefixed with -")
+
+    filters = []
+    for key, value in args.items():
+        if key in ('stream', 'fields', 'order', 'after', 'limit'):
+            continue
+        column, _, op = key.partition('__')
+        op = op or 'eq'
+        if column not in DATA_FILTER_COLUMNS or op not in DATA_FILTER_OPS:
+            raise ValueError(f"Unknown query parameter: {key}")
+        filters.append((column, op, value))
+    filters.sort()
+
+    after = None
+    if 'after' in args:
+        try:
+            if order == 'id':
+                after = [int(args['after'])]
+            else:
+                after = json.loads(args['after'])
+                # Giá trị cột sắp xếp phải là kiểu SQLite bind được, id là số nguyên
+                if not (isinstance(after, list) and len(after) == 2
+                        and isinstance(after[0], (str, int, float)) and not isinstance(after[0], bool)
+                        and isinstance(after[1], int) and not isinstance(after[1], bool)):
+                    raise ValueError
+        except ValueError:
+            raise ValueError("after must be the next_after cursor of the previous page")
+
+    limit = args.get('limit')
+    try:
+        limit = int(limit) if limit is not None else (None if stream else DATA_PAGE_SIZE)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit is not None and (limit < 1 or (not stream and limit > DATA_PAGE_MAX)):
+        raise ValueError(f"limit must be between 1 and {DATA_PAGE_MAX}")
+
+    return {
+        "stream": stream,
+        "fields": fields,
+        "filters": filters,
+        "order": order,
+        "descending": descending,
+        "after": after,
+        "limit": limit
+    }
+
+@functools.lru_cache(maxsize=DATA_STATEMENT_CACHE)
+def compile_data_query(fields, filters, order, descending, keyset, limited):
+    """Biên dịch một kiểu truy vấn /data thành SQL có tham số (có cache)
+
+    filters là các cặp (cột, phép lọc). Tên cột và phép so sánh chỉ lấy từ
+    allow-list, mọi giá trị đều truyền qua tham số. Luôn sắp xếp thêm theo
+    id để cursor (cột sắp xếp, id) là duy nhất; cột sắp xếp và id luôn được
+    SELECT để tính next_after dù không nằm trong fields.
+    """
+    columns = list(fields) + [column for column in dict.fromkeys((order, "id")) if column not in fields]
+
+    where = []
+    for column, op in filters:
+        if op == "prefix":
+            where.append(f"{column} >= ? AND {column} < ?")
+        else:
+            where.append(f"{column} {DATA_FILTER_OPS[op]} ?")
+    comparison = "<" if descending else ">"
+    if keyset:
+        where.append(f"id {comparison} ?" if order == "id" else f"({order}, id) {comparison} (?, ?)")
+
+    direction = "DESC" if descending else "ASC"
+    sql = f"SELECT {', '.join(columns)} FROM sample_data"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} {direction}"
+    if order != "id":
+        sql += f", id {direction}"
+    if limited:
+        sql += " LIMIT ?"
+    return sql
+
+def data_query_params(query):
+    """Tham số theo đúng thứ tự dấu ? của compile_data_query (trừ LIMIT)"""
+    params = []
+    for column, op, value in query["filters"]:
+        if op == "prefix":
+            # So sánh chuỗi theo byte UTF-8: mọi chuỗi bắt đầu bằng value đều nhỏ hơn value + U+10FFFF
+            params += [value, value + "\U0010ffff"]
+        else:
+            params.append(value)
+    if query["after"] is not None:
+        params += query["after"]
+    return params
+
+def stream_rows(client_id, lease_token, sql, params, fields):
+    """Sinh kết quả của truy vấn dạng NDJSON, mỗi lần DATA_STREAM_BATCH dòng
+
+    WSGI server chỉ lấy lô tiếp theo khi đã gửi xong lô trước, nên client
+    đọc chậm thì cursor cũng đọc chậm theo (backpressure) và bộ nhớ chỉ giữ
+    một lô. Lease bị thu hồi giữa chừng thì dừng với một dòng {"error"}.
+    Kết nối đọc được giữ tới khi stream kết thúc.
+    """
+    with db_pool.reader() as conn:
+        cursor = conn.execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(DATA_STREAM_BATCH)
+                if not rows:
+                    break
+                if not is_authorized(client_id, lease_token):
+                    yield json.dumps({"error": "Lease revoked during stream"}) + "\n"
+                    break
+                yield "".join(
+                    json.dumps({field: row[field] for field in fields}) + "\n" for row in rows
+                )
+        finally:
+            # Client ngắt giữa chừng: đóng cursor để kết nối trả về pool không
+            # còn giữ giao dịch đọc
+            cursor.close()
+
 @app.route('/release', methods=['POST'])
 def release_access():
     """Endpoint để client thông báo đã hoàn thành truy cập"""
-    global current_client
-    
     data = request.json
     client_id = data.get('client_id')
     
     if not client_id:
         return jsonify({"error": "Client ID is required"}), 400
     
-    # Kiểm tra xem client này có phải là client hiện tại không
-    if client_id != current_client:
+    # Client gửi kèm lease token, coordinator gửi granted_at của lease cần thu hồi
+    # kèm chữ ký; granted_at không có chữ ký hợp lệ không được dùng để thu hồi
+    token = data.get('lease_token')
+    claims = verify_lease_token(token) if token else None
+    if claims and claims["client_id"] == client_id:
+        granted_at = claims["granted_at"]
+    else:
+        claims = None
+        granted_at = data.get('granted_at')
+        if granted_at is not None:
+            if not is_timestamp(granted_at):
+                return jsonify({"error": "granted_at must be a number"}), 400
+            if not verify_release_signature(data):
+                return jsonify({
+                    "error": "granted_at requires a valid coordinator signature"
+                }), 403
+
+    # Kiểm tra xem client này có đang được cấp lease không
+    if client_id not in current_clients and granted_at is None:
         return jsonify({
             "error": "Unauthorized access. This client was not assigned to this server."
         }), 403
+
+    if granted_at is not None:
+        revoke_lease(client_id, granted_at)
+
+    if client_id not in current_clients and claims is None:
+        # Lease đã được giải phóng trước đó (client và coordinator cùng báo)
+        return jsonify({
+            "status": "success",
+            "message": f"Access already released for client {client_id}"
+        })
     
-    # Log giải phóng truy cập
-    log_access(client_id, "release")
+    # Log giải phóng truy cập (coordinator gửi kèm lý do khi thu hồi lease hết hạn
+    # hoặc lấy lại lease cho client ưu tiên cao hơn)
+    reason = data.get('reason')
+    log_access(client_id, reason if reason in ("lease_expired", "preempted") else "release")
     
-    # Reset client hiện tại
-    current_client = None
+    # Thu hồi lease của client
+    current_clients.pop(client_id, None)
     
     # Hiển thị thông báo giải phóng
     print(f"=== DATABASE SERVER {SERVER_ID} ===")
@@ -232,7 +797,7 @@ def release_access():
         'server_id': SERVER_ID,
         'timestamp': datetime.datetime.now().isoformat(),
         'message': f"Client {client_id} đã giải phóng Database Server {SERVER_ID}"
-    })
+    }, room=MONITOR_ROOM)
     
     return jsonify({
         "status": "success",
@@ -242,53 +807,101 @@ def release_access():
 @app.route('/status', methods=['GET'])
 def server_status():
     """Endpoint để kiểm tra trạng thái server"""
-    db_file = f'database_server{SERVER_ID}.db'
-    
-    # Đếm số lần truy cập
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    
-    c.execute("SELECT COUNT(*) FROM access_log")
-    access_count = c.fetchone()[0]
-    
-    c.execute("SELECT * FROM access_log ORDER BY access_time DESC LIMIT 10")
-    recent_logs = c.fetchall()
-    
-    conn.close()
+    # Số lần truy cập và hoạt động gần đây giữ sẵn trong bộ nhớ, không truy vấn database
+    access_count, recent_logs = access_log.stats()
     
     # Định dạng log gần đây thành list
     recent_activity = []
-    for log in recent_logs:
+    for client_id, access_time, operation in recent_logs:
         recent_activity.append({
-            "client_id": log[1],
-            "time": log[2],
-            "operation": log[3]
+            "client_id": client_id,
+            "time": access_time,
+            "operation": operation
         })
     
     return jsonify({
         "server_id": SERVER_ID,
         "status": "active",
-        "current_client": current_client,
+        "current_clients": sorted(current_clients),
+        "exclusive_client": next(
+            (cid for cid, mode in current_clients.items() if mode == 'exclusive'), None
+        ),
         "access_count": access_count,
         "recent_activity": recent_activity
     })
 
+def register_with_coordinator(port):
+    """Đăng ký server này với coordinator, trả về chu kỳ heartbeat (giây)
+
+    Coordinator trả về các lease đang có trên server (khi server khởi động lại
+    trong lúc client vẫn giữ lease) để khôi phục danh sách client được phép.
+    """
+    response = requests.post(f"{COORDINATOR_URL}/register_server", json={
+        "id": SERVER_ID,
+        "name": f"Database Server {SERVER_ID}",
+        "url": SERVER_URL or f"http://192.168.214.103:{port}",
+        "capacity": SERVER_CAPACITY
+    }, timeout=5)
+    response.raise_for_status()
+    data = response.json()
+
+    for lease in data.get("leases", []):
+        current_clients.setdefault(lease["client_id"], lease["mode"])
+    print(f"Database Server {SERVER_ID} đã đăng ký với coordinator {COORDINATOR_URL}")
+    return data.get("heartbeat_interval", 10)
+
+def coordinator_heartbeat_loop(port):
+    """Vòng nền gửi heartbeat tới coordinator, đăng ký lại khi coordinator không nhận ra server"""
+    interval = None
+    while True:
+        try:
+            if interval is None:
+                interval = register_with_coordinator(port)
+            else:
+                response = requests.post(f"{COORDINATOR_URL}/server_heartbeat", json={
+                    "server_id": SERVER_ID
+                }, timeout=5)
+                if response.status_code == 404:
+                    interval = register_with_coordinator(port)
+        except Exception as e:
+            print(f"Không thể liên lạc với coordinator: {str(e)}")
+        socketio.sleep(interval or 5)
+
+def deregister_from_coordinator():
+    """Hủy đăng ký với coordinator khi server tắt"""
+    try:
+        requests.post(f"{COORDINATOR_URL}/deregister_server", json={
+            "server_id": SERVER_ID
+        }, timeout=2)
+    except Exception as e:
+        print(f"Không thể hủy đăng ký với coordinator: {str(e)}")
+
 def log_access(client_id, operation):
-    """Ghi log truy cập vào database"""
-    db_file = f'database_server{SERVER_ID}.db'
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    
-    now = datetime.datetime.now().isoformat()
-    c.execute(
-        "INSERT INTO access_log (client_id, access_time, operation) VALUES (?, ?, ?)",
-        (client_id, now, operation)
-    )
-    
-    conn.commit()
-    conn.close()
+    """Ghi log truy cập vào database (qua bộ đệm, không chờ commit)"""
+    access_log.log(client_id, operation)
+
+def flush_access_log():
+    """Ghi nốt access_log còn trong bộ đệm khi server tắt"""
+    try:
+        written = access_log.flush()
+        if written:
+            print(f"Đã ghi {written} bản ghi access_log còn trong bộ đệm")
+    except Exception as e:
+        print(f"Không thể ghi access_log khi tắt: {str(e)}")
 
 if __name__ == '__main__':
     init_db()
     port = int(os.environ.get('PORT', SERVER_PORT))
-    socketio.run(app, host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+
+    # Tự đăng ký với coordinator và hủy đăng ký khi tắt
+    socketio.start_background_task(coordinator_heartbeat_loop, port)
+    atexit.register(deregister_from_coordinator)
+
+    # Ghi access_log theo lô ở nền, ghi nốt bộ đệm khi tắt (SIGTERM cũng
+    # thoát qua sys.exit để các hàm atexit được chạy)
+    socketio.start_background_task(access_log.run)
+    atexit.register(flush_access_log)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Tắt reloader: tiến trình cha của reloader cũng chạy init_db, đăng ký/heartbeat
+    # tới coordinator, bộ ghi access_log và các hàm atexit song song với tiến trình con
+    socketio.run(app, host='0.0.0.0', port=port, debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""Stress test cấp/giải phóng lease của coordinator qua HTTP
+
+Coordinator chạy ở tiến trình riêng như khi triển khai (eventlet nếu có), test
+không import coordinator nên các client là thread thật của hệ điều hành. Nhiều
+client cùng xin lease với long-poll ngắn để hết hạn chờ trùng với lúc
+dispatch_queue trao slot. Kiểm tra không lease nào bị dùng chung quá sức chứa
+(hoặc chung với lease exclusive), client nhận phản hồi khác 200 không giữ lease
+và không còn lease nào sau khi mọi client đã giải phóng.
+"""
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+COORDINATOR_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "coordinator", "coordinator-server.py"
+)
+COORDINATOR_URL = "http://127.0.0.1:5000"
+
+THREADS = 32
+CYCLES = 60
+CAPACITY = 2
+NOTIFY_LATENCY = 0.002
+
+
+def port_in_use(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+@pytest.fixture(scope="module")
+def fake_servers():
+    """Hai database server giả; /notify_access mất NOTIFY_LATENCY giây như một lượt gọi mạng"""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/notify_access":
+            time.sleep(NOTIFY_LATENCY)
+        body = json.dumps({"status": "success", "clients": {}}).encode()
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+    servers = [make_server("127.0.0.1", 0, app, threaded=True) for _ in range(2)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield [f"http://127.0.0.1:{server.server_port}" for server in servers]
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def coordinator(fake_servers, tmp_path, request):
+    if port_in_use(5000):
+        pytest.skip("Cổng 5000 của coordinator đang được dùng")
+    env = dict(os.environ, LEASE_JOURNAL="", LEASE_TTL="0", SERVER_CAPACITY=str(CAPACITY),
+               COORDINATOR_WORKERS="1", LEASE_NOTIFY=request.param)
+    process = subprocess.Popen([sys.executable, COORDINATOR_PATH], env=env, cwd=tmp_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    try:
+        deadline = time.time() + 30
+        while not port_in_use(5000):
+            assert process.poll() is None and time.time() < deadline, "Coordinator không khởi động được"
+            time.sleep(0.1)
+        # Thay URL của các server mặc định bằng server giả
+        for server_id, url in enumerate(fake_servers, start=1):
+            requests.post(f"{COORDINATOR_URL}/register_server", json={
+                "id": server_id, "url": url, "capacity": CAPACITY
+            }, timeout=5).raise_for_status()
+        yield
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def held_leases():
+    """client_id -> server_id của các lease coordinator đang giữ"""
+    status = requests.get(f"{COORDINATOR_URL}/server_status", timeout=10).json()["status"]
+    return {client_id: int(server_id)
+            for server_id, server in status.items() for client_id in server["clients"]}
+
+
+# Với "sync", lease chỉ được commit sau lượt /notify_access nên khoảng giữa
+# giữ chỗ và commit rộng hơn
+@pytest.mark.parametrize("coordinator", ["async", "sync"], indirect=True)
+def test_concurrent_grant_release_never_shares_or_leaks(coordinator):
+    holders = {1: {}, 2: {}}
+    holders_lock = threading.Lock()
+    failures = []
+    statuses = {}
+
+    def worker(index):
+        session = requests.Session()
+        client_id = f"stress-{index}"
+        for cycle in range(CYCLES):
+            mode = "exclusive" if (index + cycle) % 5 == 0 else "shared"
+            response = session.post(f"{COORDINATOR_URL}/request_access", json={
+                "client_id": client_id, "mode": mode, "wait": 0.01 * (cycle % 4)
+            }, timeout=30)
+            with holders_lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            if response.status_code != 200:
+                if client_id in held_leases():
+                    failures.append(f"{client_id} nhận {response.status_code} nhưng vẫn giữ lease")
+                    session.post(f"{COORDINATOR_URL}/release_access", json={"client_id": client_id}, timeout=30)
+                continue
+
+            server_id = response.json()["server_id"]
+            with holders_lock:
+                current = holders[server_id]
+                current[client_id] = mode
+                if len(current) > CAPACITY or ("exclusive" in current.values() and len(current) > 1):
+                    failures.append(f"server {server_id} dùng chung quá mức: {dict(current)}")
+            # Giữ lease một chút để các lease đang hoạt động chồng lên nhau
+            time.sleep(0.001)
+            with holders_lock:
+                del holders[server_id][client_id]
+            released = session.post(f"{COORDINATOR_URL}/release_access", json={"client_id": client_id}, timeout=30)
+            if released.status_code != 200:
+                failures.append(f"{client_id} không giải phóng được lease: {released.status_code}")
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not failures, failures[:10]
+    assert statuses.get(200), statuses
+    # Mọi lease đã cấp đều đã được giải phóng: không còn lease rò rỉ
+    time.sleep(0.5)
+    assert held_leases() == {}